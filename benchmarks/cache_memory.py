@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Compares the memory and speed of the cache implementations.
+
+Every cache is filled in a process of its own, memory is the growth of
+its resident set (Linux only).
+
+    python benchmarks/cache_memory.py --keys 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brainer.lib.arena import ArenaCache
+from brainer.lib.cache import InMemoryCache
+
+CACHES = {'memory': InMemoryCache, 'arena': ArenaCache}
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(name, keys, value_size):
+    # Keys and values are made as they are set, like the ones a node
+    # unpacks from messages: the cache is all that keeps them.
+    before = rss()
+    cache = CACHES[name]()
+
+    start = time.time()
+    for i in xrange(keys):
+        cache.set('key:{}'.format(i), str(i).zfill(value_size), version=i)
+    set_time = time.time() - start
+    memory = rss() - before
+
+    start = time.time()
+    for i in xrange(keys):
+        cache.get('key:{}'.format(i))
+    get_time = time.time() - start
+
+    print('{:8} {:>12.1f} {:>12.0f} {:>12.0f}'.format(
+        name, float(memory) / keys, keys / set_time, keys / get_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=200000)
+    parser.add_argument('--value-size', type=int, default=32)
+    parser.add_argument('--run', choices=sorted(CACHES))
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run, args.keys, args.value_size)
+        return
+
+    print('{} keys, {} byte values'.format(args.keys, args.value_size))
+    print('{:8} {:>12} {:>12} {:>12}'.format(
+        'cache', 'bytes/key', 'sets/s', 'gets/s'))
+    for name in sorted(CACHES, reverse=True):
+        subprocess.check_call([
+            sys.executable, __file__, '--run', name,
+            '--keys', str(args.keys),
+            '--value-size', str(args.value_size)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Compares looking keys up in the hash rings one by one and in batches.
+
+    python benchmarks/hash_lookup.py --nodes 20 --keys 5000
+"""
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brainer.lib.hash import ConsistentHash, HashRing
+
+
+def best(function, repeat, number):
+    return min(timeit.repeat(function, repeat=repeat, number=number))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    keys = ['key:{}'.format(i) for i in range(args.keys)]
+    ring = HashRing(['node-{}'.format(i) for i in range(args.nodes)])
+    consistent = ConsistentHash(args.nodes, 20)
+
+    lookups = [
+        ('HashRing.get_node', lambda: [ring.get_node(key) for key in keys]),
+        ('HashRing.get_nodes', lambda: ring.get_nodes(keys)),
+        ('ConsistentHash.get_machine',
+         lambda: [consistent.get_machine(key) for key in keys]),
+        ('ConsistentHash.get_machines',
+         lambda: consistent.get_machines(keys)),
+    ]
+
+    print('{} nodes, {} keys, best of {} x {} runs'.format(
+        args.nodes, args.keys, args.repeat, args.number))
+    print('{:28} {:>10} {:>12}'.format('lookup', 'seconds', 'keys/s'))
+    for name, function in lookups:
+        seconds = best(function, args.repeat, args.number)
+        print('{:28} {:>10.3f} {:>12.0f}'.format(
+            name, seconds, args.keys * args.number / seconds))
+
+
+if __name__ == '__main__':
+    main()
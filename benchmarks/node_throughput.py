@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Compares the reads per second of a node with and without workers.
+
+A broker and a node are started for each run, the node with
+`--workers` or not. Clients, each in a process of its own, read keys
+straight from the nodes with `SmartBrainer`. Workers only help with
+enough free cores for them and the clients.
+
+    python benchmarks/node_throughput.py --workers 4 --clients 8
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from brainer.client import SmartBrainer
+
+
+def start(script, *args):
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'brainer', script)] +
+            list(args), stdout=devnull, stderr=devnull)
+
+
+def read(broker, keys, seconds):
+    client = SmartBrainer(broker, timeout=5)
+    client.connect()
+    reads, deadline = 0, time.time() + seconds
+    while time.time() < deadline:
+        for key in keys:
+            client.get(key)
+        reads += len(keys)
+    print(reads)
+
+
+def run(args, workers):
+    directory = tempfile.mkdtemp(prefix='brainer-bench-')
+    broker = 'ipc://{}/broker.sock'.format(directory)
+    processes = [start('run_broker', '--endpoint', broker,
+                       '--repair-interval', '0')]
+    try:
+        processes.append(start(
+            'run_node', '--broker', broker, '--node-id', 'node',
+            '--node-endpoint', 'ipc://{}/node.sock'.format(directory),
+            '--workers', str(workers)))
+
+        client = SmartBrainer(broker, timeout=5)
+        client.connect()
+        while len(client.refresh()['nodes']) < max(workers, 1):
+            time.sleep(0.1)
+        keys = ['key:{}'.format(i) for i in range(args.keys)]
+        client.set_many(dict((key, key) for key in keys))
+        client.close()
+
+        clients = [subprocess.Popen(
+            [sys.executable, __file__, '--read', broker,
+             '--keys', str(args.keys), '--seconds', str(args.seconds)],
+            stdout=subprocess.PIPE) for _ in range(args.clients)]
+        reads = sum(int(process.communicate()[0]) for process in clients)
+        print('{:8} {:>12.0f}'.format(workers, reads / args.seconds))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--read')
+    args = parser.parse_args()
+
+    if args.read:
+        read(args.read, ['key:{}'.format(i) for i in range(args.keys)],
+             args.seconds)
+        return
+
+    print('{} clients, {} keys, {} cores'.format(
+        args.clients, args.keys, os.sysconf('SC_NPROCESSORS_ONLN')))
+    print('{:8} {:>12}'.format('workers', 'reads/s'))
+    for workers in (0, args.workers):
+        run(args, workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+import os
+import struct
+
+import zmq
+import umsgpack
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+from brainer.client import BrainerCommands, broker_addresses
+from brainer.lib.exceptions import RequestTimeoutError
+
+
+class AsyncBrainer(BrainerCommands):
+    """A Brainer client for asyncio applications.
+
+    It has the same operations as `brainer.client.Brainer`, but they
+    return `asyncio.Future` objects instead of blocking. Every request
+    is tagged with an id and sent through a single non-blocking DEALER
+    socket, so any number of coroutines can share one client and have
+    their requests in flight at the same time.
+
+    Usage:
+        >>> client = AsyncBrainer('ipc:///tmp/broker.sock', timeout=1)
+        >>> client.connect()
+        >>> await client.set('mykey', 'myvalue')
+        True
+        >>> await asyncio.wait_for(client.get('mykey'), 0.2)
+        'myvalue'
+
+    Timeouts can be set for the whole client, with `timeout`, or per
+    call with `asyncio.wait_for`, which cancels the request.
+    """
+    _request_id = struct.Struct('>Q')
+
+    def __init__(self, address, context=None, loop=None, timeout=None):
+        """
+        :param address: The broker address, or a list of them.
+        :param context: A `zmq.Context`. Defaults to a new one.
+        :param loop: An asyncio event loop. Defaults to the current one.
+        :param timeout: Seconds to wait for each reply before failing
+        with `RequestTimeoutError`. Defaults to forever.
+        """
+        if asyncio is None:
+            raise RuntimeError('AsyncBrainer requires asyncio.')
+
+        self.address = address
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._timeout = timeout
+        if context is None:
+            context = zmq.Context()
+        self.socket = context.socket(zmq.DEALER)
+        self._futures = {}
+        # Request ids are a random prefix and a counter, so they are
+        # unique across clients as well.
+        self._nonce = os.urandom(8)
+        self._counter = 0
+
+    def connect(self):
+        """Connects to Brainer server and starts reading replies.
+        """
+        for address in broker_addresses(self.address):
+            self.socket.connect(address)
+        self._loop.add_reader(
+            self.socket.getsockopt(zmq.FD), self._on_readable)
+
+    def close(self):
+        """Stops reading replies and closes the socket. Requests still
+        waiting for a reply are cancelled.
+        """
+        self._loop.remove_reader(self.socket.getsockopt(zmq.FD))
+        self.socket.close(linger=0)
+        for future in list(self._futures.values()):
+            future.cancel()
+
+    def pending(self):
+        """Returns how many requests are still waiting for a reply.
+        """
+        return len(self._futures)
+
+    def request(self, message, timeout=None):
+        """Sends a message to the broker.
+
+        :param message: The message.
+        :param timeout: Seconds to wait for the reply. Defaults to the
+        client timeout.
+        :returns: An `asyncio.Future` firing with the reply, or failing
+        with `zmq.Again` if the socket can't take the request right now.
+        """
+        self._counter += 1
+        request_id = self._nonce + self._request_id.pack(self._counter)
+        future = self._futures[request_id] = self._loop.create_future()
+        future.add_done_callback(
+            lambda _: self._futures.pop(request_id, None))
+
+        if timeout is None:
+            timeout = self._timeout
+        if timeout is not None:
+            timer = self._loop.call_later(
+                timeout, self._expire, future, timeout)
+            future.add_done_callback(lambda _: timer.cancel())
+
+        try:
+            self.socket.send_multipart(
+                [request_id, b'', umsgpack.dumps(message)], zmq.NOBLOCK)
+        except zmq.Again as e:
+            # Failing the future forgets it and cancels its timer.
+            future.set_exception(e)
+            return future
+        # The socket FD is edge-triggered and sending can swallow the
+        # edge of a reply that is already there, so look again.
+        self._loop.call_soon(self._on_readable)
+        return future
+
+    def _request(self, message):
+        return self.request(message)
+
+    @staticmethod
+    def _expire(future, timeout):
+        if not future.done():
+            future.set_exception(RequestTimeoutError(timeout))
+
+    def _on_readable(self):
+        """Reads every reply available and fills in their futures.
+        """
+        if self.socket.closed:
+            return
+
+        while self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            request_id, _, reply = self.socket.recv_multipart(zmq.NOBLOCK)
+            future = self._futures.get(request_id)
+            # Replies to cancelled or timed out requests are dropped.
+            if future is not None and not future.done():
+                future.set_result(umsgpack.loads(reply))
@@ -1,15 +1,30 @@
 # -*- coding: utf8 -*-
 import sys
+import time
+from collections import OrderedDict
 
 import umsgpack
 from twisted.python import log
 from twisted.internet import reactor, defer
 
 from brainer.lib.base import BaseREP
-from brainer.lib.hash import ConsistentHash
+from brainer.lib.hash import HashRing, DEFAULT_VNODES, hash64, moved_ranges
 from brainer.lib.mixins import SerializerMixin
-from brainer.lib.exceptions import ZeroNodeError
+from brainer.lib.pubsub import Publisher
+from brainer.lib.events import TOPOLOGY, JOINED, LEFT
+from brainer.lib import quorum
+from brainer.lib.versions import (
+    MAX_BROKER_ID, make_version, version_micros)
+from brainer.lib.exceptions import (
+    ZeroNodeError, QuorumError, ConsistencyLevelError, BackpressureError)
 from brainer.node.client import NodeClient
+from brainer.broker.coalescer import WriteCoalescer
+from brainer.broker.replication import ReplicationQueue, BLOCK, POLICIES
+from brainer.broker.repair import AntiEntropy
+from brainer.broker.peers import BrokerPeers, MEMBERSHIP
+from brainer.broker.monitor import NodeMonitor
+
+WRITE_ACTIONS = ('set', 'remove', 'mset', 'mremove')
 
 
 class Broker(BaseREP, SerializerMixin):
@@ -22,8 +37,59 @@ class Broker(BaseREP, SerializerMixin):
         :param node_manager: A Node Manager. Defaults to `NodeManager`.
         :param serializer: A serializer, defaults to umsgpack.
         :param debug: If True, will log debug messages. Defaults to False.
+        :param vnodes: Virtual nodes per node in the hash ring.
+        Defaults to `brainer.lib.hash.DEFAULT_VNODES`.
+        :param replication: How many nodes hold each key. Defaults to
+        None, which means every node.
+        :param node_hwm: High-water mark of each node connection.
+        Defaults to 0 (no limit).
+        :param coalesce_window: Seconds to gather writes for a node into
+        a single message. Defaults to 0 (every write sent on its own).
+        :param coalesce_size: Most writes gathered into one message.
+        :param queue_size: Writes waiting to be sent to a node, at most.
+        0 disables the replication queues. Defaults to 1000.
+        :param queue_concurrency: Writes waiting on a node, at most.
+        :param queue_retries: How many times a failed write to a node is
+        sent again.
+        :param queue_policy: What to do once a node queue is full:
+        'block' turns the client write away with BACKPRESSURE, 'shed'
+        drops the write to that node (the consistency level still has
+        to be met by the other replicas). Defaults to 'block'.
+        :param repair_interval: Seconds between anti-entropy runs, which
+        compare replicas and repair what differs. Defaults to 60, 0
+        disables them.
+        :param publisher: An address to publish topology changes on, see
+        `publish_topology`, and membership changes for peer brokers.
+        Defaults to None, nothing is published.
+        :param peers: The publisher addresses of other brokers sharing
+        the nodes with this one, see `BrokerPeers`. Requires `publisher`.
+        :param sync_interval: Seconds between full membership
+        publications to the peers. Defaults to 1.
+        :param heartbeat_interval: Seconds between pings to the nodes,
+        to publish the ones not answering as suspected. Only with a
+        `publisher`. Defaults to 5, 0 disables them.
+        :param broker_id: Kept in the low bits of write versions, see
+        `brainer.lib.versions`. Brokers sharing nodes need different
+        ones, from 0 to 255. Defaults to a hash of the publisher
+        address, 0 without one.
         """
         self._init_instance(*args, **kwargs)
+        # Node connections share our ZeroMQ context and IO threads.
+        self._factory = factory
+        if self._publisher_address:
+            self._publisher = Publisher.create(
+                self._publisher_address, factory=factory,
+                serializer=self._serializer)
+            if self._heartbeat_interval:
+                self._monitor = NodeMonitor(self, self._heartbeat_interval)
+                self._monitor.start()
+        if self._peer_addresses:
+            self._peers = BrokerPeers(
+                self, self._peer_addresses, self._sync_interval)
+            self._peers.start()
+        if self._repair_interval:
+            self._repair = AntiEntropy(self, self._repair_interval)
+            self._repair.start()
         log.msg('Broker started!!! Serializer: {}'.format(
             self._serializer.__name__))
 
@@ -32,27 +98,252 @@ class Broker(BaseREP, SerializerMixin):
     def _init_instance(self, *args, **kwargs):
         self._serializer = kwargs.pop('serializer', umsgpack)
         self._debug = kwargs.pop('debug', False)
-        self._publisher_address = kwargs.get(
-            'publisher', 'ipc:///tmp/publisher.sock')
+        self._vnodes = kwargs.pop('vnodes', DEFAULT_VNODES)
+        self._replication = kwargs.pop('replication', None)
+        self._node_hwm = kwargs.pop('node_hwm', 0)
+        self._coalesce_window = kwargs.pop('coalesce_window', 0)
+        self._coalesce_size = kwargs.pop('coalesce_size', 100)
+        self._queue_size = kwargs.pop('queue_size', 1000)
+        self._queue_concurrency = kwargs.pop('queue_concurrency', 100)
+        self._queue_retries = kwargs.pop('queue_retries', 3)
+        self._queue_policy = kwargs.pop('queue_policy', BLOCK)
+        self._repair_interval = kwargs.pop('repair_interval', 60)
+        self._repair = None
+        if self._queue_policy not in POLICIES:
+            raise ValueError(
+                'queue_policy must be one of {}.'.format(', '.join(POLICIES)))
+        self._factory = None
+        self._publisher_address = kwargs.pop('publisher', None)
+        self._peer_addresses = kwargs.pop('peers', ())
+        self._sync_interval = kwargs.pop('sync_interval', 1)
+        self._heartbeat_interval = kwargs.pop('heartbeat_interval', 5)
+        self._monitor = None
+        if self._peer_addresses and not self._publisher_address:
+            raise ValueError('Brokers with peers need a publisher address.')
+        self._broker_id = kwargs.pop('broker_id', None)
+        if self._broker_id is None:
+            self._broker_id = (
+                hash64(self._publisher_address) & MAX_BROKER_ID
+                if self._publisher_address else 0)
+        if not 0 <= self._broker_id <= MAX_BROKER_ID:
+            raise ValueError('broker_id must be between 0 and {}.'.format(
+                MAX_BROKER_ID))
+        self._publisher = None
+        self._peers = None
 
         # A list of node-ids, the index is the node_number
         self._nodes = []
         # Key: Value = node-id: connection obj
         self._nodes_connections = {}
+        # Key: Value = node-id: address the node is listening on
+        self._nodes_addresses = {}
+        # Key: Value = node-id: [address, changed, registered], shared
+        # with peer brokers. `changed` is a write version (see
+        # `next_version`), the latest change of a node wins. Nodes that
+        # unregistered are kept, so an older change doesn't bring them
+        # back.
+        self._members = {}
+        # The hash ring for the current membership. Only rebuilt when
+        # nodes register or unregister, never per request.
+        self._ring = None
+        # Bumped on every membership change. Clients routing by
+        # themselves use it to know their ring is stale.
+        self._topology_version = 0
+        # Last version given to a write. See `next_version`.
+        self._version = 0
         self._allowed_actions = (
             'register', 'unregister', 'ping',
-            'route', 'set', 'get', 'remove')
+            'route', 'set', 'get', 'remove', 'mset', 'mget', 'mremove',
+            'topology', 'stats')
 
     def register_node(self, node_id, address):
         """
-        :param node_id: The node id sent down by the Node.
+        :param node_id: The node id sent down by the Node. A node
+        registering again (e.g. after a restart) replaces its previous
+        connection.
         """
-        self._nodes.append(node_id)
-        node_number = self._nodes.index(node_id)
+        rejoined = node_id in self._nodes
+        node_number = self._connect_node(node_id, address)
+        self._members[node_id] = [address, self.next_version(), True]
+        self.update_ring()
+        if rejoined:
+            # The ring is the same, but the node may have missed writes.
+            others = [other for other in self._nodes if other != node_id]
+            if others:
+                self.transfer(
+                    HashRing(others, vnodes=self._vnodes), self._ring,
+                    catch_up=True, only=node_id)
+        self.publish_members([node_id])
+        self.publish_topology(JOINED, node_id)
+        return node_number
 
-        node_connection = NodeClient.create(address)
+    def _connect_node(self, node_id, address):
+        """Opens a connection to a node, replacing any previous one.
+
+        :returns: The node number.
+        """
+        if node_id in self._nodes:
+            self.clean_connection(node_id)
+        else:
+            self._nodes.append(node_id)
+
+        node_connection = NodeClient.create(
+            address, factory=self._factory, high_water_mark=self._node_hwm)
+        if self._coalesce_window:
+            node_connection = WriteCoalescer(
+                node_connection, self._coalesce_window, self._coalesce_size)
+        if self._queue_size:
+            node_connection = ReplicationQueue(
+                node_connection, max_size=self._queue_size,
+                concurrency=self._queue_concurrency,
+                retries=self._queue_retries)
         self._nodes_connections[node_id] = node_connection
-        return node_number
+        self._nodes_addresses[node_id] = address
+        return self._nodes.index(node_id)
+
+    def update_ring(self, transfer=True, version=0):
+        """Rebuilds the hash ring from the current list of nodes.
+        Must be called whenever the membership changes.
+
+        It also bumps the topology version and tells every node about
+        it, so nodes can turn away clients routing with an older ring.
+        Then nodes that became replicas of some keys copy them, see
+        `transfer`.
+
+        :param transfer: Whether to tell nodes to copy keys. Only the
+        broker a node (un)registered with does, see `merge_members`.
+        :param version: The topology version of a peer broker, taken if
+        greater than ours, so brokers agree on it.
+        """
+        old_ring = self._ring
+        if not self._nodes:
+            self._ring = None
+        else:
+            self._ring = HashRing(self._nodes, vnodes=self._vnodes)
+
+        self.set_topology_version(max(self._topology_version + 1, version))
+
+        if transfer and old_ring is not None and self._ring is not None:
+            self.transfer(old_ring, self._ring)
+
+    def set_topology_version(self, version):
+        """Sets the topology version and tells every node about it.
+        """
+        self._topology_version = version
+        for connection in self._nodes_connections.values():
+            d = connection.topology(self._topology_version)
+            d.addErrback(lambda f: None)  # NodeClient logs it already.
+
+    def publish_topology(self, event=None, node_id=None):
+        """Publishes the topology (see `get_topology`) under the
+        `TOPOLOGY` tag, so clients and nodes routing keys by themselves
+        don't have to poll for it. See `TopologySubscriber`.
+
+        :param event: What happened: `JOINED`, `LEFT`, `SUSPECTED` or
+        `RECOVERED`. None when only the topology version changed.
+        :param node_id: The node it happened to.
+        """
+        if self._publisher is None:
+            return
+
+        self._publisher.send_message(TOPOLOGY, {
+            'event': event, 'node_id': node_id,
+            'topology': self.get_topology()})
+
+    def publish_members(self, node_ids=None):
+        """Publishes the membership to peer brokers, see `BrokerPeers`.
+
+        :param node_ids: The nodes that changed. Defaults to all.
+        """
+        if self._publisher is None:
+            return
+
+        if node_ids is None:
+            node_ids = self._members.keys()
+        self._publisher.send_message(MEMBERSHIP, {
+            'topology': self._topology_version,
+            'members': [[node_id] + self._members[node_id]
+                        for node_id in node_ids]})
+
+    def merge_members(self, members, version=0):
+        """Applies the membership published by a peer broker. Nodes
+        changed later than we knew of are connected to or dropped, and
+        the ring is rebuilt and the changes published, see
+        `publish_topology`. Nodes are not told to copy keys, the broker
+        they (un)registered with did already.
+
+        :param members: A list of [node_id, address, changed, registered].
+        :param version: The topology version of the peer.
+        :returns: True if the membership changed.
+        """
+        events = []
+        for node_id, address, stamp, registered in members:
+            current = self._members.get(node_id)
+            if current is not None and current[1] >= stamp:
+                continue
+
+            self._members[node_id] = [address, stamp, registered]
+            self._version = max(self._version, stamp)
+            if registered and (node_id not in self._nodes or
+                               self._nodes_addresses[node_id] != address):
+                self._connect_node(node_id, address)
+                events.append((JOINED, node_id))
+            elif not registered and node_id in self._nodes:
+                self.clean_connection(node_id)
+                self._nodes.remove(node_id)
+                events.append((LEFT, node_id))
+
+        if events:
+            self.update_ring(transfer=False, version=version)
+        elif version > self._topology_version:
+            self.set_topology_version(version)
+            self.publish_topology()
+        for event, node_id in events:
+            self.publish_topology(event, node_id)
+        return bool(events)
+
+    def transfer(self, old_ring, new_ring, catch_up=False, only=None):
+        """Tells nodes to copy the hash ranges they became replicas of
+        when the ring went from `old_ring` to `new_ring`. Each range is
+        copied from one of its previous owners, so a joining node only
+        gets its share of the data, from every other node in parallel.
+
+        :param old_ring: The previous `HashRing`.
+        :param new_ring: The current `HashRing`.
+        :param catch_up: Tell nodes they held these ranges before, they
+        only need the writes they missed.
+        :param only: Only tell this node id.
+        :returns: See `brainer.lib.hash.moved_ranges`.
+        """
+        moves = moved_ranges(old_ring, new_ring, self.get_replication())
+        for node_id, sources in moves.iteritems():
+            if only is not None and node_id != only:
+                continue
+
+            connection = self._nodes_connections.get(node_id)
+            if connection is None:
+                continue
+
+            if self._debug:
+                log.msg('Node {} copies {} ranges from {}.'.format(
+                    node_id, sum(len(ranges) for ranges in sources.values()),
+                    ', '.join(sources)))
+            d = connection.pull(
+                [[source, self._nodes_addresses[source], ranges]
+                 for source, ranges in sources.iteritems()],
+                catch_up)
+            d.addErrback(lambda f: None)  # NodeClient logs it already.
+        return moves
+
+    def get_topology(self):
+        """Returns what a client needs to route keys by itself.
+        """
+        return {
+            'version': self._topology_version,
+            'nodes': [[node_id, self._nodes_addresses.get(node_id)]
+                      for node_id in self._nodes],
+            'vnodes': self._vnodes,
+            'replication': self.get_replication()}
 
     def clean_connection(self, node_id):
         """Shutdown the connection and remove any reference
@@ -66,6 +357,21 @@ class Broker(BaseREP, SerializerMixin):
         connection = self._nodes_connections[node_id]
         connection.shutdown()
         del self._nodes_connections[node_id]
+        self._nodes_addresses.pop(node_id, None)
+
+    def check_backpressure(self, connections):
+        """Raises `BackpressureError` if the policy is 'block' and any of
+        the node connections can't take more writes.
+
+        :param connections: Node connections about to get a write.
+        """
+        if self._queue_policy != BLOCK:
+            return
+
+        for connection in connections:
+            if isinstance(connection, ReplicationQueue) and connection.full():
+                raise BackpressureError(
+                    'A replica is too far behind, try again later.')
 
     def unregister_node(self, node_id):
         """Entry-point for unregistering a node.
@@ -76,6 +382,11 @@ class Broker(BaseREP, SerializerMixin):
         self.clean_connection(node_id)
         if node_id in self._nodes:
             self._nodes.remove(node_id)
+            self.update_ring()
+        if node_id in self._members:
+            self._members[node_id] = [None, self.next_version(), False]
+            self.publish_members([node_id])
+            self.publish_topology(LEFT, node_id)
 
     def get_node_by_key(self, key):
         """Gets the right machine based on the ky.
@@ -84,17 +395,84 @@ class Broker(BaseREP, SerializerMixin):
         node that key should go.
         :returns: A `brainer.node.client.NodeClient` object.
         """
-        if not self._nodes:
+        if self._ring is None:
             raise ZeroNodeError
 
-        hashing = ConsistentHash(len(self._nodes))
-        node_number = hashing.get_machine(key)
-        node_id = self._nodes[node_number]
+        node_id = self._ring.get_node(key)
         if self._debug:
-            log.msg('Machine {} ({}) picked for key {}'.format(
-                node_id, node_number, key))
+            log.msg('Machine {} picked for key {}'.format(node_id, key))
         return self._nodes_connections[node_id]
 
+    def get_replication(self, message=None):
+        """Returns how many nodes should hold a key. A request can ask
+        for its own replication factor with the 'replication' field,
+        otherwise the broker one is used.
+
+        Replicas are on different machines, so there are at most as
+        many as node groups (see `brainer.lib.hash.group_of`).
+
+        :param message: The message itself (optional).
+        """
+        replication = self._replication
+        if message is not None:
+            replication = message.get('replication', replication)
+
+        groups = len(self._ring.groups) if self._ring is not None else 0
+        if replication is None or replication > groups:
+            return groups
+        return max(replication, 1)
+
+    def is_fully_replicated(self):
+        """True when every node holds every key.
+        """
+        return self.get_replication() == len(self._nodes)
+
+    def get_nodes_by_key(self, key, replication=None):
+        """Gets the nodes holding a key: the main node picked by the
+        hashing and its successors in the ring.
+
+        :param key: The key.
+        :param replication: How many nodes. Defaults to the broker
+        replication factor.
+        :returns: A list of `brainer.node.client.NodeClient` objects,
+        main node first.
+        """
+        if self._ring is None:
+            raise ZeroNodeError
+
+        if replication is None:
+            replication = self.get_replication()
+
+        node_ids = self._ring.get_replicas(key, replication)
+        if self._debug:
+            log.msg('Machines {} picked for key {}'.format(node_ids, key))
+        return [self._nodes_connections[node_id] for node_id in node_ids]
+
+    def next_version(self):
+        """Returns a version for a new write: the current time in
+        microseconds and our broker id (see `brainer.lib.versions`),
+        always greater than the previous one, ours or a peer's. Nodes
+        keep the highest version they have seen for each key.
+        """
+        micros = max(
+            int(time.time() * 1000000), version_micros(self._version) + 1)
+        self._version = make_version(micros, self._broker_id)
+        return self._version
+
+    def group_keys_by_node(self, keys):
+        """Maps many keys to their nodes with a single ring lookup.
+
+        :param keys: A list of keys.
+        :returns: A dict of node-id: list of keys owned by that node.
+        """
+        if self._ring is None:
+            raise ZeroNodeError
+
+        groups = {}
+        for key, node_id in zip(keys, self._ring.get_nodes(keys)):
+            groups.setdefault(node_id, []).append(key)
+        return groups
+
     def gotMessage(self, message_id, *messageParts):
         """Any message received is processed here.
 
@@ -133,26 +511,39 @@ class Broker(BaseREP, SerializerMixin):
         :param method: The method that the client requested.
         :param message_id: The request message id.
         """
+        if f.check(ZeroNodeError):
+            self.reply_error(
+                message_id, "ZERO_NODES", "There are no nodes registered.")
+            return
+        elif f.check(QuorumError):
+            self.reply_error(
+                message_id, "QUORUM_FAILED", f.getErrorMessage())
+            return
+        elif f.check(BackpressureError):
+            self.reply_error(
+                message_id, "BACKPRESSURE", f.getErrorMessage())
+            return
+        elif f.check(ConsistencyLevelError):
+            self.reply_error(
+                message_id, "INVALID_LEVEL",
+                "Consistency level must be one of {} or an integer.".format(
+                    ', '.join(quorum.LEVELS)))
+            return
+
         log.err(f, "Method {} failed.".format(method))
         self.reply_error(message_id, "UNKNOWN_ERROR", "Verify server log")
 
     def register(self, message_id, message):
         """Registers a node and kick of the process of
-        creating connections.
+        creating connections. The node is then told which ranges to
+        copy from other nodes, see `transfer`.
 
         :param message_id: The message id (generated by ZeroMQ)
         :param message: The message itself.
         """
         server_id, address = message['id'], message['address']
         self.register_node(server_id, address)
-        is_first = len(self._nodes_connections) == 1
-        if not is_first:
-            d = self.snapshot(server_id)
-        else:
-            d = defer.succeed(None)
-
-        d.addCallback(lambda snapshot: self.reply(
-            message_id, {"action": "register", "snapshot": snapshot}))
+        self.reply(message_id, {"action": "register"})
 
     def unregister(self, message_id, message):
         """Unregisters a node and kicks off the process of
@@ -168,57 +559,54 @@ class Broker(BaseREP, SerializerMixin):
         self.unregister_node(node_id)
         self.reply(message_id, {"action": "unregister", "unregistered": True})
 
-    def snapshot(self, requester_id):
-        """Requests a snapshot from any other node that is not the requester.
+    def topology(self, message_id, message):
+        """Replies the current nodes, their addresses and the ring
+        settings, along with the topology version.
 
-        :param requester_id: A server id to filter out.
+        :param message_id: The message id (generated by ZeroMQ)
+        :param message: The message itself.
         """
-        node = None
-        for server_id, connection in self._nodes_connections.items():
-            if server_id != requester_id:
-                node = connection
-                break
-
-        return node.snapshot()
-
-    def batch(self, main_node, wait_all, method, *args, **kwargs):
-        """Performs an operation in every node. Used for write operations.
-
-        :param main_node: The main node connection picked by the
-        hashing method.
-        :param wait_all: If True, the deferred will fire only when all
-        nodes have replied to the write. If False, it fires immediately
-        after the main node replies the write.
+        reply = self.get_topology()
+        reply['action'] = 'topology'
+        self.reply(message_id, reply)
+
+    def batch(self, nodes, level, method, *args, **kwargs):
+        """Performs an operation in a list of nodes. Used for write
+        operations.
+
+        :param nodes: The node connections holding the key, as returned
+        by `get_nodes_by_key`. The first one is the main node picked
+        by the hashing method.
+        :param level: The write consistency level. The deferred fires
+        with the list of replies as soon as enough nodes have replied
+        (see `brainer.lib.quorum.required`).
         :param method: A method to call in every node connection.
         E.g.: 'set'
         """
-        func = getattr(main_node, method)
-        main_defer = func(*args, **kwargs)
-        dlist = [main_defer]
-
-        for server_id, connection in self._nodes_connections.items():
-            if connection == main_node:
-                continue
-
-            func = getattr(connection, method)
-            d = func(*args, **kwargs)
-            if wait_all:
-                dlist.append(d)
-
-        d = defer.DeferredList(dlist)
-        return d
+        needed = quorum.required(level, len(nodes))
+        if method in WRITE_ACTIONS:
+            self.check_backpressure(nodes)
+        dlist = [getattr(connection, method)(*args, **kwargs)
+                 for connection in nodes]
+        return quorum.gather(dlist, needed)
 
     def set(self, message_id, message):
         """Sets a key-value pair in the nodes.
 
+        The key is written to as many nodes as the replication factor
+        says (every node by default). A request can pick its own with
+        the 'replication' field in the message.
+
         The set is tunable per-query. You can pick speed or consistency.
-        This is defined by the parameter 'wait_all' in the message.
-        If set to True, we only reply to the customer after all nodes
-        get the data. On False, we reply as soon as the main node get
-        the data (defined by the hashing).
+        This is defined by the parameter 'w' in the message: 'one',
+        'quorum', 'all' or how many replicas must acknowledge the write
+        before we reply to the customer.
 
-        It currently defaults to True (consistency). So in the case a
-        node goes down, it's harder to lose data, by default.
+        Without 'w', the older 'wait_all' parameter is used. If set to
+        True (the default), we only reply to the customer after all
+        replicas get the data. On False, we reply as soon as one of
+        them has it. So in the case a node goes down, it's harder to
+        lose data, by default.
 
         :param message_id: The message id (generated by ZeroMQ)
         :param message: The message itself.
@@ -229,17 +617,40 @@ class Broker(BaseREP, SerializerMixin):
         """Get a value based on a key.
 
         We will consult the right node based on the key (determined
-        by hashing). But in case a node goes down, all other nodes
-        should have the same data (see `set` documentation).
+        by hashing). But in case a node goes down, its successors in the
+        ring should have the same data (see `set` documentation).
+
+        The read is tunable per-query with the parameter 'r' in the
+        message, like 'w' for `set`. It defaults to 'one', which only
+        asks the main node. Otherwise every replica is asked, we reply
+        as soon as 'r' of them answered, with the most recent version.
 
         :param message_id: The message id (generated by ZeroMQ)
         :param message: The message itself.
         """
-        node = self.get_node_by_key(message['key'])
-        d = node.get(message)
+        level = message.get('r', quorum.ONE)
+        if level in (quorum.ONE, 1):
+            node = self.get_node_by_key(message['key'])
+            d = node.get(message)
+        else:
+            nodes = self.get_nodes_by_key(
+                message['key'], self.get_replication(message))
+            request = dict(message, versioned=True)
+            d = self.batch(nodes, level, 'get', request)
+            d.addCallback(self.resolve_versions)
+
         d.addCallback(lambda reply: self.reply(message_id, reply))
         return d
 
+    @staticmethod
+    def resolve_versions(replies):
+        """Picks the most recent value out of versioned replies.
+
+        :param replies: A list of [value, version] pairs.
+        """
+        value, _ = max(replies, key=lambda reply: reply[1])
+        return value
+
     def remove(self, message_id, message):
         """Removes a key.
 
@@ -257,18 +668,219 @@ class Broker(BaseREP, SerializerMixin):
         :param message_id: The message id (generated by ZeroMQ)
         :param message: The message itself.
         """
-        main_node = self.get_node_by_key(message['key'])
-        wait_all = message.get('wait_all', True)
-        d = self.batch(main_node, wait_all, action, message)
+        nodes = self.get_nodes_by_key(
+            message['key'], self.get_replication(message))
+        level = self.get_write_level(message)
+        message['version'] = self.next_version()
+        d = self.batch(nodes, level, action, message)
         d.addCallback(
-            lambda replies: self.reply(message_id, replies[0][1]))
+            lambda replies: self.reply(message_id, replies[0]))
+
+        return d
+
+    @staticmethod
+    def get_write_level(message):
+        """Returns the write consistency level of a message: 'w' if
+        present, otherwise what the older 'wait_all' flag means.
+
+        :param message: The message itself.
+        """
+        level = message.get('w')
+        if level is None:
+            level = quorum.ALL if message.get('wait_all', True) else quorum.ONE
+        return level
+
+    def mset(self, message_id, message):
+        """Sets many key-value pairs at once. Keys are grouped by node
+        so every node gets a single message with all its keys.
+
+        Supports 'replication', 'w' and 'wait_all' like `set`. We reply
+        a dict of key: reply once every key has enough acknowledgements.
+
+        :param message_id: The message id (generated by ZeroMQ)
+        :param message: The message itself. 'items' is a dict of
+        key: value. 'expires' optionally sets how many seconds they live.
+        """
+        items, version = message['items'], self.next_version()
+        expires = message.get('expires')
+
+        def request(keys):
+            request = {
+                'action': 'mset', 'version': version,
+                'items': dict((key, items[key]) for key in keys)}
+            if expires:
+                request['expires'] = expires
+            return request
+
+        d = self.multi(
+            'mset', items.keys(), self.get_replication(message),
+            self.get_write_level(message), request)
+        d.addCallback(lambda replies: self.reply(message_id, dict(
+            (key, key_replies[0])
+            for key, key_replies in replies.iteritems())))
+        return d
+
+    def mremove(self, message_id, message):
+        """Removes many keys at once. See `mset`.
+
+        :param message_id: The message id (generated by ZeroMQ)
+        :param message: The message itself. 'keys' is a list of keys.
+        """
+        version = self.next_version()
+
+        def request(keys):
+            return {'action': 'mremove', 'keys': keys, 'version': version}
+
+        d = self.multi(
+            'mremove', message['keys'], self.get_replication(message),
+            self.get_write_level(message), request)
+        d.addCallback(lambda replies: self.reply(message_id, dict(
+            (key, key_replies[0])
+            for key, key_replies in replies.iteritems())))
+        return d
+
+    def mget(self, message_id, message):
+        """Gets many keys at once. Keys are grouped by node so every
+        node gets a single message with all its keys.
+
+        Supports 'r' like `get`. We reply a dict of key: value.
+
+        :param message_id: The message id (generated by ZeroMQ)
+        :param message: The message itself. 'keys' is a list of keys.
+        """
+        level = message.get('r', quorum.ONE)
+        if level in (quorum.ONE, 1):
+            replication, versioned = 1, False
+        else:
+            replication, versioned = self.get_replication(message), True
+
+        def request(keys):
+            return {'action': 'mget', 'keys': keys, 'versioned': versioned}
+
+        def resolve(replies):
+            if versioned:
+                return dict(
+                    (key, self.resolve_versions(key_replies))
+                    for key, key_replies in replies.iteritems())
+            return dict(
+                (key, key_replies[0])
+                for key, key_replies in replies.iteritems())
+
+        d = self.multi('mget', message['keys'], replication, level, request)
+        d.addCallback(resolve)
+        d.addCallback(lambda reply: self.reply(message_id, reply))
+        return d
+
+    def multi(self, method, keys, replication, level, request):
+        """Performs a multi-key operation. Every node holding some of
+        the keys gets one message with all of them.
+
+        :param method: The `NodeClient` method to call. E.g.: 'mset'
+        :param keys: The keys.
+        :param replication: How many replicas of each key to reach.
+        :param level: The consistency level, checked for every key.
+        :param request: A function returning the message for a node
+        out of the list of keys it holds.
+        :returns: A deferred firing with a dict of key: list of node
+        replies for that key, or failing if any key misses its level.
+        """
+        if self._ring is None:
+            raise ZeroNodeError
 
+        keys = list(OrderedDict.fromkeys(keys))
+        needed = quorum.required(level, replication)
+        replicas = self._ring.get_replicas_many(keys, replication)
+
+        groups = {}
+        for key, node_ids in zip(keys, replicas):
+            for node_id in node_ids:
+                groups.setdefault(node_id, []).append(key)
+
+        if method in WRITE_ACTIONS:
+            self.check_backpressure(
+                [self._nodes_connections[node_id] for node_id in groups])
+
+        replies = {}
+        for node_id, node_keys in groups.iteritems():
+            connection = self._nodes_connections[node_id]
+            d = getattr(connection, method)(request(node_keys))
+            for key, key_d in self._split_reply(d, node_keys).iteritems():
+                replies.setdefault(key, []).append(key_d)
+
+        dlist = []
+        for key, node_ids in zip(keys, replicas):
+            d = quorum.gather(replies[key], min(needed, len(node_ids)))
+            d.addCallback(lambda key_replies, key=key: (key, key_replies))
+            dlist.append(d)
+
+        d = defer.gatherResults(dlist, consumeErrors=True)
+        d.addCallbacks(dict, lambda f: f.value.subFailure)
+        return d
+
+    def stats(self, message_id, message):
+        """Replies with the counters of every node, as a dict of node-id:
+        counters. These are the replication queue ones (see
+        `ReplicationQueue.stats`), plus the node cache ones under 'cache'
+        (see `BoundedCache.stats`), left out if the node doesn't reply.
+
+        :param message_id: The message id (generated by ZeroMQ)
+        :param message: The message itself.
+        """
+        dlist = []
+        for node_id, connection in self._nodes_connections.iteritems():
+            counters = {}
+            if isinstance(connection, ReplicationQueue):
+                counters = connection.stats()
+            d = connection.cache_stats()
+            d.addCallbacks(
+                lambda cache, counters=counters: dict(counters, cache=cache),
+                lambda f, counters=counters: counters)
+            d.addCallback(lambda stats, node_id=node_id: (node_id, stats))
+            dlist.append(d)
+
+        d = defer.gatherResults(dlist)
+        d.addCallback(lambda stats: self.reply(message_id, dict(stats)))
         return d
 
+    @staticmethod
+    def _split_reply(d, keys):
+        """Splits the deferred of a multi-key node reply into one
+        deferred per key.
+
+        :param d: A deferred firing with a dict of key: reply.
+        :param keys: The keys sent to the node.
+        :returns: A dict of key: deferred.
+        """
+        deferreds = dict((key, defer.Deferred()) for key in keys)
+
+        def split(reply):
+            for key, key_d in deferreds.iteritems():
+                key_d.callback(reply.get(key))
+
+        def fail(f):
+            for key_d in deferreds.itervalues():
+                key_d.errback(f)
+
+        d.addCallbacks(split, fail)
+        return deferreds
+
 
-def run_broker(host, debug=False):
+def run_broker(host, debug=False, vnodes=DEFAULT_VNODES, replication=None,
+               io_threads=1, node_hwm=0, coalesce_window=0,
+               coalesce_size=100, queue_size=1000, queue_concurrency=100,
+               queue_retries=3, queue_policy=BLOCK, repair_interval=60,
+               publisher=None, peers=(), sync_interval=1,
+               heartbeat_interval=5, broker_id=None):
     log.startLogging(sys.stdout)
-    Broker.create(host, debug=debug)
+    Broker.create(
+        host, debug=debug, vnodes=vnodes, replication=replication,
+        io_threads=io_threads, node_hwm=node_hwm,
+        coalesce_window=coalesce_window, coalesce_size=coalesce_size,
+        queue_size=queue_size, queue_concurrency=queue_concurrency,
+        queue_retries=queue_retries, queue_policy=queue_policy,
+        repair_interval=repair_interval, publisher=publisher, peers=peers,
+        sync_interval=sync_interval, heartbeat_interval=heartbeat_interval,
+        broker_id=broker_id)
     reactor.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+from twisted.internet import reactor, defer
+
+WRITE_ACTIONS = ('set', 'remove', 'mset', 'mremove')
+
+
+class WriteCoalescer(object):
+    """Wraps a `NodeClient` and coalesces writes. Writes sent within
+    `window` seconds of each other, up to `max_size` of them, travel to
+    the node in a single 'apply' message. Every write still gets its
+    own deferred, fired with the node reply for that write.
+
+    Anything else (gets, snapshots...) goes straight to the connection.
+    """
+    def __init__(self, connection, window=0.001, max_size=100,
+                 clock=reactor):
+        """
+        :param connection: A `brainer.node.client.NodeClient`.
+        :param window: Seconds to wait for more writes before sending.
+        :param max_size: Writes per message. Reaching it sends right away.
+        :param clock: Something providing callLater. Defaults to reactor.
+        """
+        self._connection = connection
+        self._window = window
+        self._max_size = max_size
+        self._clock = clock
+        self._pending = []
+        self._call = None
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __len__(self):
+        """Returns how many writes are waiting to be sent.
+        """
+        return len(self._pending)
+
+    def _enqueue(self, message):
+        d = defer.Deferred()
+        self._pending.append((message, d))
+        if len(self._pending) >= self._max_size:
+            self.flush()
+        elif self._call is None:
+            self._call = self._clock.callLater(self._window, self.flush)
+        return d
+
+    def set(self, message):
+        return self._enqueue(message)
+
+    def remove(self, message):
+        return self._enqueue(message)
+
+    def mset(self, message):
+        return self._enqueue(message)
+
+    def mremove(self, message):
+        return self._enqueue(message)
+
+    def flush(self):
+        """Sends every pending write in one message.
+        """
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        d = self._connection.sendMsg(
+            {'action': 'apply', 'ops': [message for message, _ in pending]})
+
+        def dispatch(replies):
+            for (_, write_d), reply in zip(pending, replies):
+                write_d.callback(reply)
+
+        def fail(f):
+            for _, write_d in pending:
+                write_d.errback(f)
+
+        d.addCallbacks(dispatch, fail)
+
+    def shutdown(self):
+        """Fails the writes not sent yet and shuts the connection down.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        pending, self._pending = self._pending, []
+        for _, d in pending:
+            d.errback(defer.CancelledError('Node connection shut down.'))
+        self._connection.shutdown()
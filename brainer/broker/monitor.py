@@ -0,0 +1,58 @@
+# -*- coding: utf8 -*-
+from twisted.internet import reactor, task
+
+from brainer.lib.events import SUSPECTED, RECOVERED
+
+
+class NodeMonitor(object):
+    """Pings every node in turns. A node that doesn't answer (within the
+    node connection timeout) is published as suspected, and as recovered
+    once it answers again, see `Broker.publish_topology`.
+
+    Suspected nodes are not taken out of the ring: they may only be
+    slow, and they leave it when they unregister.
+    """
+    def __init__(self, broker, interval=5, clock=reactor):
+        """
+        :param broker: The `Broker`, to get nodes from and publish on.
+        :param interval: Seconds between pings.
+        :param clock: Something providing callLater. Defaults to reactor.
+        """
+        self._broker = broker
+        self._interval = interval
+        self._loop = task.LoopingCall(self.run)
+        self._loop.clock = clock
+        self.suspected = set()
+
+    def start(self):
+        self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def run(self):
+        """Pings every node.
+        """
+        self.suspected &= set(self._broker._nodes_connections)
+        for node_id, connection in self._broker._nodes_connections.items():
+            d = connection.ping()
+            d.addCallbacks(
+                self._answered, self._missed,
+                callbackArgs=(node_id, connection),
+                errbackArgs=(node_id, connection))
+
+    def _current(self, node_id, connection):
+        # The node may have left, or registered again, meanwhile.
+        return self._broker._nodes_connections.get(node_id) is connection
+
+    def _answered(self, reply, node_id, connection):
+        if node_id in self.suspected and self._current(node_id, connection):
+            self.suspected.discard(node_id)
+            self._broker.publish_topology(RECOVERED, node_id)
+
+    def _missed(self, f, node_id, connection):
+        if node_id not in self.suspected and self._current(
+                node_id, connection):
+            self.suspected.add(node_id)
+            self._broker.publish_topology(SUSPECTED, node_id)
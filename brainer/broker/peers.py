@@ -0,0 +1,53 @@
+# -*- coding: utf8 -*-
+from twisted.internet import reactor, task
+
+from brainer.lib.pubsub import Subscriber
+
+# The tag membership messages are published under.
+MEMBERSHIP = 'membership'
+
+
+class BrokerPeers(object):
+    """Keeps the membership of brokers running side by side in sync.
+
+    Every broker publishes the nodes registering and unregistering with
+    it (see `Broker.publish_members`), and subscribes to the publishers
+    of its peers. Each broker keeps its own connections to the nodes.
+
+    Members carry the time they last changed, and the latest change
+    wins, so brokers agree whatever order changes reach them in. The
+    whole membership is also published every `interval` seconds, so a
+    broker starting late or missing messages catches up.
+    """
+    def __init__(self, broker, addresses, interval=1, clock=reactor,
+                 subscriber_class=Subscriber):
+        """
+        :param broker: The `Broker`.
+        :param addresses: The publisher addresses of the other brokers.
+        :param interval: Seconds between full membership publications.
+        :param clock: Something providing callLater. Defaults to reactor.
+        """
+        self._broker = broker
+        self._interval = interval
+        self._subscriber = subscriber_class.create(
+            addresses, [MEMBERSHIP], self.received, factory=broker._factory)
+        self._loop = task.LoopingCall(self.sync)
+        self._loop.clock = clock
+
+    def start(self):
+        self._loop.start(self._interval, now=True)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+        self._subscriber.shutdown()
+
+    def sync(self):
+        """Publishes the whole membership.
+        """
+        self._broker.publish_members()
+
+    def received(self, tag, message):
+        """Merges the membership published by a peer.
+        """
+        self._broker.merge_members(message['members'], message['topology'])
@@ -0,0 +1,152 @@
+# -*- coding: utf8 -*-
+from itertools import combinations
+
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+
+from brainer.lib.hash import shared_ranges
+from brainer.lib.merkle import DEFAULT_DEPTH
+
+
+class AntiEntropy(object):
+    """Background repair of diverged replicas.
+
+    Every run compares the Merkle trees of a pair of nodes, top-down,
+    only going into the subtrees that differ. Without full replication,
+    the trees only cover the hash ranges both nodes are replicas of:
+    nodes keep them up to date as keys change, from the first time they
+    are asked for (see `brainer.lib.merkle.MerkleTree.view`). The keys of the leaves
+    that differ are then exchanged, and each node keeps the latest
+    version of every key. Pairs are visited in turns, one per run.
+
+    Removes leave tombstones carrying their version (see
+    `brainer.lib.cache.Tombstones`), exchanged like keys, so a key
+    removed from one replica only is removed from the other as well.
+    Tombstones are dropped after a grace period: a replica still
+    holding the key by then brings it back. Bounded caches only take
+    the keys they hold (see `brainer.lib.cache.BoundedCache.merge`), so
+    leaves holding keys one of them evicted keep differing, and are
+    exchanged again on every run.
+    """
+    def __init__(self, broker, interval=60, depth=DEFAULT_DEPTH,
+                 clock=reactor):
+        """
+        :param broker: The `Broker`, to get nodes and the ring from.
+        :param interval: Seconds between runs.
+        :param depth: The depth of the node Merkle trees.
+        :param clock: Something providing callLater. Defaults to reactor.
+        """
+        self._broker = broker
+        self._interval = interval
+        self._depth = depth
+        self._turn = 0
+        self._running = False
+        self._loop = task.LoopingCall(self.run)
+        self._loop.clock = clock
+        # How many leaves had to be repaired so far.
+        self.repaired = 0
+
+    def start(self):
+        self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def pairs(self):
+        """Returns the pairs of nodes to compare. When every node holds
+        every key, comparing all of them with the first one is enough.
+        """
+        nodes = self._broker._nodes
+        if len(nodes) < 2:
+            return []
+        elif self._broker.is_fully_replicated():
+            return [(nodes[0], node_id) for node_id in nodes[1:]]
+        return list(combinations(nodes, 2))
+
+    def run(self):
+        """Repairs the next pair of nodes. Does nothing while a repair
+        is still going on.
+        """
+        pairs = self.pairs()
+        if self._running or not pairs:
+            return
+
+        first, second = pairs[self._turn % len(pairs)]
+        self._turn += 1
+        self._running = True
+
+        def done(result):
+            self._running = False
+            return result
+
+        d = self.repair(first, second)
+        d.addErrback(log.err, 'Repairing {} and {} failed.'.format(
+            first, second))
+        d.addBoth(done)
+        return d
+
+    def repair(self, first, second):
+        """Makes two nodes agree on the keys they share.
+
+        :param first: A node id.
+        :param second: Another node id.
+        :returns: A deferred firing with how many leaves differed.
+        """
+        connections = self._broker._nodes_connections
+        nodes = [connections[first], connections[second]]
+
+        ranges = None
+        if not self._broker.is_fully_replicated():
+            ranges = shared_ranges(
+                self._broker._ring, self._broker.get_replication(),
+                [first, second])
+            if not ranges:
+                return defer.succeed(0)
+
+        return self._compare(nodes, ranges, 0, [0])
+
+    def _compare(self, nodes, ranges, level, indexes):
+        d = defer.gatherResults(
+            [node.merkle(level, indexes, ranges) for node in nodes],
+            consumeErrors=True)
+
+        def descend(digests):
+            if indexes is None:
+                compared = range(len(digests[0]))
+            else:
+                compared = indexes
+            differ = [index for index, one, other
+                      in zip(compared, digests[0], digests[1])
+                      if one != other]
+
+            if not differ:
+                return 0
+            elif level == self._depth:
+                return self._exchange(nodes, ranges, differ)
+
+            children = []
+            for index in differ:
+                children.extend((2 * index, 2 * index + 1))
+            return self._compare(nodes, ranges, level + 1, children)
+
+        d.addCallback(descend)
+        return d
+
+    def _exchange(self, nodes, ranges, buckets):
+        d = defer.gatherResults(
+            [node.merkle_range(buckets, ranges) for node in nodes],
+            consumeErrors=True)
+
+        def merge(snapshots):
+            return defer.gatherResults([
+                nodes[0].merge(snapshots[1]),
+                nodes[1].merge(snapshots[0])], consumeErrors=True)
+
+        def count(_):
+            self.repaired += len(buckets)
+            return len(buckets)
+
+        d.addCallback(merge)
+        d.addCallback(count)
+        return d
@@ -0,0 +1,171 @@
+# -*- coding: utf8 -*-
+from collections import deque
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+
+from brainer.lib.exceptions import ReplicationQueueFullError
+from brainer.lib.versions import version_micros
+
+BLOCK = 'block'
+SHED = 'shed'
+
+POLICIES = (BLOCK, SHED)
+
+
+class ReplicationQueue(object):
+    """Wraps a node connection and bounds the writes going to it.
+
+    At most `concurrency` writes are waiting on the node at a time, up
+    to `max_size` more wait in the queue. Once it is full, new writes
+    fail right away with `ReplicationQueueFullError` instead of piling
+    up in memory. Writes are sent in the order they came.
+
+    Writes the node fails (e.g. times out) are sent again up to
+    `retries` times, while the writes queued behind them go on. So a
+    write may be applied twice, or after later ones: the node ignores
+    sets and removes older than the version it holds for a key (see
+    `Node.set` and `Node.remove`).
+
+    Anything else (gets, snapshots...) goes straight to the connection.
+    """
+    def __init__(self, connection, max_size=1000, concurrency=100,
+                 retries=3, retry_delay=0.1, clock=reactor):
+        """
+        :param connection: A `brainer.node.client.NodeClient`.
+        :param max_size: Writes waiting to be sent, at most.
+        :param concurrency: Writes sent and waiting on the node, at most.
+        :param retries: How many times a failed write is sent again.
+        :param retry_delay: Seconds to wait before sending it again.
+        :param clock: Something providing callLater. Defaults to reactor.
+        """
+        self._connection = connection
+        self._max_size = max_size
+        self._concurrency = concurrency
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._clock = clock
+        self._queue = deque()
+        self._inflight = 0
+        # Writes waiting to be sent again: delayed call: deferred.
+        self._retrying = {}
+        # The most recent version sent to the node and acknowledged by
+        # it. Versions hold timestamps, their distance is the lag.
+        self._sent_version = 0
+        self._acked_version = 0
+        self.shed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __len__(self):
+        """Returns how many writes are queued, not yet sent.
+        """
+        return len(self._queue)
+
+    def full(self):
+        """Returns True if a new write would be turned away.
+        """
+        return (self._inflight >= self._concurrency and
+                len(self._queue) >= self._max_size)
+
+    def lag(self):
+        """Returns how far behind the node is, in seconds: the distance
+        between the latest write sent to it and the latest it
+        acknowledged.
+        """
+        if self._acked_version >= self._sent_version:
+            return 0.0
+        return (version_micros(self._sent_version) -
+                version_micros(self._acked_version)) / 1e6
+
+    def stats(self):
+        """Returns the queue counters.
+        """
+        return {
+            'queued': len(self._queue),
+            'inflight': self._inflight,
+            'lag': self.lag(),
+            'shed': self.shed,
+            'retried': self.retried,
+            'failed': self.failed}
+
+    def _enqueue(self, method, message):
+        if not self._queue and self._inflight < self._concurrency:
+            d = defer.Deferred()
+            self._send(method, message, d, self._retries)
+            return d
+        elif len(self._queue) >= self._max_size:
+            self.shed += 1
+            return defer.fail(ReplicationQueueFullError(
+                'Replication queue is full ({} writes).'.format(
+                    self._max_size)))
+
+        d = defer.Deferred()
+        self._queue.append((method, message, d))
+        return d
+
+    def set(self, message):
+        return self._enqueue('set', message)
+
+    def remove(self, message):
+        return self._enqueue('remove', message)
+
+    def mset(self, message):
+        return self._enqueue('mset', message)
+
+    def mremove(self, message):
+        return self._enqueue('mremove', message)
+
+    def _send(self, method, message, d, retries):
+        self._inflight += 1
+        version = message.get('version') or 0
+        self._sent_version = max(self._sent_version, version)
+
+        def on_reply(reply):
+            self._inflight -= 1
+            self._acked_version = max(self._acked_version, version)
+            d.callback(reply)
+            self._next()
+
+        def on_failure(f):
+            self._inflight -= 1
+            if retries > 0:
+                self.retried += 1
+                self._retry(method, message, d, retries - 1)
+            else:
+                self.failed += 1
+                log.msg('Giving up on {} after {} retries.'.format(
+                    method, self._retries))
+                d.errback(f)
+            self._next()
+
+        getattr(self._connection, method)(message).addCallbacks(
+            on_reply, on_failure)
+
+    def _retry(self, method, message, d, retries):
+        def send():
+            del self._retrying[call]
+            self._send(method, message, d, retries)
+
+        call = self._clock.callLater(self._retry_delay, send)
+        self._retrying[call] = d
+
+    def _next(self):
+        while self._queue and self._inflight < self._concurrency:
+            method, message, d = self._queue.popleft()
+            self._send(method, message, d, self._retries)
+
+    def shutdown(self):
+        """Fails the writes not sent yet, or waiting to be sent again,
+        and shuts the connection down.
+        """
+        queue, self._queue = self._queue, deque()
+        retrying, self._retrying = self._retrying, {}
+        for call in retrying:
+            call.cancel()
+        for d in [d for _, _, d in queue] + retrying.values():
+            d.errback(defer.CancelledError('Node connection shut down.'))
+        self._connection.shutdown()
@@ -1,74 +1,714 @@
 # -*- coding: utf8 -*-
+from __future__ import print_function
+
+import os
 import sys
+import time
+import struct
+import threading
+from contextlib import contextmanager
 
 import zmq
 import umsgpack
 
+from brainer.lib.hash import HashRing
+from brainer.lib.events import TOPOLOGY
+from brainer.lib.exceptions import RequestTimeoutError, PoolExhaustedError
 
-class Brainer(object):
-    """This the Brainer client.
 
-    Usage:
-        >>> client = Brainer('tcp://127.0.0.1:34212)
-        >>> client.set('mykey', 'myvalue')
-        True
-        >>> client.get('mykey')
-        'myvalue'
+def broker_addresses(address):
+    """Returns a list of broker addresses, given one or many.
     """
-    def __init__(self, address):
-        """
-        :param host: The host.
-        """
-        self.address = address
-        context = zmq.Context()
-        self.socket = context.socket(zmq.REQ)
+    if isinstance(address, (list, tuple)):
+        return list(address)
+    return [address]
 
-    def connect(self):
-        """Connects to Brainer server.
-        """
-        self.socket.connect(self.address)
 
+class BrainerCommands(object):
+    """The Brainer operations. Each of them builds a message and hands
+    it to `_request`, which subclasses implement.
+    """
     def _request(self, message):
-        self.socket.send(umsgpack.dumps(message))
-        return umsgpack.loads(self.socket.recv())
+        raise NotImplementedError
 
-    def get(self, key):
+    def get(self, key, r=None):
         """Retrieves the value of a key from Brainer nodes.
         If key doesn't exist, returns None.
 
         :param key: A key to retrieve its value.
+        :param r: Read consistency level: 'one', 'quorum', 'all' or how
+        many replicas must answer. Defaults to 'one'.
         :returns: Key value or None if key is not set.
         """
         data = {"action": "get", "key": key}
+        if r is not None:
+            data['r'] = r
         reply = self._request(data)
         return reply
 
-    def set(self, key, value, wait_all=True):
+    def set(self, key, value, wait_all=True, replication=None, w=None,
+            expires=None):
         """Binds value to a key on Brainer nodes.
 
         :param key: A key to pair with the value.
         :param value: The value to be paired with the key.
         :param wait-all: If True, will wait until all nodes has the data.
+        :param replication: How many nodes should hold the key. Defaults
+        to the broker replication factor.
+        :param w: Write consistency level: 'one', 'quorum', 'all' or how
+        many replicas must acknowledge. Takes precedence over wait_all.
+        :param expires: Seconds the key lives. Defaults to forever.
         """
         data = {
             "action": "set",
             "key": key, "value": value,
             "wait_all": wait_all}
+        if replication is not None:
+            data['replication'] = replication
+        if w is not None:
+            data['w'] = w
+        if expires is not None:
+            data['expires'] = expires
         reply = self._request(data)
         return reply
 
-    def remove(self, key, wait_all=True):
+    def remove(self, key, wait_all=True, replication=None, w=None):
         """Removes a key from the nodes.
 
         :param key: A key to remove.
+        :param replication: How many nodes hold the key. Defaults
+        to the broker replication factor.
+        :param w: Write consistency level, see `set`.
         """
         data = {
             "action": "remove",
             "key": key,
             "wait_all": wait_all}
+        if replication is not None:
+            data['replication'] = replication
+        if w is not None:
+            data['w'] = w
         reply = self._request(data)
         return reply
 
+    def stats(self):
+        """Returns the replication queue and cache counters of every node.
+        """
+        return self._request({"action": "stats"})
+
+    def get_many(self, keys, r=None):
+        """Retrieves the values of many keys in a single round trip.
+
+        :param keys: A list of keys.
+        :param r: Read consistency level, see `get`.
+        :returns: A dict of key: value. Missing keys have None.
+        """
+        data = {"action": "mget", "keys": list(keys)}
+        if r is not None:
+            data['r'] = r
+        return self._request(data)
+
+    def set_many(self, items, wait_all=True, replication=None, w=None,
+                 expires=None):
+        """Binds many values to their keys in a single round trip.
+
+        :param items: A dict of key: value.
+        :param wait-all: If True, will wait until all nodes has the data.
+        :param replication: How many nodes should hold the keys.
+        :param w: Write consistency level, see `set`.
+        :param expires: Seconds the keys live. Defaults to forever.
+        :returns: A dict of key: reply.
+        """
+        data = {"action": "mset", "items": dict(items), "wait_all": wait_all}
+        if replication is not None:
+            data['replication'] = replication
+        if w is not None:
+            data['w'] = w
+        if expires is not None:
+            data['expires'] = expires
+        return self._request(data)
+
+    def remove_many(self, keys, wait_all=True, replication=None, w=None):
+        """Removes many keys in a single round trip.
+
+        :param keys: A list of keys.
+        :param replication: How many nodes hold the keys.
+        :param w: Write consistency level, see `set`.
+        :returns: A dict of key: reply.
+        """
+        data = {"action": "mremove", "keys": list(keys), "wait_all": wait_all}
+        if replication is not None:
+            data['replication'] = replication
+        if w is not None:
+            data['w'] = w
+        return self._request(data)
+
+
+class Brainer(BrainerCommands):
+    """This the Brainer client.
+
+    Usage:
+        >>> client = Brainer('tcp://127.0.0.1:34212)
+        >>> client.set('mykey', 'myvalue')
+        True
+        >>> client.get('mykey')
+        'myvalue'
+
+    Given many broker addresses (see `Broker` peers), requests are
+    spread over them in turns.
+    """
+    socket_type = zmq.REQ
+
+    def __init__(self, address, context=None, timeout=None):
+        """
+        :param address: The broker address, or a list of them.
+        :param context: A `zmq.Context` to create the socket with.
+        Defaults to a new one.
+        :param timeout: Seconds to wait for a reply before raising
+        `RequestTimeoutError`. Defaults to forever.
+        """
+        self.address = address
+        self.timeout = timeout
+        # A REQ socket that missed a reply can't send anymore.
+        self.broken = False
+        if context is None:
+            context = zmq.Context()
+        self.context = context
+        self.socket = context.socket(self.socket_type)
+
+    def connect(self):
+        """Connects to Brainer server.
+        """
+        for address in broker_addresses(self.address):
+            self.socket.connect(address)
+
+    def close(self):
+        """Closes the socket, dropping anything not sent yet.
+        """
+        self.socket.close(linger=0)
+
+    def _request(self, message):
+        self._send(message)
+        return self._receive()
+
+    def _send(self, message):
+        self.socket.send(umsgpack.dumps(message))
+
+    def _receive(self):
+        if self.timeout is not None:
+            if not self.socket.poll(self.timeout * 1000):
+                self.broken = True
+                raise RequestTimeoutError(self.timeout)
+        return umsgpack.loads(self.socket.recv())
+
+
+def is_stale_topology(reply):
+    """True if a node turned a request away because the ring used to
+    route it is older than the current one.
+    """
+    return (isinstance(reply, dict) and reply.get('success') is False and
+            reply.get('code') == 'STALE_TOPOLOGY')
+
+
+class TopologySubscriber(object):
+    """Receives the topology changes brokers publish, see
+    `Broker.publish_topology`.
+
+    Usage:
+        >>> subscriber = TopologySubscriber('ipc:///tmp/publisher.sock')
+        >>> subscriber.connect()
+        >>> subscriber.receive(timeout=1)
+        {'event': 'joined', 'node_id': '...', 'topology': {...}}
+    """
+    def __init__(self, address, context=None):
+        """
+        :param address: The broker publisher address, or a list of them.
+        :param context: A `zmq.Context`. Defaults to a new one.
+        """
+        self.address = address
+        if context is None:
+            context = zmq.Context()
+        self.socket = context.socket(zmq.SUB)
+
+    def connect(self):
+        """Connects to the publishers and subscribes to topology changes.
+        """
+        for address in broker_addresses(self.address):
+            self.socket.connect(address)
+        self.socket.setsockopt(zmq.SUBSCRIBE, TOPOLOGY.encode('ascii'))
+
+    def close(self):
+        self.socket.close(linger=0)
+
+    def receive(self, timeout=None):
+        """Returns the next message, None if none came within `timeout`.
+
+        :param timeout: Seconds to wait. Defaults to forever, 0 to not
+        wait at all.
+        """
+        if timeout is not None and not self.socket.poll(timeout * 1000):
+            return None
+        data = self.socket.recv()
+        return umsgpack.loads(data.split(b'\0', 1)[1])
+
+    def receive_all(self):
+        """Returns every message received so far, without waiting.
+        """
+        messages = []
+        while True:
+            message = self.receive(timeout=0)
+            if message is None:
+                return messages
+            messages.append(message)
+
+
+class SmartBrainer(Brainer):
+    """A Brainer client that routes reads straight to the nodes.
+
+    It fetches the nodes, their addresses and the ring settings from
+    the broker, builds the same hash ring and sends gets to the node
+    owning the key, saving the hop through the broker. Writes and reads
+    asking for more than one replica still go through the broker.
+
+    The topology carries a version. Nodes turn away requests routed
+    with an older one, and the client then fetches the topology again
+    and retries. If a node doesn't answer, the read goes to the broker.
+
+    Given the broker `publisher`, changes are picked up as they are
+    published instead, before every read (see `TopologySubscriber`).
+    """
+    def __init__(self, address, context=None, timeout=None,
+                 publisher=None):
+        """
+        :param address: The broker address, or a list of them.
+        :param context: A `zmq.Context`, shared with node connections.
+        :param timeout: Seconds to wait for each reply.
+        :param publisher: The broker publisher address, or a list of
+        them. Defaults to None, the topology is only fetched when nodes
+        turn reads away.
+        """
+        super(SmartBrainer, self).__init__(address, context, timeout)
+        self.topology_version = None
+        self._ring = None
+        # Key: Value = node-id: `Brainer` connected to that node
+        self._node_clients = {}
+        self._subscriber = None
+        if publisher is not None:
+            self._subscriber = TopologySubscriber(publisher, self.context)
+
+    def connect(self):
+        """Connects to the broker and fetches the topology.
+        """
+        super(SmartBrainer, self).connect()
+        if self._subscriber is not None:
+            # Before fetching it, not to miss a change meanwhile.
+            self._subscriber.connect()
+        self.refresh()
+
+    def refresh(self):
+        """Fetches the topology from the broker, rebuilds the ring and
+        opens or closes node connections to match it.
+        """
+        topology = self._request({'action': 'topology'})
+        self._apply_topology(topology)
+        return topology
+
+    def update(self):
+        """Applies the latest topology published by the brokers, if it
+        is newer than ours.
+
+        :returns: True if it was.
+        """
+        if self._subscriber is None:
+            return False
+
+        latest = None
+        for message in self._subscriber.receive_all():
+            topology = message['topology']
+            if latest is None or topology['version'] > latest['version']:
+                latest = topology
+        if latest is None or latest['version'] <= self.topology_version:
+            return False
+        self._apply_topology(latest)
+        return True
+
+    def _apply_topology(self, topology):
+        nodes = dict(topology['nodes'])
+        for node_id in set(self._node_clients) - set(nodes):
+            self._node_clients.pop(node_id).close()
+
+        for node_id, address in nodes.items():
+            if node_id not in self._node_clients:
+                self._connect_node(node_id, address)
+
+        self._ring = None
+        if nodes:
+            self._ring = HashRing(list(nodes), vnodes=topology['vnodes'])
+        self.topology_version = topology['version']
+
+    def _connect_node(self, node_id, address):
+        client = Brainer(address, self.context, self.timeout)
+        client.connect()
+        self._node_clients[node_id] = client
+        return client
+
+    def _direct(self, r):
+        return self._ring is not None and r in (None, 'one', 1)
+
+    def _node_send(self, node_id, message):
+        message['topology'] = self.topology_version
+        self._node_clients[node_id]._send(message)
+
+    def _node_receive(self, node_id):
+        client = self._node_clients[node_id]
+        try:
+            return client._receive()
+        except RequestTimeoutError:
+            # The socket is stuck waiting for that reply, start over.
+            client.close()
+            self._connect_node(node_id, client.address)
+            raise
+
+    def get(self, key, r=None):
+        """Retrieves the value of a key straight from its node.
+        See `Brainer.get`.
+        """
+        self.update()
+        if self._direct(r):
+            try:
+                for _ in range(2):
+                    node_id = self._ring.get_node(key)
+                    self._node_send(node_id, {'action': 'get', 'key': key})
+                    reply = self._node_receive(node_id)
+                    if not is_stale_topology(reply):
+                        return reply
+                    self.refresh()
+            except RequestTimeoutError:
+                self.refresh()
+
+        return super(SmartBrainer, self).get(key, r)
+
+    def get_many(self, keys, r=None):
+        """Retrieves the values of many keys straight from their nodes.
+        Every node gets one message with all its keys, and all of them
+        are sent before waiting for any reply. See `Brainer.get_many`.
+        """
+        keys = list(keys)
+        self.update()
+        if self._direct(r):
+            groups = {}
+            for key, node_id in zip(keys, self._ring.get_nodes(keys)):
+                groups.setdefault(node_id, []).append(key)
+
+            for node_id, node_keys in groups.items():
+                self._node_send(
+                    node_id, {'action': 'mget', 'keys': node_keys})
+
+            values, stale, timed_out = {}, False, False
+            for node_id in groups:
+                try:
+                    reply = self._node_receive(node_id)
+                except RequestTimeoutError:
+                    timed_out = True
+                    continue
+                if is_stale_topology(reply):
+                    stale = True
+                else:
+                    values.update(reply)
+
+            if not stale and not timed_out:
+                return values
+            self.refresh()
+
+        return super(SmartBrainer, self).get_many(keys, r)
+
+    def close(self):
+        """Closes the broker and node connections.
+        """
+        super(SmartBrainer, self).close()
+        for client in self._node_clients.values():
+            client.close()
+        self._node_clients = {}
+        if self._subscriber is not None:
+            self._subscriber.close()
+
+
+class BrainerPool(BrainerCommands):
+    """A thread-safe Brainer client. ZeroMQ sockets can't be shared
+    between threads, so the pool hands a `Brainer` to each thread for
+    the time of a request and takes it back afterwards.
+
+    All connections share one `zmq.Context`, at most `max_connections`
+    are open at once, and a connection that timed out is replaced by a
+    new one instead of going back to the pool.
+
+    Usage:
+        >>> pool = BrainerPool('tcp://127.0.0.1:34212', timeout=1)
+        >>> pool.set('mykey', 'myvalue')  # From any thread.
+        True
+        >>> with pool.connection() as client:
+        ...     client.get('mykey')
+        'myvalue'
+    """
+    def __init__(self, address, max_connections=10, timeout=None,
+                 wait=None, context=None, client_class=Brainer):
+        """
+        :param address: The broker address, or a list of them.
+        :param max_connections: How many connections can be open.
+        :param timeout: Seconds to wait for each reply, see `Brainer`.
+        :param wait: Seconds to wait for a free connection when all are
+        in use, before raising `PoolExhaustedError`. Defaults to forever.
+        :param context: A `zmq.Context`. Defaults to a new one.
+        :param client_class: Defaults to `Brainer`.
+        """
+        self.address = address
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._wait = wait
+        self._context = context if context is not None else zmq.Context()
+        self._client_class = client_class
+        self._idle = []
+        self._created = 0
+        # Notified whenever a connection is given back or closed, so
+        # threads waiting for one look again.
+        self._available = threading.Condition()
+
+    def __len__(self):
+        """Returns how many connections are open.
+        """
+        return self._created
+
+    def _create(self):
+        client = self._client_class(
+            self.address, context=self._context, timeout=self._timeout)
+        client.connect()
+        return client
+
+    def acquire(self):
+        """Takes a connection out of the pool, opening a new one if
+        none is idle and the limit allows it.
+
+        :raises: `PoolExhaustedError` if none got free within `wait`.
+        """
+        deadline = None if self._wait is None else time.time() + self._wait
+        with self._available:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self._max_connections:
+                    self._created += 1
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhaustedError(self._max_connections)
+                self._available.wait(remaining)
+
+        try:
+            return self._create()
+        except Exception:
+            self._forget()
+            raise
+
+    def _forget(self):
+        """Frees the place of a connection that is gone.
+        """
+        with self._available:
+            self._created -= 1
+            self._available.notify()
+
+    def release(self, client):
+        """Gives a connection back. Broken ones are closed instead.
+
+        :param client: A client returned by `acquire`.
+        """
+        if client.broken:
+            client.close()
+            self._forget()
+        else:
+            with self._available:
+                self._idle.append(client)
+                self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        """A context manager that holds a connection for its block.
+        """
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def close(self):
+        """Closes every idle connection.
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._available.notify_all()
+        for client in idle:
+            client.close()
+
+    def _request(self, message):
+        with self.connection() as client:
+            return client._request(message)
+
+
+class BrainerFuture(object):
+    """The reply of a request sent by `PipelinedBrainer`. It is filled
+    in when the reply arrives, which can be in any order.
+    """
+    def __init__(self, client):
+        self._client = client
+        self._done = False
+        self._result = None
+
+    def done(self):
+        """True when the reply has arrived.
+        """
+        return self._done
+
+    def set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def result(self, timeout=None):
+        """Returns the reply, reading from the socket until it arrives.
+        Replies to other requests read on the way fill their futures.
+
+        :param timeout: Seconds to wait. Defaults to forever.
+        :raises: `RequestTimeoutError` if it didn't arrive in time.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._done:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+
+            if not self._client.receive(remaining):
+                raise RequestTimeoutError(timeout)
+
+        return self._result
+
+
+class PipelinedBrainer(Brainer):
+    """A Brainer client that doesn't wait for a reply before sending
+    the next request. It talks to the broker through a DEALER socket and
+    tags every request with an id, so many requests can be in flight
+    and their replies can come back in any order.
+
+    Every operation returns a `BrainerFuture` instead of the reply.
+
+    Usage:
+        >>> client = PipelinedBrainer('tcp://127.0.0.1:34212)
+        >>> client.connect()
+        >>> futures = [client.get(key) for key in keys]
+        >>> [future.result() for future in futures]
+
+    Or, sending everything in bulk:
+        >>> with client.pipeline() as pipe:
+        ...     pipe.set('mykey', 'myvalue')
+        ...     pipe.get('mykey')
+        >>> pipe.results
+        [True, 'myvalue']
+    """
+    socket_type = zmq.DEALER
+    _request_id = struct.Struct('>Q')
+
+    def __init__(self, address, context=None):
+        super(PipelinedBrainer, self).__init__(address, context)
+        self._futures = {}
+        # Request ids are a random prefix and a counter, so they are
+        # unique across clients as well, whoever routes replies by them.
+        self._nonce = os.urandom(8)
+        self._counter = 0
+
+    def pending(self):
+        """Returns how many requests are still waiting for a reply.
+        """
+        return len(self._futures)
+
+    def _request(self, message):
+        self._counter += 1
+        request_id = self._nonce + self._request_id.pack(self._counter)
+        future = self._futures[request_id] = BrainerFuture(self)
+        self.socket.send_multipart(
+            [request_id, b'', umsgpack.dumps(message)])
+        return future
+
+    def receive(self, timeout=None):
+        """Reads one reply and fills in its future.
+
+        :param timeout: Seconds to wait. Defaults to forever.
+        :returns: False if nothing arrived in time, True otherwise.
+        """
+        if timeout is not None and not self.socket.poll(timeout * 1000):
+            return False
+
+        request_id, _, reply = self.socket.recv_multipart()
+        future = self._futures.pop(request_id, None)
+        # Replies to requests nobody waits for anymore are dropped.
+        if future is not None:
+            future.set_result(umsgpack.loads(reply))
+        return True
+
+    def pipeline(self):
+        """Returns a `Pipeline` that sends its requests in bulk.
+        """
+        return Pipeline(self)
+
+
+class Pipeline(BrainerCommands):
+    """Buffers requests and sends them all at once when `execute`
+    is called, or when leaving the `with` block.
+    """
+    def __init__(self, client, timeout=None):
+        """
+        :param client: A `PipelinedBrainer`.
+        :param timeout: Seconds to wait for all the replies.
+        """
+        self._client = client
+        self._timeout = timeout
+        self._messages = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _request(self, message):
+        self._messages.append(message)
+
+    def execute(self):
+        """Sends every buffered request and waits for all the replies.
+
+        :returns: The replies, in the order the requests were made.
+        """
+        futures = [self._client._request(message)
+                   for message in self._messages]
+        self._messages = []
+
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+
+        self.results = []
+        for future in futures:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            self.results.append(future.result(timeout))
+
+        return self.results
+
 
 def main():
     address = sys.argv[1]
@@ -82,17 +722,19 @@ def main():
 
     allowed_actions = ('get', 'set', 'remove')
     if action not in allowed_actions:
-        print 'Invalid action.'
+        print('Invalid action.')
         sys.exit(1)
 
     client = Brainer(address)
     client.connect()
     method = getattr(client, action)
-    args = [key]
+    args, kwargs = [key], {}
     if action == 'set':
         args.append(value)
+        if len(sys.argv) > 5:
+            kwargs['expires'] = float(sys.argv[5])
 
-    print method(*args)
+    print(method(*args, **kwargs))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,555 @@
+# -*- coding: utf8 -*-
+"""A cache keeping keys and values serialized in large byte arrays, see
+`ArenaCache`.
+"""
+import struct
+from array import array
+from itertools import chain
+
+import umsgpack
+
+from brainer.lib.cache import BaseCache, Tombstones, TOMBSTONE_GRACE
+from brainer.lib.clock import monotonic
+from brainer.lib.hash import hash64
+from brainer.lib.merkle import MerkleTree, DEFAULT_DEPTH, item_digest
+
+# flags, key size, value size. Then the deadline and version, if the
+# flags say so, the key and the value. Strings are kept as they are, so
+# reading them is a slice, anything else is packed with msgpack.
+RECORD = struct.Struct('>BHI')
+DEADLINE = struct.Struct('>d')
+VERSION = struct.Struct('>q')
+UNICODE_KEY = 1
+HAS_DEADLINE = 2
+HAS_VERSION = 4
+STR_VALUE = 8
+UNICODE_VALUE = 16
+
+# Index slots with no location.
+EMPTY = -1
+DELETED = -2
+
+MAX_LOAD = 0.7
+
+
+class ArenaCache(BaseCache):
+    """A cache storing every key, with its serialized value, expiration
+    and version, as a record in large bytearray slabs. Records are found
+    through an open addressing index of two flat arrays: 32 bits of the
+    key hash and the record location. A key costs its record plus 17 to
+    35 bytes of index, instead of the several Python objects and dict
+    entries of `InMemoryCache`. Values other than strings are unpacked on
+    every read, which makes reads slower.
+
+    Records of removed or overwritten keys are garbage. A slab that falls
+    to half full or less has its live records moved to the current slab
+    and is freed, so that work is bounded by the slab size.
+
+    Keys must be strings (str or unicode).
+    """
+    def __init__(self, slab_size=2**20, capacity=1024, depth=DEFAULT_DEPTH,
+                 tombstone_grace=TOMBSTONE_GRACE):
+        """
+        :param slab_size: Bytes per slab. Larger records get a slab each.
+        :param capacity: Initial index slots, grows as needed. Must be a
+        power of 2.
+        :param depth: Depth of the Merkle tree, see `MerkleTree`.
+        :param tombstone_grace: Seconds to remember versioned removes
+        for, see `Tombstones`.
+        """
+        self._slab_size = slab_size
+        self._depth = depth
+        self._tombstones = Tombstones(tombstone_grace)
+        self._reset(capacity)
+
+    def _reset(self, capacity):
+        self._slabs = []
+        # Live record bytes, and where the data ends, of every slab.
+        self._live = []
+        self._ends = []
+        self._free_slabs = []
+        self._current = None
+        self._live_bytes = 0
+        self._count = 0
+        # Slots not empty, deleted ones included.
+        self._used = 0
+        self._allocate_index(capacity)
+        self._expire_cursor = 0
+        self._tree = MerkleTree(self._depth, track_keys=False)
+        self._tombstones.clear()
+
+    def _allocate_index(self, capacity):
+        self._hashes = array('I', [0]) * capacity
+        self._locations = array('l', [EMPTY]) * capacity
+
+    def __repr__(self):
+        return '<ArenaCache: {} keys>'.format(self._count)
+
+    def __len__(self):
+        return self._count
+
+    # Records.
+
+    @staticmethod
+    def _encode_key(key):
+        if isinstance(key, unicode):
+            return key.encode('utf8'), UNICODE_KEY
+        if isinstance(key, str):
+            return key, 0
+        raise TypeError('Keys must be strings, not {!r}.'.format(key))
+
+    @staticmethod
+    def _encode_value(value):
+        if isinstance(value, str):
+            return value, STR_VALUE
+        if isinstance(value, unicode):
+            return value.encode('utf8'), UNICODE_VALUE
+        return umsgpack.packb(value), 0
+
+    @staticmethod
+    def _decode_value(data, flags):
+        if flags & STR_VALUE:
+            return data
+        if flags & UNICODE_VALUE:
+            return data.decode('utf8')
+        return umsgpack.unpackb(data)
+
+    @staticmethod
+    def _pack(key_bytes, flags, data, deadline, version):
+        parts = [None, key_bytes, data]
+        if version is not None:
+            flags |= HAS_VERSION
+            parts.insert(1, VERSION.pack(version))
+        if deadline is not None:
+            flags |= HAS_DEADLINE
+            parts.insert(1, DEADLINE.pack(deadline))
+        parts[0] = RECORD.pack(flags, len(key_bytes), len(data))
+        return ''.join(parts)
+
+    def _header(self, location):
+        """Returns the slab of a record, where its key starts, the key
+        and value sizes, deadline, version and flags.
+        """
+        slab = self._slabs[location >> 32]
+        offset = location & 0xffffffff
+        flags, key_size, value_size = RECORD.unpack_from(slab, offset)
+        start = offset + RECORD.size
+        deadline = version = None
+        if flags & HAS_DEADLINE:
+            deadline, = DEADLINE.unpack_from(slab, start)
+            start += DEADLINE.size
+        if flags & HAS_VERSION:
+            version, = VERSION.unpack_from(slab, start)
+            start += VERSION.size
+        return slab, start, key_size, value_size, deadline, version, flags
+
+    def _record(self, location):
+        """Returns the key, value bytes, deadline, version and flags of a
+        record.
+        """
+        slab, start, key_size, value_size, deadline, version, flags = (
+            self._header(location))
+        key = str(slab[start:start + key_size])
+        if flags & UNICODE_KEY:
+            key = key.decode('utf8')
+        start += key_size
+        return (key, str(slab[start:start + value_size]), deadline, version,
+                flags)
+
+    def _size(self, location):
+        _, start, key_size, value_size, _, _, _ = self._header(location)
+        return start - (location & 0xffffffff) + key_size + value_size
+
+    def _write(self, data):
+        """Appends a record to the current slab, opening a new one if it
+        doesn't fit.
+
+        :returns: Its location.
+        """
+        size = len(data)
+        current = self._current
+        if current is None or self._ends[current] + size > len(
+                self._slabs[current]):
+            current = self._current = self._new_slab(
+                max(self._slab_size, size))
+        offset = self._ends[current]
+        self._slabs[current][offset:offset + size] = data
+        self._ends[current] += size
+        self._live[current] += size
+        self._live_bytes += size
+        return current << 32 | offset
+
+    def _new_slab(self, size):
+        slab = bytearray(size)
+        if self._free_slabs:
+            index = self._free_slabs.pop()
+            self._slabs[index] = slab
+            self._live[index] = self._ends[index] = 0
+        else:
+            index = len(self._slabs)
+            self._slabs.append(slab)
+            self._live.append(0)
+            self._ends.append(0)
+        return index
+
+    def _free(self, location):
+        """Marks a record as garbage, compacting its slab if it is at
+        most half full.
+        """
+        size = self._size(location)
+        index = location >> 32
+        self._live[index] -= size
+        self._live_bytes -= size
+        if (index != self._current and
+                self._live[index] * 2 <= len(self._slabs[index])):
+            self._compact_slab(index)
+
+    def _compact_slab(self, index):
+        """Moves the live records of a slab to the current one, and frees
+        it.
+        """
+        slab = self._slabs[index]
+        offset, end = 0, self._ends[index]
+        while offset < end and self._live[index]:
+            location = index << 32 | offset
+            size = self._size(location)
+            slot = self._slot(self._record(location)[0])
+            if slot >= 0 and self._locations[slot] == location:
+                self._live[index] -= size
+                self._live_bytes -= size
+                self._locations[slot] = self._write(
+                    slab[offset:offset + size])
+            offset += size
+        self._slabs[index] = None
+        self._free_slabs.append(index)
+
+    # Index.
+
+    def _find(self, key_bytes):
+        """Looks a key up in the index.
+
+        :returns: Its slot (-1 if missing), the slot to insert it in,
+        and its hash (the top 32 bits of `hash64`).
+        """
+        key_hash = hash64(key_bytes) >> 32
+        locations, hashes = self._locations, self._hashes
+        mask = len(locations) - 1
+        slot = key_hash & mask
+        free = -1
+        while True:
+            location = locations[slot]
+            if location == EMPTY:
+                return -1, slot if free < 0 else free, key_hash
+            if location == DELETED:
+                if free < 0:
+                    free = slot
+            elif hashes[slot] == key_hash:
+                slab, start, key_size = self._header(location)[:3]
+                if slab[start:start + key_size] == key_bytes:
+                    return slot, slot, key_hash
+            slot = (slot + 1) & mask
+
+    def _slot(self, key):
+        return self._find(self._encode_key(key)[0])[0]
+
+    def _grow(self):
+        """Rehashes the index, dropping the deleted slots. It doubles in
+        size if the live keys alone would fill it past half.
+        """
+        capacity = len(self._locations)
+        while capacity < (self._count + 1) * 2:
+            capacity *= 2
+        hashes, locations = self._hashes, self._locations
+        self._allocate_index(capacity)
+        mask = capacity - 1
+        for slot, location in enumerate(locations):
+            if location < 0:
+                continue
+            key_hash = hashes[slot]
+            new = key_hash & mask
+            while self._locations[new] != EMPTY:
+                new = (new + 1) & mask
+            self._hashes[new] = key_hash
+            self._locations[new] = location
+        self._used = self._count
+        self._expire_cursor = 0
+
+    def _slots(self):
+        """Yields the slots in use.
+        """
+        for slot, location in enumerate(self._locations):
+            if location >= 0:
+                yield slot
+
+    @classmethod
+    def _digest(cls, key, data, flags, version):
+        if version is not None:
+            return item_digest(key, None, version)
+        if flags & (STR_VALUE | UNICODE_VALUE):
+            return item_digest(key, cls._decode_value(data, flags))
+        # What item_digest hashes, [key, value] packed.
+        return hash64('\x92' + umsgpack.packb(key) + data)
+
+    def _slot_digest(self, slot):
+        key, data, _, version, flags = self._record(self._locations[slot])
+        return self._digest(key, data, flags, version)
+
+    def _store(self, key, value, deadline, version):
+        self._forget_removal(key)
+        key_bytes, key_flags = self._encode_key(key)
+        data, value_flags = self._encode_value(value)
+        if self._used + 1 > len(self._locations) * MAX_LOAD:
+            self._grow()
+        slot, free, key_hash = self._find(key_bytes)
+        old = previous = None
+        if slot >= 0:
+            old = self._slot_digest(slot)
+            previous = self._locations[slot]
+        else:
+            slot = free
+            if self._locations[slot] == EMPTY:
+                self._used += 1
+            self._count += 1
+
+        self._hashes[slot] = key_hash
+        self._locations[slot] = self._write(self._pack(
+            key_bytes, key_flags | value_flags, data, deadline, version))
+        self._tree.update(
+            key, old, self._digest(key, data, value_flags, version))
+        # Only once the slot points to the new record, or compacting the
+        # slab would move the old one.
+        if previous is not None:
+            self._free(previous)
+
+    def _forget_removal(self, key):
+        """Drops the tombstone of a key written again.
+        """
+        digest = self._tombstones.digest(key)
+        if digest is not None:
+            self._tombstones.discard(key)
+            self._tree.update(key, digest, None)
+
+    def _remember_removal(self, key, version, seconds=None):
+        """Adds a tombstone for a key no longer in the index.
+        """
+        old = self._tombstones.digest(key)
+        self._tombstones.add(key, version, seconds)
+        self._tree.update(key, old, self._tombstones.digest(key))
+
+    def _delete(self, slot, key):
+        self._tree.update(key, self._slot_digest(slot), None)
+        location = self._locations[slot]
+        self._locations[slot] = DELETED
+        self._count -= 1
+        self._free(location)
+
+    # BaseCache.
+
+    def set(self, key, value, expires=None, version=None):
+        """Sets the value onto the key with an optional expiration date.
+
+        :param key: A key.
+        :param value: The value.
+        :param expires: Key expiration in seconds (optional).
+        :param version: The write version assigned by the broker (optional).
+        """
+        deadline = monotonic() + expires if expires else None
+        self._store(key, value, deadline, version)
+        return True
+
+    def get(self, key):
+        """Gets a key if available and if it has expiration,
+        only if it hasn't been expired.
+
+        :param key: A key string.
+        """
+        slot = self._slot(key)
+        if slot < 0:
+            return None
+        _, data, deadline, _, flags = self._record(self._locations[slot])
+        if deadline is not None and deadline < monotonic():
+            self._delete(slot, key)
+            return None
+        return self._decode_value(data, flags)
+
+    def version(self, key):
+        """Returns the version of the last write of a key, if any. The
+        version of its remove if it was removed recently.
+
+        :param key: The key.
+        """
+        slot = self._slot(key)
+        if slot < 0:
+            return self._tombstones.version(key)
+        return self._header(self._locations[slot])[5]
+
+    def remove(self, key, version=None):
+        """Removes key from cache.
+
+        :param key: The key.
+        :param version: The write version assigned by the broker
+        (optional), see `InMemoryCache.remove`.
+        """
+        slot = self._slot(key)
+        if slot >= 0:
+            self._delete(slot, key)
+        if version is not None:
+            self._remember_removal(key, version)
+        return slot >= 0
+
+    def keys(self):
+        """Returns a list of every key in the cache.
+        """
+        return [self._record(self._locations[slot])[0]
+                for slot in self._slots()]
+
+    def removed_keys(self):
+        """Returns a list of the keys with a tombstone, see `Tombstones`.
+        """
+        return self._tombstones.keys()
+
+    def _export_slots(self, slots, tombstones):
+        now = monotonic()
+        snapshot = {'data': {}, 'expiration': {}, 'version': {},
+                    'tombstone': tombstones}
+        for slot in slots:
+            key, data, deadline, version, flags = self._record(
+                self._locations[slot])
+            snapshot['data'][key] = self._decode_value(data, flags)
+            if deadline is not None:
+                snapshot['expiration'][key] = deadline - now
+            if version is not None:
+                snapshot['version'][key] = version
+        return snapshot
+
+    def snapshot(self):
+        """Returns a snapshot of the cache, see `InMemoryCache.snapshot`.
+        """
+        return self._export_slots(self._slots(), self._tombstones.export())
+
+    def export(self, keys):
+        """Returns a snapshot (see `snapshot`) holding only some keys.
+        Keys not in the cache are left out.
+
+        :param keys: The keys to export.
+        """
+        slots = (self._slot(key) for key in keys)
+        return self._export_slots(
+            (slot for slot in slots if slot >= 0),
+            self._tombstones.export(keys))
+
+    def replay(self, snapshot, update=False):
+        """Replays the output of a snapshot into this cache, see
+        `InMemoryCache.replay`.
+        """
+        if not update:
+            self._reset(len(self._locations))
+
+        now = monotonic()
+        expiration = snapshot['expiration']
+        versions = snapshot.get('version', {})
+        for key, value in snapshot['data'].iteritems():
+            version = versions.get(key)
+            if update:
+                current = self.version(key)
+                if current is not None and (
+                        version is None or current > version):
+                    continue
+            deadline = now + expiration[key] if key in expiration else None
+            self._store(key, value, deadline, version)
+
+        for key, (version, seconds) in snapshot.get(
+                'tombstone', {}).iteritems():
+            current = self.version(key)
+            if current is not None and current >= version:
+                continue
+            slot = self._slot(key)
+            if slot >= 0:
+                self._delete(slot, key)
+            self._remember_removal(key, version, seconds)
+
+    def digest(self, key):
+        """Returns the digest of a key, or of its tombstone. None if it
+        isn't in the cache.
+
+        :param key: The key.
+        """
+        slot = self._slot(key)
+        if slot < 0:
+            return self._tombstones.digest(key)
+        return self._slot_digest(slot)
+
+    def digests(self, level, indexes=None, ranges=None):
+        """Returns digests of a level of the Merkle tree of the cache.
+        See `brainer.lib.merkle.MerkleTree.digests`.
+
+        :param ranges: Hash ranges, to only digest the keys in them (see
+        `brainer.lib.merkle.MerkleTree.view`).
+        """
+        tree = self._tree
+        if ranges is not None:
+            tree = tree.view(ranges, self._tree_keys, self.digest)
+        return tree.digests(level, indexes)
+
+    def _tree_keys(self):
+        return chain(self.keys(), self.removed_keys())
+
+    def bucket_keys(self, buckets):
+        """Returns the keys in some leaves of the Merkle tree. Scans the
+        whole index, the tree doesn't keep them.
+
+        :param buckets: Leaf indexes.
+        """
+        buckets = set(buckets)
+        shift = 32 - self._depth
+        keys = [self._record(self._locations[slot])[0]
+                for slot in self._slots()
+                if self._hashes[slot] >> shift in buckets]
+        keys.extend(key for key in self._tombstones.keys()
+                    if self._tree.bucket(key) in buckets)
+        return keys
+
+    def expire(self, limit=None):
+        """Removes expired keys. Index slots are looked at in turns, the
+        next call carries on where this one stopped.
+
+        :param limit: How many slots to look at, at most. Defaults to all.
+        :returns: How many keys were removed.
+        """
+        capacity = len(self._locations)
+        if limit is None or limit > capacity:
+            limit = capacity
+        now = monotonic()
+        removed = 0
+        slot = self._expire_cursor
+        for _ in xrange(limit):
+            location = self._locations[slot]
+            if location >= 0:
+                deadline = self._header(location)[4]
+                if deadline is not None and deadline < now:
+                    self._delete(slot, self._record(location)[0])
+                    removed += 1
+            slot = (slot + 1) % capacity
+        self._expire_cursor = slot
+
+        for key, version in self._tombstones.expire():
+            self._tree.update(key, item_digest(key, None, version), None)
+        return removed
+
+    def stats(self):
+        """Returns a dict with items, bytes (slabs and index), payload
+        (bytes of the live records) and bytes_per_key.
+        """
+        index = sum(column.itemsize * len(column)
+                    for column in (self._hashes, self._locations))
+        slabs = sum(len(slab) for slab in self._slabs if slab is not None)
+        return {
+            'items': self._count,
+            'bytes': slabs + index,
+            'payload': self._live_bytes,
+            'bytes_per_key': (
+                float(slabs + index) / self._count if self._count else 0)}
+
+    def close(self):
+        """Called when the node shuts down. Nothing to do in memory.
+        """
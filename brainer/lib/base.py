@@ -4,6 +4,15 @@ from twisted.python import log
 from txzmq import ZmqREPConnection, ZmqFactory, ZmqEndpoint
 
 
+class Factory(ZmqFactory):
+    """A `txzmq.ZmqFactory` with a configurable number of IO threads.
+    Every connection made from one factory shares its ZeroMQ context.
+    """
+    def __init__(self, io_threads=1):
+        self.ioThreads = io_threads
+        super(Factory, self).__init__()
+
+
 class BaseREP(ZmqREPConnection):
     _serializer = umsgpack
 
@@ -45,7 +54,8 @@ class BaseREP(ZmqREPConnection):
         :param node_manager: A Node Manager. Defaults to `NodeManager`.
         :param serializer: A serializer, defaults to umsgpack.
         :param debug: If True, will log debug messages. Defaults to False.
+        :param io_threads: ZeroMQ IO threads. Defaults to 1.
         """
-        factory = ZmqFactory()
+        factory = Factory(kwargs.pop('io_threads', 1))
         endpoint = ZmqEndpoint('bind', address)
         return cls(factory, endpoint, **kwargs)
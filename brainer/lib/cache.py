@@ -1,31 +1,205 @@
 # -*- coding: utf8 -*-
-from datetime import datetime, timedelta
+import heapq
+from itertools import chain
+
+import umsgpack
+
+from brainer.lib.clock import monotonic
+from brainer.lib.eviction import LRU, get_policy
+from brainer.lib.merkle import MerkleTree, item_digest
+
+# Seconds removed keys are remembered for, see `Tombstones`.
+TOMBSTONE_GRACE = 3600
 
 
 class BaseCache(object):
-    """A basic Cache must implement set, get, remove and snapshot.
+    """A basic Cache must implement set, get, version, remove and snapshot.
 
-    The only implementation currently is in-memory. See `InMemoryCache`.
+    See `InMemoryCache`, `BoundedCache` and, for caches kept on disk,
+    `brainer.lib.persistence`.
     """
-    def set(self, key, value):
+    def set(self, key, value, expires=None, version=None):
         raise NotImplementedError
 
     def get(self, key):
         raise NotImplementedError
 
-    def remove(self, key):
+    def version(self, key):
+        raise NotImplementedError
+
+    def remove(self, key, version=None):
         raise NotImplementedError
 
     def snapshot(self):
         raise NotImplementedError
 
+    def keys(self):
+        raise NotImplementedError
+
+    def removed_keys(self):
+        raise NotImplementedError
+
+    def export(self, keys):
+        raise NotImplementedError
+
+    def merge(self, snapshot):
+        """Applies keys another replica sent to repair this one, see
+        `brainer.broker.repair.AntiEntropy`. Keys we hold a newer
+        version of are kept.
+        """
+        self.replay(snapshot, update=True)
+
+    def digest(self, key):
+        raise NotImplementedError
+
+    def digests(self, level, indexes=None, ranges=None):
+        raise NotImplementedError
+
+    def bucket_keys(self, buckets):
+        raise NotImplementedError
+
+    def expire(self, limit=None):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class Tombstones(object):
+    """The versions of keys recently removed.
+
+    A write older than a remove, like a retry arriving late or a replica
+    merging its keys back during anti-entropy, must not bring the key
+    back. So caches remember the version of every versioned remove,
+    report it as the version of the key, and digest it like a write.
+
+    Tombstones are dropped after `grace` seconds, by then every replica
+    should have heard of the remove. They are kept in memory only.
+    """
+    def __init__(self, grace=TOMBSTONE_GRACE):
+        """
+        :param grace: Seconds to remember a remove for.
+        """
+        self._grace = grace
+        # key: [version, deadline], a `monotonic` timestamp.
+        self._entries = {}
+        # (deadline, key) pairs, see `InMemoryCache._deadlines`.
+        self._deadlines = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return self._entries.keys()
+
+    def clear(self):
+        self._entries = {}
+        self._deadlines = []
+
+    def version(self, key):
+        """Returns the version of the remove of a key, if any.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def digest(self, key):
+        """Returns the digest of the remove of a key, None if there is
+        none. Removes are digested by their version, like writes.
+        """
+        version = self.version(key)
+        if version is None:
+            return None
+        return item_digest(key, None, version)
+
+    def add(self, key, version, seconds=None):
+        """Remembers a remove, unless a newer one is remembered already.
+
+        :param key: The key.
+        :param version: The version of the remove.
+        :param seconds: How long to remember it. Defaults to `grace`.
+        """
+        current = self.version(key)
+        if current is not None and current >= version:
+            return
+        if seconds is None:
+            seconds = self._grace
+        deadline = monotonic() + seconds
+        self._entries[key] = [version, deadline]
+        heapq.heappush(self._deadlines, (deadline, key))
+
+    def discard(self, key):
+        """Forgets the remove of a key, written again.
+        """
+        self._entries.pop(key, None)
+
+    def expire(self):
+        """Drops the tombstones past their grace period.
+
+        :returns: A list of (key, version) pairs dropped.
+        """
+        now = monotonic()
+        deadlines = self._deadlines
+        expired = []
+        while deadlines and deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(deadlines)
+            entry = self._entries.get(key)
+            # Skip entries of keys written or removed again since.
+            if entry is not None and entry[1] == deadline:
+                del self._entries[key]
+                expired.append((key, entry[0]))
+
+        if len(deadlines) > 2 * len(self._entries) + 1024:
+            self._deadlines = [
+                (deadline, key)
+                for key, (_, deadline) in self._entries.iteritems()]
+            heapq.heapify(self._deadlines)
+
+        return expired
+
+    def export(self, keys=None):
+        """Returns a dict of key: [version, seconds left] for some keys,
+        for the 'tombstone' part of snapshots.
+
+        :param keys: Defaults to all. Keys with no tombstone are left out.
+        """
+        now = monotonic()
+        if keys is None:
+            keys = self._entries
+        exported = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None:
+                exported[key] = [entry[0], entry[1] - now]
+        return exported
+
 
 class InMemoryCache(BaseCache):
     """This is an InMemoryCache.
     """
-    def __init__(self):
+    def __init__(self, tombstone_grace=TOMBSTONE_GRACE):
+        """
+        :param tombstone_grace: Seconds to remember versioned removes
+        for, see `Tombstones`.
+        """
         self._cache = {}
+        # key: deadline, a `monotonic` timestamp.
         self._expiration = {}
+        # (deadline, key) pairs, the next to expire first. Entries of
+        # keys set again or removed are skipped when they come up.
+        self._deadlines = []
+        self._versions = {}
+        self._tombstones = Tombstones(tombstone_grace)
+        # Kept up to date on every write, so replicas can find where
+        # they differ without a snapshot. See `brainer.lib.merkle`.
+        self._tree = MerkleTree()
 
     def __repr__(self):
         """Returns a representation of the cache.
@@ -33,57 +207,240 @@ class InMemoryCache(BaseCache):
         return str(self._cache)
 
     def snapshot(self):
-        """Returns a snapshot of the cache.
+        """Returns a snapshot of the cache. Expirations are exported as
+        the seconds left, our clock means nothing to other processes, and
+        so are tombstones (see `Tombstones.export`).
         """
-        return {'data': self._cache, 'expiration': self._expiration}
+        now = monotonic()
+        return {
+            'data': self._cache,
+            'expiration': dict(
+                (key, deadline - now)
+                for key, deadline in self._expiration.iteritems()),
+            'version': self._versions,
+            'tombstone': self._tombstones.export()}
+
+    def keys(self):
+        """Returns a list of every key in the cache.
+        """
+        return self._cache.keys()
+
+    def removed_keys(self):
+        """Returns a list of the keys with a tombstone, see `Tombstones`.
+        """
+        return self._tombstones.keys()
+
+    def export(self, keys):
+        """Returns a snapshot (see `snapshot`) holding only some keys.
+        Keys not in the cache, nor removed recently, are left out.
+
+        :param keys: The keys to export.
+        """
+        now = monotonic()
+        snapshot = {'data': {}, 'expiration': {}, 'version': {},
+                    'tombstone': self._tombstones.export(keys)}
+        for key in keys:
+            if key not in self._cache:
+                continue
+            snapshot['data'][key] = self._cache[key]
+            if key in self._expiration:
+                snapshot['expiration'][key] = self._expiration[key] - now
+            if key in self._versions:
+                snapshot['version'][key] = self._versions[key]
+        return snapshot
 
     def replay(self, snapshot, update=False):
         """Replays the output of a snapshot into this cache.
 
         :param update: The default behaviour is to entirely override the
         current data (which should be None in normal cases). If you want
-        to update the data, set this to True.
+        to update the data, set this to True. Keys we hold a newer
+        version of, or removed later, are kept, so a snapshot arriving in
+        chunks doesn't undo writes made meanwhile. Tombstones remove the
+        keys we hold an older version of.
         """
+        now = monotonic()
+        tombstones = snapshot.get('tombstone', {})
         if not update:
             self._cache = snapshot['data']
-            self._expiration = snapshot['expiration']
-        else:
-            self._cache.update(snapshot['data'])
-            self._expiration.update(snapshot['expiration'])
+            self._expiration = dict(
+                (key, now + seconds)
+                for key, seconds in snapshot['expiration'].iteritems())
+            self._deadlines = [
+                (deadline, key)
+                for key, deadline in self._expiration.iteritems()]
+            heapq.heapify(self._deadlines)
+            self._versions = snapshot.get('version', {})
+            self._tombstones.clear()
+            for key, (version, seconds) in tombstones.iteritems():
+                if key not in self._cache:
+                    self._tombstones.add(key, version, seconds)
+            self._tree = MerkleTree.build(
+                (key, self.digest(key))
+                for key in chain(self._cache, self._tombstones.keys()))
+            return
+
+        expiration = snapshot['expiration']
+        versions = snapshot.get('version', {})
+        for key, value in snapshot['data'].iteritems():
+            version = versions.get(key)
+            current = self.version(key)
+            if current is not None and (version is None or current > version):
+                continue
+
+            old = self.digest(key)
+            self._tombstones.discard(key)
+            self._cache[key] = value
+            if key in expiration:
+                self._expire_at(key, now + expiration[key])
+            else:
+                self._expiration.pop(key, None)
+            if version is not None:
+                self._versions[key] = version
+            else:
+                self._versions.pop(key, None)
+            self._tree.update(key, old, item_digest(key, value, version))
+
+        for key, (version, seconds) in tombstones.iteritems():
+            current = self.version(key)
+            if current is not None and current >= version:
+                continue
+            # Removed the way subclasses keep track of, then remembered
+            # for the time the sender had left.
+            self.remove(key)
+            old = self.digest(key)
+            self._tombstones.add(key, version, seconds)
+            self._tree.update(key, old, self.digest(key))
+
+    def digest(self, key):
+        """Returns the digest of a key, or of its tombstone. None if it
+        isn't in the cache.
+
+        :param key: The key.
+        """
+        if key not in self._cache:
+            return self._tombstones.digest(key)
+        return item_digest(key, self._cache[key], self._versions.get(key))
+
+    def digests(self, level, indexes=None, ranges=None):
+        """Returns digests of a level of the Merkle tree of the cache.
+        See `brainer.lib.merkle.MerkleTree.digests`.
+
+        :param ranges: Hash ranges, to only digest the keys in them (see
+        `brainer.lib.merkle.MerkleTree.view`).
+        """
+        tree = self._tree
+        if ranges is not None:
+            tree = tree.view(ranges, self._tree_keys, self.digest)
+        return tree.digests(level, indexes)
+
+    def _tree_keys(self):
+        return chain(self.keys(), self.removed_keys())
+
+    def bucket_keys(self, buckets):
+        """Returns the keys in some leaves of the Merkle tree.
+
+        :param buckets: Leaf indexes.
+        """
+        return self._tree.keys(buckets)
 
     @staticmethod
     def calculate_expiration(seconds):
         """Gets now and adds seconds to record expiration timestamp.
         """
-        return datetime.now() + timedelta(seconds=seconds)
+        return monotonic() + seconds
 
-    def set(self, key, value, expires=None):
+    def _expire_at(self, key, deadline):
+        self._expiration[key] = deadline
+        heapq.heappush(self._deadlines, (deadline, key))
+
+    def expire(self, limit=None):
+        """Removes expired keys, the ones that expired first first.
+        Keys are also removed when read after they expire, this reclaims
+        the memory of the ones nobody reads.
+
+        :param limit: How many keys to look at, at most, so a call takes
+        bounded time. Defaults to no limit.
+        :returns: How many keys were removed.
+        """
+        now = monotonic()
+        deadlines = self._deadlines
+        removed = 0
+        while deadlines and deadlines[0][0] <= now:
+            if limit is not None and limit <= 0:
+                break
+            deadline, key = heapq.heappop(deadlines)
+            if limit is not None:
+                limit -= 1
+            # Skip entries of keys set again (or removed) since.
+            if self._expiration.get(key) == deadline:
+                self.remove(key)
+                removed += 1
+
+        # Keys set again and again leave stale entries behind.
+        if len(deadlines) > 2 * len(self._expiration) + 1024:
+            self._deadlines = [
+                (deadline, key)
+                for key, deadline in self._expiration.iteritems()]
+            heapq.heapify(self._deadlines)
+
+        for key, version in self._tombstones.expire():
+            self._tree.update(key, item_digest(key, None, version), None)
+
+        return removed
+
+    def set(self, key, value, expires=None, version=None):
         """Sets the value onto the key with an optional expiration date.
 
         :param key: A key.
         :param value: The value.
         :param expires: Key expiration in seconds (optional).
+        :param version: The write version assigned by the broker (optional).
         """
+        old = self.digest(key)
+        self._tombstones.discard(key)
         self._cache[key] = value
         if expires:
-            self._expiration[key] = self.calculate_expiration(expires)
+            self._expire_at(key, self.calculate_expiration(expires))
+        else:
+            self._expiration.pop(key, None)
 
+        if version is not None:
+            self._versions[key] = version
+        else:
+            self._versions.pop(key, None)
+
+        self._tree.update(key, old, item_digest(key, value, version))
         return True
 
-    def remove(self, key):
-        """Removes key from cache.
+    def version(self, key):
+        """Returns the version of the last write of a key, if any. The
+        version of its remove if it was removed recently.
 
         :param key: The key.
         """
-        if key in self._expiration:
-            del self._expiration[key]
+        if key not in self._cache:
+            return self._tombstones.version(key)
+        return self._versions.get(key)
 
-        try:
-            del self._cache[key]
-        except KeyError:
-            return False
+    def remove(self, key, version=None):
+        """Removes key from cache.
 
-        return True
+        :param key: The key.
+        :param version: The write version assigned by the broker
+        (optional). A tombstone keeps it, see `Tombstones`.
+        :returns: True if the key was in the cache.
+        """
+        old = self.digest(key)
+        removed = key in self._cache
+        if removed:
+            del self._cache[key]
+        self._expiration.pop(key, None)
+        self._versions.pop(key, None)
+        if version is not None:
+            self._tombstones.add(key, version)
+        self._tree.update(key, old, self.digest(key))
+        return removed
 
     def get(self, key):
         """Gets a key if available and if it has expiration,
@@ -91,9 +448,171 @@ class InMemoryCache(BaseCache):
 
         :param key: A key string.
         """
-        if key in self._expiration:
-            if self._expiration[key] < datetime.now():
-                self.remove(key)
-                return
+        deadline = self._expiration.get(key)
+        if deadline is not None and deadline < monotonic():
+            self.remove(key)
+            return
 
         return self._cache.get(key, None)
+
+    def stats(self):
+        """Returns a dict with how many keys the cache holds.
+        """
+        return {'items': len(self._cache)}
+
+    def close(self):
+        """Called when the node shuts down. Nothing to do in memory.
+        """
+
+
+def entry_size(key, value):
+    """Estimates the memory a key takes, as the length of the key and
+    value packed with msgpack. Interpreter overhead isn't accounted for,
+    leave some room when choosing `max_bytes`.
+    """
+    return len(umsgpack.packb([key, value]))
+
+
+class BoundedCache(InMemoryCache):
+    """An `InMemoryCache` holding at most `max_items` keys and about
+    `max_bytes` bytes (see `entry_size`). Once full, writes evict keys
+    chosen by an eviction policy, see `brainer.lib.eviction`.
+
+    Replicas evict on their own, so they hold different keys. Repairs
+    (see `brainer.broker.repair.AntiEntropy`) only update the keys a
+    bounded cache holds: taking back the ones it evicted would evict
+    others, which repairs would then copy back in turn.
+    """
+    def __init__(self, max_items=0, max_bytes=0, policy=LRU,
+                 sizeof=entry_size, tombstone_grace=TOMBSTONE_GRACE):
+        """
+        :param max_items: How many keys to hold at most, 0 for no limit.
+        :param max_bytes: How many bytes to hold at most, 0 for no limit.
+        :param policy: 'lru', 'lfu', 'ttl' or an `EvictionPolicy`.
+        :param sizeof: A function taking a key and value and returning
+        the bytes they take.
+        :param tombstone_grace: See `InMemoryCache`.
+        """
+        super(BoundedCache, self).__init__(tombstone_grace=tombstone_grace)
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._policy = get_policy(policy)
+        self._touch = self._policy.touch
+        self._sizeof = sizeof
+        self._sizes = {}
+        self._bytes = 0
+        self._evictions = 0
+        self._evicted_bytes = 0
+
+    def _track(self, key):
+        """Tells the policy about a key just written and accounts for
+        its size. Sizes are only worked out with a byte limit.
+        """
+        size = 0
+        if self._max_bytes:
+            size = self._sizeof(key, self._cache[key])
+        deadline = self._expiration.get(key)
+        if key in self._sizes:
+            self._bytes -= self._sizes[key]
+            self._policy.update(key, deadline)
+        else:
+            self._policy.add(key, deadline)
+        self._sizes[key] = size
+        self._bytes += size
+
+    def _full(self):
+        return ((self._max_items and len(self._cache) > self._max_items) or
+                (self._max_bytes and self._bytes > self._max_bytes))
+
+    def evict(self):
+        """Evicts keys until the cache is within its limits.
+
+        :returns: How many keys were evicted.
+        """
+        evicted = 0
+        while self._full():
+            key = self._policy.victim()
+            if key is None:
+                break
+            self._evicted_bytes += self._sizes.get(key, 0)
+            self.remove(key)
+            evicted += 1
+        self._evictions += evicted
+        return evicted
+
+    def set(self, key, value, expires=None, version=None):
+        """Sets a key, see `InMemoryCache.set`, evicting others if the
+        cache gets full. A key larger than `max_bytes` on its own is not
+        stored (and any previous value is removed).
+        """
+        if self._max_bytes and self._sizeof(key, value) > self._max_bytes:
+            self.remove(key)
+            self._evictions += 1
+            return False
+
+        super(BoundedCache, self).set(
+            key, value, expires=expires, version=version)
+        self._track(key)
+        self.evict()
+        return True
+
+    def get(self, key):
+        """Gets a key, see `InMemoryCache.get`, marking it as used.
+        """
+        deadline = self._expiration.get(key)
+        if deadline is not None and deadline < monotonic():
+            self.remove(key)
+            return
+
+        if key in self._sizes:
+            self._touch(key)
+        return self._cache.get(key)
+
+    def remove(self, key, version=None):
+        removed = super(BoundedCache, self).remove(key, version=version)
+        if removed:
+            self._bytes -= self._sizes.pop(key)
+            self._policy.discard(key)
+        return removed
+
+    def merge(self, snapshot):
+        """Applies keys sent by another replica, see `BaseCache.merge`,
+        leaving out the keys we don't hold. Tombstones still apply.
+        """
+        cache = self._cache
+        data = dict((key, value)
+                    for key, value in snapshot['data'].iteritems()
+                    if key in cache)
+        self.replay(dict(snapshot, data=data), update=True)
+
+    def replay(self, snapshot, update=False):
+        """Replays a snapshot, see `InMemoryCache.replay`, evicting keys
+        if it doesn't fit.
+        """
+        super(BoundedCache, self).replay(snapshot, update=update)
+        if not update:
+            for key in self._sizes:
+                self._policy.discard(key)
+            self._sizes = {}
+            self._bytes = 0
+            keys = self._cache
+        else:
+            keys = snapshot['data']
+
+        for key in keys:
+            if key in self._cache:
+                self._track(key)
+        self.evict()
+
+    def stats(self):
+        """Returns a dict with items, bytes, their limits, evictions
+        (keys evicted, or refused for being too large) and evicted_bytes.
+        Bytes are only accounted for with `max_bytes`.
+        """
+        return {
+            'items': len(self._cache),
+            'bytes': self._bytes,
+            'max_items': self._max_items,
+            'max_bytes': self._max_bytes,
+            'evictions': self._evictions,
+            'evicted_bytes': self._evicted_bytes}
@@ -0,0 +1,44 @@
+# -*- coding: utf8 -*-
+"""A monotonic clock: it never goes back, whatever happens to the wall
+clock. Only differences between its readings mean something.
+"""
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    """Returns a `monotonic` function calling clock_gettime through
+    ctypes, or None if it is not available.
+    """
+    try:
+        librt = ctypes.CDLL(
+            ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        spec = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    monotonic = _clock_gettime() or time.time
@@ -0,0 +1,15 @@
+# -*- coding: utf8 -*-
+"""Topology change notifications, published by brokers over PUB/SUB.
+See `brainer.broker.Broker.publish_topology`.
+"""
+
+# The tag brokers publish topology changes under. Messages are dicts
+# with 'event', 'node_id' and 'topology' (see `Broker.get_topology`).
+TOPOLOGY = 'topology'
+
+# Topology events. A node suspected of being down stays in the ring
+# until it unregisters, or recovers.
+JOINED = 'joined'
+LEFT = 'left'
+SUSPECTED = 'suspected'
+RECOVERED = 'recovered'
@@ -0,0 +1,218 @@
+# -*- coding: utf8 -*-
+"""Eviction policies for `brainer.lib.cache.BoundedCache`.
+
+A policy is told about every key added, read, updated or removed, and
+picks the next key to evict. Every operation is O(1), amortized.
+"""
+import heapq
+import random
+import itertools
+from collections import OrderedDict, deque
+
+LRU = 'lru'
+LFU = 'lfu'
+TTL = 'ttl'
+
+
+class EvictionPolicy(object):
+    def add(self, key, deadline=None):
+        """A key was added.
+
+        :param key: The key.
+        :param deadline: When the key expires (`monotonic`), if ever.
+        """
+        raise NotImplementedError
+
+    def update(self, key, deadline=None):
+        """A key was set again. See `add`.
+        """
+        raise NotImplementedError
+
+    def touch(self, key):
+        """A key was read.
+        """
+        raise NotImplementedError
+
+    def discard(self, key):
+        """A key was removed.
+        """
+        raise NotImplementedError
+
+    def victim(self):
+        """Returns the key to evict next, None if there are no keys.
+        """
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evicts the least recently used key.
+
+    Reads are the hot path: a touch stamps the key with a tick and
+    queues it, like `TTLPolicy` queues deadlines. Entries of keys used
+    again since are skipped when they come up.
+    """
+    def __init__(self):
+        # key: tick of its last use.
+        self._ticks = {}
+        # (tick, key) pairs, least recently used first.
+        self._queue = deque()
+        self._clock = itertools.count()
+
+    def add(self, key, deadline=None):
+        tick = next(self._clock)
+        self._ticks[key] = tick
+        self._queue.append((tick, key))
+        if len(self._queue) > 2 * len(self._ticks) + 1024:
+            ticks = self._ticks
+            self._queue = deque(
+                entry for entry in self._queue
+                if ticks.get(entry[1]) == entry[0])
+
+    # Reads and writes alike make a key the most recently used.
+    update = add
+    touch = add
+
+    def discard(self, key):
+        self._ticks.pop(key, None)
+
+    def victim(self):
+        queue, ticks = self._queue, self._ticks
+        while queue:
+            tick, key = queue[0]
+            if ticks.get(key) == tick:
+                return key
+            queue.popleft()
+        return None
+
+
+class LFUPolicy(EvictionPolicy):
+    """Evicts the least frequently used key, oldest first among equals.
+
+    Counters are logarithmic, like Redis: a read only bumps a counter
+    with probability 1 / ((counter - 1) * factor + 1), so a byte goes a
+    long way. Keys are grouped by counter, the lowest group is found
+    scanning at most MAX_COUNTER groups.
+    """
+    MAX_COUNTER = 255
+    # New keys start a bit above the bottom, so they get a chance to be
+    # read before they are evicted.
+    INITIAL = 5
+
+    def __init__(self, factor=10, random=random.random):
+        """
+        :param factor: The higher, the more reads a counter needs to go up.
+        :param random: A function returning a float in [0, 1).
+        """
+        self._factor = factor
+        self._random = random
+        self._counters = {}
+        # counter: keys with that counter, oldest first.
+        self._groups = {}
+        self._lowest = self.MAX_COUNTER
+
+    def _move(self, key, counter):
+        old = self._counters.get(key)
+        if old is not None:
+            group = self._groups[old]
+            del group[key]
+            if not group:
+                del self._groups[old]
+        self._counters[key] = counter
+        self._groups.setdefault(counter, OrderedDict())[key] = None
+        self._lowest = min(self._lowest, counter)
+
+    def add(self, key, deadline=None):
+        self._move(key, self.INITIAL)
+
+    def update(self, key, deadline=None):
+        self.touch(key)
+
+    def touch(self, key):
+        counter = self._counters.get(key)
+        if counter is None or counter == self.MAX_COUNTER:
+            return
+        base = max(counter - self.INITIAL, 0)
+        if self._random() < 1.0 / (base * self._factor + 1):
+            self._move(key, counter + 1)
+
+    def discard(self, key):
+        counter = self._counters.pop(key, None)
+        if counter is None:
+            return
+        group = self._groups[counter]
+        del group[key]
+        if not group:
+            del self._groups[counter]
+
+    def victim(self):
+        if not self._counters:
+            self._lowest = self.MAX_COUNTER
+            return None
+        while self._lowest not in self._groups:
+            self._lowest += 1
+        for key in self._groups[self._lowest]:
+            return key
+
+
+class TTLPolicy(EvictionPolicy):
+    """Evicts the key closest to expiring. Keys that never expire go
+    after them, least recently used first.
+    """
+    def __init__(self):
+        self._deadlines = {}
+        self._heap = []
+        self._lru = LRUPolicy()
+
+    def add(self, key, deadline=None):
+        if deadline is None:
+            self._deadlines.pop(key, None)
+            self._lru.add(key)
+        else:
+            self._lru.discard(key)
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+
+        # Keys set again and again leave stale entries behind, see
+        # `InMemoryCache.expire`.
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [
+                (deadline, key)
+                for key, deadline in self._deadlines.iteritems()]
+            heapq.heapify(self._heap)
+
+    def update(self, key, deadline=None):
+        self.add(key, deadline)
+
+    def touch(self, key):
+        if key not in self._deadlines:
+            self._lru.touch(key)
+
+    def discard(self, key):
+        self._deadlines.pop(key, None)
+        self._lru.discard(key)
+
+    def victim(self):
+        heap = self._heap
+        # Entries of keys removed or set again are dropped on the way.
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][1]
+        return self._lru.victim()
+
+
+POLICIES = {LRU: LRUPolicy, LFU: LFUPolicy, TTL: TTLPolicy}
+
+
+def get_policy(policy):
+    """Returns a policy out of its name, or the policy itself.
+
+    :param policy: 'lru', 'lfu', 'ttl' or an `EvictionPolicy`.
+    """
+    if isinstance(policy, EvictionPolicy):
+        return policy
+    try:
+        return POLICIES[policy]()
+    except KeyError:
+        raise ValueError('Eviction policy must be one of {}.'.format(
+            ', '.join(sorted(POLICIES))))
@@ -3,3 +3,33 @@
 
 class ZeroNodeError(Exception):
     pass
+
+
+class QuorumError(Exception):
+    """Not enough replicas answered to satisfy a consistency level."""
+    pass
+
+
+class ConsistencyLevelError(ValueError):
+    """The consistency level is not ONE, QUORUM, ALL or an integer."""
+    pass
+
+
+class RequestTimeoutError(Exception):
+    """A reply didn't arrive in time."""
+    pass
+
+
+class PoolExhaustedError(Exception):
+    """Every connection of a pool is in use."""
+    pass
+
+
+class ReplicationQueueFullError(Exception):
+    """The replication queue of a node is full."""
+    pass
+
+
+class BackpressureError(Exception):
+    """A replica can't take more writes right now, try again later."""
+    pass
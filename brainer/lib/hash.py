@@ -1,6 +1,26 @@
 # -*- coding: utf8 -*-
+from __future__ import print_function
+
 import bisect
 import hashlib
+import struct
+
+# Virtual nodes per machine used by `HashRing` unless told otherwise.
+DEFAULT_VNODES = 160
+
+# Ring positions are in the range [0, RING_SIZE).
+RING_SIZE = 2 ** 64
+
+# Node ids are '<group>/<name>' for nodes sharing a machine, like the
+# workers of `run_node --workers`. See `group_of`.
+GROUP_SEPARATOR = '/'
+
+_uint64 = struct.Struct('>Q')
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
 
 
 def my_hash(key):
@@ -8,20 +28,48 @@ def my_hash(key):
     return (int(hashlib.md5(key).hexdigest(), 16) % 1000000) / 1000000.0
 
 
+def hash64(key):
+    '''hash64(key) returns a hash in the range [0, 2**64).
+
+    It takes the first 8 bytes of the md5 digest as an unsigned
+    integer, which avoids the hexdigest/int round trip of `my_hash`
+    and gives the full 64-bit resolution.'''
+    if isinstance(key, text_type):
+        key = key.encode('utf8')
+    return _uint64.unpack_from(hashlib.md5(key).digest())[0]
+
+
+def group_of(node):
+    '''Returns the group of a node id: what comes before the first
+    GROUP_SEPARATOR, or the whole id.'''
+    return node.split(GROUP_SEPARATOR, 1)[0]
+
+
+def search_sorted(points, values):
+    '''Returns, for every value, the index of the first point >= value,
+    cycling back to 0 past the last point. Like numpy's searchsorted,
+    with the names looked up once for the whole list.'''
+    size = len(points)
+    bisect_left = bisect.bisect_left
+    return [bisect_left(points, value) % size for value in values]
+
+
 class ConsistentHash(object):
     '''ConsistentHash(n,r) creates a consistent hash object for a
     cluster of size n, using r replicas.
 
-    It has three attributes. num_machines and num_replics are
+    It has four attributes. num_machines and num_replics are
     self-explanatory.  hash_tuples is a list of tuples (j,k,hash),
     where j ranges over machine numbers (0...n-1), k ranges over
     replicas (0...r-1), and hash is the corresponding hash value,
     in the range [0,1).  The tuples are sorted by increasing hash
-    value.
+    value. hash_values is the sorted list of those hash values alone,
+    precomputed so a lookup is a single bisect.
 
-    The class has a single instance method, get_machine(key), which
+    The class has two instance methods, get_machine(key), which
     returns the number of the machine to which key should be
-    mapped.'''
+    mapped, and get_machines(keys), which does the same for many
+    keys at once.'''
 
     def __init__(self, num_machines=1, num_replicas=1):
         if num_replicas <= 0 or num_machines <= 0:
@@ -35,29 +83,194 @@ class ConsistentHash(object):
         # Sort the hash tuples based on just the hash values
         hash_tuples.sort(lambda x, y: cmp(x[2], y[2]))
         self.hash_tuples = hash_tuples
+        self.hash_values = [h for (_, _, h) in hash_tuples]
+        self._machines = [j for (j, _, _) in hash_tuples]
 
     def get_machine(self, key):
         '''Returns the number of the machine which key gets sent to.'''
-        h = my_hash(key)
+        index = bisect.bisect_left(self.hash_values, my_hash(key))
         # edge case where we cycle past hash value of 1 and back to 0.
-        if h > self.hash_tuples[-1][2]:
-            return self.hash_tuples[0][0]
-        hash_values = map(lambda x: x[2], self.hash_tuples)
-        index = bisect.bisect_left(hash_values, h)
-        return self.hash_tuples[index][0]
+        if index == len(self.hash_values):
+            index = 0
+        return self._machines[index]
+
+    def get_machines(self, keys):
+        '''Returns the machine numbers for a list of keys, in order.'''
+        machines, values = self._machines, self.hash_values
+        size = len(values)
+        bisect_left = bisect.bisect_left
+        return [machines[bisect_left(values, my_hash(key)) % size]
+                for key in keys]
+
+
+class HashRing(object):
+    '''HashRing(nodes, vnodes) creates a consistent hash ring where
+    every node owns `vnodes` points spread over the [0, 2**64) space.
+
+    Unlike `ConsistentHash`, points are derived from the node names
+    and not from their position in a list, so adding or removing a
+    node only moves the keys that fall in the ranges of that node.
+
+    `points` is the sorted list of ring positions and `owners` holds,
+    for each position, the node that owns it. Replicas of a key are
+    always taken from different groups (see `group_of`), so `groups`
+    is how many replicas a key can have. The hash function is
+    pluggable through `hash_function`; it must map a string to an
+    integer in the range [0, 2**64).'''
+
+    def __init__(self, nodes, vnodes=DEFAULT_VNODES, hash_function=hash64):
+        if vnodes <= 0 or not nodes:
+            raise ValueError('Nodes and Virtual Nodes must be 1 or more')
+
+        self.nodes = tuple(nodes)
+        self.vnodes = vnodes
+        self.hash_function = hash_function
+        ring = sorted(
+            (hash_function('{}-{}'.format(node, k)), node)
+            for node in self.nodes
+            for k in range(vnodes))
+        self.points = [point for (point, _) in ring]
+        self.owners = [node for (_, node) in ring]
+        self._groups = dict((node, group_of(node)) for node in self.nodes)
+        self.groups = frozenset(self._groups.values())
+        # (index, count): replicas. Filled in lazily by `_walk`.
+        self._replicas = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def get_node(self, key):
+        '''Returns the node which key gets sent to.'''
+        index = bisect.bisect_left(self.points, self.hash_function(key))
+        # Past the last point we cycle back to the first one.
+        if index == len(self.points):
+            index = 0
+        return self.owners[index]
+
+    def get_nodes(self, keys):
+        '''Returns the nodes for a list of keys, in order.'''
+        owners, points = self.owners, self.points
+        size = len(points)
+        hash_function, bisect_left = self.hash_function, bisect.bisect_left
+        return [owners[bisect_left(points, hash_function(key)) % size]
+                for key in keys]
+
+    def get_replicas(self, key, count):
+        '''Returns the `count` nodes of distinct groups found walking
+        the ring clockwise from key. The first one is the node `get_node`
+        returns, the others are its successors.'''
+        index = bisect.bisect_left(self.points, self.hash_function(key))
+        return self._walk(index, count)
+
+    def get_replicas_many(self, keys, count):
+        '''Returns the replicas for a list of keys, in order.'''
+        hash_function, walk = self.hash_function, self._walk
+        return [walk(i, count) for i in search_sorted(
+            self.points, [hash_function(key) for key in keys])]
+
+    def _walk(self, index, count):
+        size = len(self.points)
+        index %= size
+        count = min(count, len(self.groups))
+        replicas = self._replicas.get((index, count))
+        if replicas is not None:
+            return replicas
+
+        replicas, groups = [], set()
+        position = index
+        while len(replicas) < count:
+            node = self.owners[position % size]
+            if self._groups[node] not in groups:
+                groups.add(self._groups[node])
+                replicas.append(node)
+            position += 1
+
+        self._replicas[(index, count)] = replicas
+        return replicas
+
+
+
+def moved_ranges(old, new, count):
+    '''Returns the hash ranges every node must copy when the ring goes
+    from `old` to `new`, with `count` replicas per key, and where to
+    copy them from.
+
+    The result is a dict of node: {source: ranges}. A range is a
+    [start, end] pair holding the hashes h where start < h <= end,
+    ranges are sorted. Every range comes from a single source, a node
+    which held it in `old` and is still in `new`, so copies are spread
+    over the previous owners. Ranges no remaining node held are left
+    out.'''
+    points = sorted(set(old.points) | set(new.points))
+    points.append(RING_SIZE - 1)
+    alive = set(new.nodes)
+    moves = {}
+
+    start = -1
+    for end in points:
+        # No point of either ring falls inside (start, end], so the
+        # whole range has the replicas of its end.
+        old_replicas = old._walk(bisect.bisect_left(old.points, end), count)
+        new_replicas = new._walk(bisect.bisect_left(new.points, end), count)
+        sources = [node for node in old_replicas if node in alive]
+        for node in new_replicas:
+            if node in old_replicas or not sources:
+                continue
+            ranges = moves.setdefault(node, {}).setdefault(sources[0], [])
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        start = end
+
+    return moves
+
+
+def shared_ranges(ring, count, nodes):
+    '''Returns the hash ranges every one of some nodes is a replica of,
+    with `count` replicas per key, sorted and in the format of
+    `moved_ranges`.'''
+    points = list(ring.points)
+    points.append(RING_SIZE - 1)
+    ranges = []
+
+    start = -1
+    for index, end in enumerate(points):
+        replicas = ring._walk(index, count)
+        if all(node in replicas for node in nodes):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        start = end
+
+    return ranges
+
+
+def keys_in_ranges(keys, ranges, hash_function=hash64):
+    '''Returns the keys whose hash falls in one of the sorted ranges
+    returned by `moved_ranges`, in order.'''
+    ends = [end for _, end in ranges]
+    found = []
+    for key in keys:
+        value = hash_function(key)
+        index = bisect.bisect_left(ends, value)
+        if index < len(ranges) and ranges[index][0] < value:
+            found.append(key)
+    return found
 
 
 def main():
     ch = ConsistentHash(7, 3)
-    print "Format:"
-    print "(machine,replica,hash value):"
+    print("Format:")
+    print("(machine,replica,hash value):")
     for (j, k, h) in ch.hash_tuples:
-        print "(%s, %s, %s)" % (j, k, h)
+        print("(%s, %s, %s)" % (j, k, h))
     while True:
-        print "\nPlease enter a key:"
+        print("\nPlease enter a key:")
         key = raw_input()
-        print "\nKey %s maps to hash %s, and so to machine %s" \
-            % (key, my_hash(key), ch.get_machine(key))
+        print("\nKey %s maps to hash %s, and so to machine %s"
+              % (key, my_hash(key), ch.get_machine(key)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+# -*- coding: utf8 -*-
+import bisect
+from collections import OrderedDict
+
+import umsgpack
+
+from brainer.lib.hash import hash64
+
+# Leaves are 2 ** DEFAULT_DEPTH ranges of the 64-bit key hash space.
+DEFAULT_DEPTH = 10
+
+# Trees over hash ranges kept next to a tree, see `MerkleTree.view`.
+MAX_VIEWS = 32
+
+
+def item_digest(key, value, version=None):
+    """Returns the digest of a key-value pair. Versioned pairs are
+    digested by their version, every write gets a different one.
+
+    :param key: The key.
+    :param value: The value.
+    :param version: The write version, if any.
+    """
+    if version is not None:
+        return hash64(umsgpack.packb([key, version]))
+    return hash64(umsgpack.packb([key, value]))
+
+
+class MerkleTree(object):
+    """A Merkle tree over ranges of the key hash space.
+
+    Every leaf holds the keys whose hash falls in its range, its digest
+    is the XOR of their item digests. Every inner node is the XOR of its
+    children. XOR makes updates incremental: changing a key only touches
+    the `depth` nodes above its leaf.
+
+    Nodes are stored as a heap: the root is 1, the children of i are
+    2i and 2i + 1. Index i of a level is node 2 ** level + i.
+
+    Replicas holding only some ranges of the ring in common compare
+    views, trees over the keys in those ranges only (see `view`).
+    """
+    def __init__(self, depth=DEFAULT_DEPTH, track_keys=True):
+        """
+        :param depth: How many levels below the root.
+        :param track_keys: Whether to keep the keys of every leaf, for
+        `keys`. Caches that can find them on their own save the memory.
+        """
+        self.depth = depth
+        self._nodes = [0] * (2 ** (depth + 1))
+        self._keys = {} if track_keys else None
+        # ranges: view over them, least recently used first.
+        self._views = OrderedDict()
+        # The starts and ends of the ranges of every view, sorted, and
+        # for the hashes up to each of them, the views they are in.
+        self._bounds = []
+        self._covering = [()]
+
+    @classmethod
+    def build(cls, items, depth=DEFAULT_DEPTH):
+        """Builds a tree out of (key, digest) pairs.
+
+        :param items: An iterable of (key, digest) pairs.
+        :param depth: See `__init__`.
+        """
+        tree = cls(depth)
+        for key, digest in items:
+            tree.update(key, None, digest)
+        return tree
+
+    def bucket(self, key):
+        """Returns the leaf index of a key.
+
+        :param key: The key.
+        """
+        return hash64(key) >> (64 - self.depth)
+
+    def update(self, key, old, new):
+        """Replaces the digest of a key.
+
+        :param key: The key.
+        :param old: The digest the key had, None if it is new.
+        :param new: The digest it has now, None if it was removed.
+        """
+        value = hash64(key)
+        bucket = value >> (64 - self.depth)
+        delta = (old or 0) ^ (new or 0)
+
+        if self._keys is not None:
+            self._track(bucket, key, old, new)
+
+        if not delta:
+            return
+
+        self._apply(bucket, delta)
+        if self._views:
+            for view in self._covering[bisect.bisect_left(
+                    self._bounds, value)]:
+                view._apply(bucket, delta)
+
+    def _apply(self, bucket, delta):
+        index = 2 ** self.depth + bucket
+        nodes = self._nodes
+        while index:
+            nodes[index] ^= delta
+            index >>= 1
+
+    def _track(self, bucket, key, old, new):
+        if old is None and new is not None:
+            self._keys.setdefault(bucket, set()).add(key)
+        elif new is None and old is not None:
+            keys = self._keys.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[bucket]
+
+    def view(self, ranges, keys, digest):
+        """Returns a tree over the keys whose hash falls in some ranges,
+        updated along with this one. It is built the first time the
+        ranges are asked for, and dropped once `MAX_VIEWS` others have
+        been asked for since.
+
+        :param ranges: Sorted [start, end] pairs, holding the hashes h
+        where start < h <= end (see `brainer.lib.hash.moved_ranges`).
+        :param keys: A function returning every key in this tree, to
+        build the view out of.
+        :param digest: A function returning the digest of a key.
+        """
+        ranges = tuple((start, end) for start, end in ranges)
+        view = self._views.pop(ranges, None)
+        if view is not None:
+            self._views[ranges] = view
+            return view
+
+        view = MerkleTree(self.depth, track_keys=False)
+        starts = [start for start, _ in ranges]
+        for key in keys():
+            value = hash64(key)
+            index = bisect.bisect_left(starts, value) - 1
+            if index >= 0 and value <= ranges[index][1]:
+                view._apply(value >> (64 - self.depth), digest(key))
+
+        self._views[ranges] = view
+        while len(self._views) > MAX_VIEWS:
+            self._views.popitem(last=False)
+        self._index_views()
+        return view
+
+    def _index_views(self):
+        bounds = set()
+        for ranges in self._views:
+            for start, end in ranges:
+                bounds.update((start, end))
+        self._bounds = sorted(bounds)
+        position = dict((bound, index)
+                        for index, bound in enumerate(self._bounds))
+
+        covering = [[] for _ in range(len(self._bounds) + 1)]
+        for ranges, view in self._views.iteritems():
+            for start, end in ranges:
+                # Hashes up to bound i, and past bound i - 1.
+                for index in range(position[start] + 1, position[end] + 1):
+                    covering[index].append(view)
+        self._covering = covering
+
+    def digests(self, level, indexes=None):
+        """Returns the digests of some nodes of a level.
+
+        :param level: 0 is the root, `depth` the leaves.
+        :param indexes: The node indexes in the level. Defaults to all.
+        """
+        first = 2 ** level
+        if indexes is None:
+            return self._nodes[first:2 * first]
+        return [self._nodes[first + index] for index in indexes]
+
+    def keys(self, buckets):
+        """Returns the keys in some leaves.
+
+        :param buckets: Leaf indexes.
+        """
+        keys = []
+        for bucket in buckets:
+            keys.extend(self._keys.get(bucket, ()))
+        return keys
@@ -0,0 +1,653 @@
+# -*- coding: utf8 -*-
+"""Durable caches, see `AppendOnlyCache` and `MappedCache`.
+"""
+import collections
+import itertools
+import mmap
+import os
+import struct
+import time
+
+import umsgpack
+from twisted.internet import reactor, task
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+from brainer.lib.cache import InMemoryCache, BoundedCache
+from brainer.lib.clock import monotonic
+from brainer.lib.hash import hash64
+from brainer.lib.merkle import item_digest
+
+ALWAYS = 'always'
+EVERYSEC = 'everysec'
+NEVER = 'never'
+FSYNC_POLICIES = (ALWAYS, EVERYSEC, NEVER)
+
+SET = 0
+REMOVE = 1
+# The id of the node the writes after it are for, see `claim`.
+OWNER = 2
+
+# Every record is its length followed by a msgpack list, so a record cut
+# short by a crash can be told apart and dropped.
+HEADER = struct.Struct('>I')
+
+_missing = object()
+
+
+def pack_record(record):
+    data = umsgpack.packb(record)
+    return HEADER.pack(len(data)) + data
+
+
+def read_records(path):
+    """Yields the records of a log and, last, the offset where the valid
+    records end.
+
+    :param path: The log file.
+    """
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            size, = HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                break
+            try:
+                record = umsgpack.unpackb(data)
+            except umsgpack.UnpackException:
+                break
+            yield record
+            offset += HEADER.size + size
+    yield offset
+
+
+def rewrite_log(path, owner, data, expiration, versions, offset, buffer):
+    """Writes a set record for every key into a new log, then the records
+    in `buffer`, syncs it and moves it over the log at `path`. Runs in a
+    thread, while the reactor goes on changing the dicts and adding to
+    the buffer: every write since the buffer was started is in it, so
+    keys read halfway through a write are fixed by the records after.
+
+    :param path: The log to replace.
+    :param owner: The id of the node the log is for, if known.
+    :param data: key: value.
+    :param expiration: key: `monotonic` deadline.
+    :param versions: key: version.
+    :param offset: Turns `monotonic` deadlines into `time.time` ones.
+    :param buffer: A list of packed records, appended to meanwhile.
+    :returns: The size of the file, and how many buffered records it
+    holds.
+    """
+    size = 0
+    rewrite = path + '.rewrite'
+    with open(rewrite, 'wb') as f:
+        if owner is not None:
+            record = pack_record([OWNER, owner])
+            f.write(record)
+            size += len(record)
+        # Copying the keys is a single step for the interpreter, the
+        # dicts can't change halfway through.
+        for key in list(data):
+            value = data.get(key, _missing)
+            if value is _missing:
+                continue
+            deadline = expiration.get(key)
+            if deadline is not None:
+                deadline += offset
+            record = pack_record(
+                [SET, key, value, deadline, versions.get(key)])
+            f.write(record)
+            size += len(record)
+
+        records = buffer[:]
+        for record in records:
+            f.write(record)
+            size += len(record)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(rewrite, path)
+    return size, len(records)
+
+
+class AppendOnlyCache(InMemoryCache):
+    """An `InMemoryCache` that appends every set and remove to a log on
+    disk, and replays it on startup.
+
+    The log is compacted in the background once it grows past
+    `compact_growth` times its size after the last compaction: the keys
+    and the writes made meanwhile are written to a new log in a thread,
+    which replaces the old one. The reactor only appends the writes
+    made after the thread was done, and switches logs. A crash before
+    the switch loses those few writes, whatever the fsync policy.
+
+    `sequence` is the highest write version replayed from the log, so
+    the node can pull the writes made since from its peers. `owner` is
+    the id of the node the log is for, see `claim`.
+    """
+    def __init__(self, path, fsync=EVERYSEC, compact_min_size=64 * 2**20,
+                 compact_growth=2, clock=reactor, **kwargs):
+        """
+        :param path: The log file, created if missing.
+        :param fsync: When to sync the log to disk: 'always' (every write,
+        slow), 'everysec' (every second, in a thread) or 'never' (leave it
+        to the operating system).
+        :param compact_min_size: Never compact logs smaller than this, in
+        bytes. Defaults to 64MB.
+        :param compact_growth: Compact when the log is this many times
+        larger than after the last compaction. Defaults to 2.
+        :param clock: Something providing IReactorTime, for the timer
+        syncing and compacting the log.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of {}.'.format(
+                ', '.join(FSYNC_POLICIES)))
+
+        super(AppendOnlyCache, self).__init__(**kwargs)
+        self._path = path
+        self._fsync = fsync
+        self._compact_min_size = compact_min_size
+        self._compact_growth = compact_growth
+        self._clock = clock
+        # Records written while compacting, to append to the new log.
+        self._rewrite_buffer = None
+        self._compacting = None
+        self._syncing = False
+        self.sequence = None
+        self.owner = None
+
+        self._log = None
+        self.load()
+        self._log = open(path, 'ab')
+        self._size = self._base_size = self._log.tell()
+
+        self._timer = task.LoopingCall(self.tick)
+        self._timer.clock = clock
+        self._timer.start(1, now=False)
+
+    def load(self):
+        """Replays the log into the cache, if there is one. A record cut
+        short at the end (the process died writing it) is dropped.
+        """
+        if not os.path.exists(self._path):
+            return
+
+        now = time.time()
+        data, expiration, versions = {}, {}, {}
+        offset = 0
+        for record in read_records(self._path):
+            if not isinstance(record, list):
+                offset = record
+                break
+            if record[0] == OWNER:
+                self.owner = record[1]
+                continue
+            key = record[1]
+            data.pop(key, None)
+            expiration.pop(key, None)
+            versions.pop(key, None)
+            if record[0] != SET:
+                continue
+            value, deadline, version = record[2:]
+            if deadline is not None:
+                if deadline <= now:
+                    continue
+                expiration[key] = deadline - now
+            data[key] = value
+            if version is not None:
+                versions[key] = version
+                if self.sequence is None or version > self.sequence:
+                    self.sequence = version
+
+        if offset < os.path.getsize(self._path):
+            log.msg('Dropping a broken record at the end of {}.'.format(
+                self._path))
+            with open(self._path, 'r+b') as f:
+                f.truncate(offset)
+
+        super(AppendOnlyCache, self).replay(
+            {'data': data, 'expiration': expiration, 'version': versions})
+
+    def _append(self, record):
+        if self._log is None:
+            return
+        record = pack_record(record)
+        self._log.write(record)
+        self._size += len(record)
+        if self._rewrite_buffer is not None:
+            self._rewrite_buffer.append(record)
+        if self._fsync == ALWAYS:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def claim(self, owner):
+        """Records the id of the node the log is for from now on, so a
+        node restarting under another id can tell the writes are not all
+        it missed.
+
+        :param owner: A node id.
+        """
+        if owner != self.owner:
+            self.owner = owner
+            self._append([OWNER, owner])
+
+    def _append_set(self, key):
+        deadline = self._expiration.get(key)
+        if deadline is not None:
+            deadline += time.time() - monotonic()
+        self._append([SET, key, self._cache[key], deadline,
+                      self._versions.get(key)])
+
+    def set(self, key, value, expires=None, version=None):
+        result = super(AppendOnlyCache, self).set(
+            key, value, expires=expires, version=version)
+        if key in self._cache:
+            self._append_set(key)
+        return result
+
+    def remove(self, key, version=None):
+        removed = super(AppendOnlyCache, self).remove(key, version=version)
+        if removed:
+            self._append([REMOVE, key])
+        return removed
+
+    def replay(self, snapshot, update=False):
+        """Replays a snapshot, see `InMemoryCache.replay`, and logs it.
+        Replacing the whole cache compacts the log right away.
+        """
+        super(AppendOnlyCache, self).replay(snapshot, update=update)
+        if not update:
+            if self._compacting is None:
+                self.compact()
+            else:
+                # The running compaction reads the dicts just replaced.
+                self._compacting.addBoth(lambda _: self.compact())
+            return
+        for key in snapshot['data']:
+            if key in self._cache:
+                self._append_set(key)
+
+    def tick(self):
+        """Called every second: hands the log to the operating system,
+        syncs it if the policy says so, and compacts it when due.
+        """
+        self._log.flush()
+        if self._fsync == EVERYSEC and not self._syncing:
+            # A copy of the descriptor, so compaction can close the log
+            # while the thread syncs it.
+            fd = os.dup(self._log.fileno())
+            self._syncing = True
+            d = deferToThread(os.fsync, fd)
+            d.addErrback(log.err, 'Syncing {} failed.'.format(self._path))
+            d.addBoth(lambda _: self._synced(fd))
+
+        if (self._size >= self._compact_min_size and
+                self._size >= self._base_size * self._compact_growth):
+            self.compact()
+
+    def _synced(self, fd):
+        os.close(fd)
+        self._syncing = False
+
+    def compact(self):
+        """Rewrites the log with only the current keys, in a thread.
+
+        :returns: A deferred firing once the new log is in place. If a
+        compaction is running already, that one's.
+        """
+        if self._compacting is not None:
+            return self._compacting
+
+        self._rewrite_buffer = []
+        d = self._compacting = deferToThread(
+            rewrite_log, self._path, self.owner, self._cache,
+            self._expiration, self._versions, time.time() - monotonic(),
+            self._rewrite_buffer)
+        d.addCallbacks(self._compacted, self._compaction_failed)
+        return d
+
+    def _compacted(self, result):
+        size, written = result
+        new_log = open(self._path, 'ab')
+        for record in self._rewrite_buffer[written:]:
+            new_log.write(record)
+            size += len(record)
+        if self._fsync == ALWAYS:
+            new_log.flush()
+            os.fsync(new_log.fileno())
+        self._log.close()
+        self._log = new_log
+        self._size = self._base_size = size
+        self._rewrite_buffer = None
+        self._compacting = None
+
+    def _compaction_failed(self, failure):
+        log.err(failure, 'Compacting {} failed.'.format(self._path))
+        self._rewrite_buffer = None
+        self._compacting = None
+        if os.path.exists(self._path + '.rewrite'):
+            os.remove(self._path + '.rewrite')
+
+    def close(self):
+        """Stops the timer, and flushes and syncs the log.
+        """
+        if self._timer.running:
+            self._timer.stop()
+        self._log.flush()
+        if self._fsync != NEVER:
+            os.fsync(self._log.fileno())
+        self._log.close()
+
+
+class BoundedAppendOnlyCache(AppendOnlyCache, BoundedCache):
+    """An `AppendOnlyCache` with the limits of a `BoundedCache`.
+    """
+
+
+MAGIC = 'BRAINER2'
+# index offset, index size, sequence (-1 for none), owner size, magic.
+# The owner, utf8, comes right before the footer.
+FOOTER = struct.Struct('>QQqH8s')
+# flags, key size, value offset, value size, deadline, version.
+ENTRY = struct.Struct('>BHQIdq')
+UNICODE_KEY = 1
+HAS_DEADLINE = 2
+HAS_VERSION = 4
+
+
+class SnapshotFile(object):
+    """A snapshot file, memory-mapped. Values are packed one after the
+    other, followed by an index of keys, their expirations and versions,
+    so only the index is read on load.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < FOOTER.size + len(MAGIC):
+            raise ValueError('{} is not a snapshot file.'.format(path))
+        end = len(self._map) - FOOTER.size
+        self._index_offset, self._index_size, sequence, owner_size, magic = (
+            FOOTER.unpack_from(self._map, end))
+        if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a snapshot file.'.format(path))
+        self.sequence = sequence if sequence >= 0 else None
+        self.owner = None
+        if owner_size:
+            self.owner = self._map[end - owner_size:end].decode('utf8')
+
+    def index(self):
+        """Yields key, offset, size, deadline (`time.time`) and version
+        of every value.
+        """
+        buf = self._map
+        position = self._index_offset
+        end = position + self._index_size
+        while position < end:
+            flags, key_size, offset, size, deadline, version = (
+                ENTRY.unpack_from(buf, position))
+            position += ENTRY.size
+            key = buf[position:position + key_size]
+            position += key_size
+            if flags & UNICODE_KEY:
+                key = key.decode('utf8')
+            yield (key, offset, size,
+                   deadline if flags & HAS_DEADLINE else None,
+                   version if flags & HAS_VERSION else None)
+
+    def raw(self, offset, size):
+        """Returns a value, still packed.
+        """
+        return self._map[offset:offset + size]
+
+    def value(self, offset, size):
+        return umsgpack.unpackb(self._map[offset:offset + size])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def write_snapshot_file(path, values, raw, source, expiration, versions,
+                        offset, sequence, owner=None):
+    """Writes a snapshot file (see `SnapshotFile`) next to `path` and
+    renames it over, so a crash never leaves a half written one. Runs in
+    a thread, the arguments must not change meanwhile.
+
+    :param path: The file to write.
+    :param values: key: value, for values to pack.
+    :param raw: key: (offset, size) in `source`, for values to copy as is.
+    :param source: The `SnapshotFile` the raw values are in.
+    :param expiration: key: `monotonic` deadline.
+    :param versions: key: version.
+    :param offset: Turns `monotonic` deadlines into `time.time` ones.
+    :param sequence: The last sequence number (write version) applied.
+    :param owner: The id of the node the snapshot is for, if known.
+    :returns: key: (offset, size) in the new file, for the raw values.
+    """
+    moved = {}
+    index = []
+    position = len(MAGIC)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+
+        def write(key, data):
+            size = len(data)
+            f.write(data)
+            deadline = expiration.get(key)
+            version = versions.get(key)
+            flags = 0
+            if isinstance(key, unicode):
+                flags |= UNICODE_KEY
+                key = key.encode('utf8')
+            if deadline is not None:
+                flags |= HAS_DEADLINE
+                deadline += offset
+            if version is not None:
+                flags |= HAS_VERSION
+            index.append(ENTRY.pack(
+                flags, len(key), position, size, deadline or 0,
+                version or 0))
+            index.append(key)
+            return size
+
+        for key, value in values.iteritems():
+            position += write(key, umsgpack.packb(value))
+        for key, (value_offset, size) in raw.iteritems():
+            moved[key] = (position, size)
+            position += write(key, source.raw(value_offset, size))
+
+        index = ''.join(index)
+        f.write(index)
+        owner = (owner or u'').encode('utf8')
+        f.write(owner)
+        f.write(FOOTER.pack(
+            position, len(index), -1 if sequence is None else sequence,
+            len(owner), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    return moved
+
+
+class MappedValues(collections.MutableMapping):
+    """The values of a `MappedCache`. Values still in the snapshot file
+    are unpacked the first time they are read, and kept.
+    """
+    def __init__(self, source=None, index=None):
+        """
+        :param source: A `SnapshotFile`.
+        :param index: key: (offset, size) in the source.
+        """
+        self._values = {}
+        self._source = source
+        self._index = index or {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        offset, size = self._index.pop(key)
+        value = self._values[key] = self._source.value(offset, size)
+        return value
+
+    def __setitem__(self, key, value):
+        self._index.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if self._index.pop(key, None) is None:
+            del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._index
+
+    def __iter__(self):
+        return itertools.chain(self._values, self._index)
+
+    def __len__(self):
+        return len(self._values) + len(self._index)
+
+    def packed(self, key):
+        """Returns a value not loaded yet as it is in the file, packed.
+        None if it is loaded, or not there.
+        """
+        location = self._index.get(key)
+        if location is not None:
+            return self._source.raw(*location)
+
+    def __repr__(self):
+        return '<MappedValues: {} keys, {} not loaded>'.format(
+            len(self), len(self._index))
+
+    def remap(self, source, moved):
+        """Points the values not loaded yet to a new snapshot file.
+
+        :param moved: key: (offset, size) in the new file, for at least
+        every value not loaded yet.
+        """
+        old, self._source = self._source, source
+        for key in self._index:
+            self._index[key] = moved[key]
+        if old is not None:
+            old.close()
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+
+
+class MappedCache(InMemoryCache):
+    """An `InMemoryCache` that writes snapshots of itself to a file (see
+    `dump`), and starts from the last one, memory-mapped: keys can be
+    served right away, values are only read from the file when needed.
+
+    `sequence` is the last sequence number (write version) the snapshot
+    holds, so the node can pull the writes made since from its peers.
+    `owner` is the id of the node the snapshot is for, see `claim`.
+    """
+    def __init__(self, path, **kwargs):
+        """
+        :param path: The snapshot file, loaded if it exists.
+        """
+        super(MappedCache, self).__init__(**kwargs)
+        self._path = path
+        self._dumping = None
+        self.sequence = None
+        self.owner = None
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        source = SnapshotFile(self._path)
+        now = time.time()
+        index, expiration, versions = {}, {}, {}
+        for key, offset, size, deadline, version in source.index():
+            if deadline is not None:
+                if deadline <= now:
+                    continue
+                expiration[key] = deadline - now
+            index[key] = (offset, size)
+            if version is not None:
+                versions[key] = version
+
+        super(MappedCache, self).replay({
+            'data': MappedValues(source, index),
+            'expiration': expiration, 'version': versions})
+        self.sequence = source.sequence
+        self.owner = source.owner
+        log.msg('Mapped {} keys from {}, up to sequence {}.'.format(
+            len(index), self._path, self.sequence))
+
+    def digest(self, key):
+        """See `InMemoryCache.digest`. Values aren't loaded for it.
+        """
+        if key not in self._cache:
+            return super(MappedCache, self).digest(key)
+        version = self._versions.get(key)
+        if version is not None:
+            return item_digest(key, None, version)
+        if isinstance(self._cache, MappedValues):
+            packed = self._cache.packed(key)
+            if packed is not None:
+                # What item_digest hashes, [key, value] packed.
+                return hash64('\x92' + umsgpack.packb(key) + packed)
+        return super(MappedCache, self).digest(key)
+
+    def snapshot(self):
+        snapshot = super(MappedCache, self).snapshot()
+        snapshot['data'] = dict(snapshot['data'])
+        return snapshot
+
+    def dump(self, sequence=None):
+        """Writes a snapshot of the cache, in a thread. Values not loaded
+        from the previous snapshot are copied without unpacking them.
+
+        :param sequence: The last sequence number applied, see `sequence`.
+        :returns: A deferred firing when done. If a dump is running
+        already, that one's.
+        """
+        if self._dumping is not None:
+            return self._dumping
+
+        values = self._cache
+        if isinstance(values, MappedValues):
+            source, raw = values._source, dict(values._index)
+            values = dict(values._values)
+        else:
+            source, raw = None, {}
+            values = dict(values)
+
+        d = self._dumping = deferToThread(
+            write_snapshot_file, self._path, values, raw, source,
+            dict(self._expiration), dict(self._versions),
+            time.time() - monotonic(), sequence, self.owner)
+        d.addCallbacks(self._dumped, self._dump_failed)
+        return d
+
+    def claim(self, owner):
+        """Records the id of the node the snapshots are for from now on,
+        see `AppendOnlyCache.claim`.
+
+        :param owner: A node id.
+        """
+        self.owner = owner
+
+    def _dumped(self, moved):
+        self._dumping = None
+        if isinstance(self._cache, MappedValues) and self._cache._index:
+            self._cache.remap(SnapshotFile(self._path), moved)
+
+    def _dump_failed(self, failure):
+        log.err(failure, 'Writing a snapshot to {} failed.'.format(
+            self._path))
+        self._dumping = None
+
+    def close(self):
+        if isinstance(self._cache, MappedValues):
+            self._cache.close()
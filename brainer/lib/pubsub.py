@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+import umsgpack
+from twisted.python import log
+from txzmq import (
+    ZmqEndpoint, ZmqFactory, ZmqPubConnection, ZmqSubConnection)
+
+from brainer.lib.mixins import SerializerMixin
+
+
+class Publisher(ZmqPubConnection, SerializerMixin):
+    """A PUB socket sending packed messages under a tag.
+    """
+    def __init__(self, factory, endpoint, **kwargs):
+        self._serializer = kwargs.pop('serializer', umsgpack)
+        super(Publisher, self).__init__(factory, endpoint)
+
+    @classmethod
+    def create(cls, address, factory=None, **kwargs):
+        """Factory method to create a Publisher.
+
+        :param address: The address to bind.
+        :param factory: A `txzmq.ZmqFactory` to share with other
+        connections. Defaults to a new one.
+        """
+        if factory is None:
+            factory = ZmqFactory()
+        return cls(factory, ZmqEndpoint('bind', address), **kwargs)
+
+    def send_message(self, tag, message):
+        """Publishes a message.
+
+        :param tag: What subscribers subscribe to.
+        :param message: The message, packed before it is sent.
+        """
+        self.publish(self.pack(message), tag)
+
+
+class Subscriber(ZmqSubConnection, SerializerMixin):
+    """A SUB socket connected to one or more publishers. Every message
+    is unpacked and handed to a callback along with its tag.
+    """
+    def __init__(self, factory, endpoint, callback, **kwargs):
+        """
+        :param factory: A `txzmq.ZmqFactory` object.
+        :param endpoint: A `txzmq.ZmqEndpoint` object.
+        :param callback: Called with the tag and the message.
+        """
+        self._serializer = kwargs.pop('serializer', umsgpack)
+        self._callback = callback
+        super(Subscriber, self).__init__(factory, endpoint)
+
+    @classmethod
+    def create(cls, addresses, tags, callback, factory=None, **kwargs):
+        """Factory method to create a Subscriber.
+
+        :param addresses: The publisher addresses.
+        :param tags: The tags to subscribe to.
+        :param callback: See `__init__`.
+        :param factory: A `txzmq.ZmqFactory` to share with other
+        connections. Defaults to a new one.
+        """
+        if factory is None:
+            factory = ZmqFactory()
+        subscriber = cls(factory, None, callback, **kwargs)
+        subscriber.addEndpoints(
+            [ZmqEndpoint('connect', address) for address in addresses])
+        for tag in tags:
+            subscriber.subscribe(tag)
+        return subscriber
+
+    def gotMessage(self, message, tag):
+        try:
+            self._callback(tag, self.unpack(message))
+        except Exception:
+            log.err(None, 'Failed handling a message tagged {!r}.'.format(tag))
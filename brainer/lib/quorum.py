@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+from twisted.internet import defer
+
+from brainer.lib.exceptions import ConsistencyLevelError, QuorumError
+
+ONE = 'one'
+QUORUM = 'quorum'
+ALL = 'all'
+
+LEVELS = (ONE, QUORUM, ALL)
+
+
+def required(level, replicas):
+    """Returns how many replicas must answer for a consistency level.
+
+    :param level: ONE, QUORUM, ALL or an integer.
+    :param replicas: How many replicas hold the key.
+    """
+    if level == ONE:
+        return min(1, replicas)
+    elif level == QUORUM:
+        return replicas // 2 + 1
+    elif level == ALL:
+        return replicas
+    elif isinstance(level, (int, long)) and not isinstance(level, bool):
+        if level < 1:
+            raise ConsistencyLevelError(level)
+        return min(level, replicas)
+
+    raise ConsistencyLevelError(level)
+
+
+def gather(deferreds, needed):
+    """Returns a deferred that fires as soon as `needed` deferreds
+    succeed, with the list of their results in arrival order.
+
+    If so many of them fail that `needed` can't be reached anymore,
+    it errbacks with a `QuorumError`. Failures are consumed either way,
+    the caller is expected to have logged them.
+
+    :param deferreds: A list of deferreds.
+    :param needed: How many successes are needed.
+    """
+    result = defer.Deferred()
+    successes = []
+    failures = []
+    total = len(deferreds)
+
+    if needed <= 0:
+        result.callback([])
+        return result
+
+    def on_success(value):
+        if not result.called:
+            successes.append(value)
+            if len(successes) == needed:
+                result.callback(successes)
+        return value
+
+    def on_failure(f):
+        failures.append(f)
+        if not result.called and total - len(failures) < needed:
+            result.errback(QuorumError(
+                '{} of {} replies needed, {} failed.'.format(
+                    needed, total, len(failures))))
+
+    if total < needed:
+        result.errback(QuorumError(
+            '{} replies needed, only {} replicas.'.format(needed, total)))
+
+    for d in deferreds:
+        d.addCallbacks(on_success, on_failure)
+
+    return result
@@ -0,0 +1,33 @@
+# -*- coding: utf8 -*-
+"""Write versions, given by brokers (see `Broker.next_version`). A
+version is a timestamp in microseconds, shifted left to make room for
+the id of the broker in the low bits: brokers sharing nodes have
+different ids, so their versions never tie and the same write wins
+everywhere. Versions double as op log sequence numbers.
+"""
+
+# Bits of a version holding the broker id.
+BROKER_ID_BITS = 8
+MAX_BROKER_ID = (1 << BROKER_ID_BITS) - 1
+
+
+def make_version(micros, broker_id=0):
+    """Returns the version of a write.
+
+    :param micros: A timestamp, in microseconds.
+    :param broker_id: The id of the broker, up to `MAX_BROKER_ID`.
+    """
+    return (micros << BROKER_ID_BITS) | broker_id
+
+
+def version_micros(version):
+    """Returns the timestamp of a version, in microseconds.
+    """
+    return version >> BROKER_ID_BITS
+
+
+def version_span(seconds):
+    """Returns how far apart the versions of writes made `seconds` apart
+    are.
+    """
+    return int(seconds * 1000000) << BROKER_ID_BITS
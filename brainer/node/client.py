@@ -1,4 +1,7 @@
 # -*- coding: utf8 -*-
+import os
+import struct
+
 import umsgpack
 from twisted.python import log
 
@@ -8,21 +11,51 @@ from brainer.lib.mixins import SerializerMixin
 
 
 class NodeClient(ZmqREQConnection, SerializerMixin):
+    """A connection to a Node. It is a DEALER socket where every request
+    carries a correlation id, so many requests can be in flight at once
+    and replies are matched back whatever their order.
+
+    Nodes route replies by correlation id alone, whoever sent the
+    request, so ids are unique across connections: a random prefix
+    drawn per connection, followed by a counter.
+    """
+    _message_id = struct.Struct('>Q')
+
     def __init__(self, factory, endpoint, *args, **kwargs):
         """A Node Client.
 
         :param factory: A `txzmq.ZmqFactory` object.
         :param endpoint: A `txzmq.ZmqEndpoint` object.
+        :param high_water_mark: How many messages can be queued for the
+        node before sends start failing. Defaults to 0 (no limit).
         """
         self._serializer = kwargs.pop('serializer', umsgpack)
         self._timeout = kwargs.pop('timeout', 5)
+        self.highWaterMark = kwargs.pop('high_water_mark', 0)
+        self._nonce = os.urandom(8)
+        self._counter = 0
         super(NodeClient, self).__init__(factory, endpoint)
 
     @classmethod
-    def create(cls, address):
-        factory = ZmqFactory()
+    def create(cls, address, factory=None, **kwargs):
+        """Factory method to create a NodeClient.
+
+        :param address: The node address.
+        :param factory: A `txzmq.ZmqFactory` to share with other
+        connections. Defaults to a new one.
+        :param kwargs: See `NodeClient.__init__`.
+        """
+        if factory is None:
+            factory = ZmqFactory()
         endpoint = ZmqEndpoint('connect', address)
-        return cls(factory, endpoint)
+        return cls(factory, endpoint, **kwargs)
+
+    def _getNextId(self):
+        """Correlation ids are the connection prefix and a counter,
+        cheaper than txzmq's uuids and never reused.
+        """
+        self._counter += 1
+        return self._nonce + self._message_id.pack(self._counter)
 
     def _on_error(self, f):
         """Log a failure and re-raise it.
@@ -55,5 +88,55 @@ class NodeClient(ZmqREQConnection, SerializerMixin):
     def remove(self, message):
         return self.sendMsg(message)
 
+    def mget(self, message):
+        return self.sendMsg(message)
+
+    def mset(self, message):
+        return self.sendMsg(message)
+
+    def mremove(self, message):
+        return self.sendMsg(message)
+
+    def topology(self, version):
+        return self.sendMsg({"action": "topology", "version": version})
+
+    def ping(self):
+        return self.sendMsg({"action": "ping"})
+
     def snapshot(self):
         return self.sendMsg({"action": "snapshot"})
+
+    def snapshot_chunk(self, cursor=None, count=1000, ranges=None):
+        message = {
+            "action": "snapshot_chunk", "cursor": cursor, "count": count}
+        if ranges is not None:
+            message['ranges'] = ranges
+        return self.sendMsg(message)
+
+    def oplog(self, since, count=1000, ranges=None):
+        message = {"action": "oplog", "since": since, "count": count}
+        if ranges is not None:
+            message['ranges'] = ranges
+        return self.sendMsg(message)
+
+    def merkle(self, level, indexes=None, ranges=None):
+        message = {"action": "merkle", "level": level, "indexes": indexes}
+        if ranges is not None:
+            message['ranges'] = ranges
+        return self.sendMsg(message)
+
+    def merkle_range(self, buckets, ranges=None):
+        message = {"action": "merkle_range", "buckets": buckets}
+        if ranges is not None:
+            message['ranges'] = ranges
+        return self.sendMsg(message)
+
+    def merge(self, snapshot):
+        return self.sendMsg({"action": "merge", "snapshot": snapshot})
+
+    def pull(self, sources, catch_up=False):
+        return self.sendMsg(
+            {"action": "pull", "sources": sources, "catch_up": catch_up})
+
+    def cache_stats(self):
+        return self.sendMsg({"action": "cache_stats"})
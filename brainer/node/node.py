@@ -1,15 +1,35 @@
 # -*- coding: utf8 -*-
 import sys
 import uuid
+from collections import OrderedDict
 
 import umsgpack
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, task
 
 from brainer.lib.mixins import SerializerMixin
 from brainer.lib.base import BaseREP
-from brainer.lib.cache import InMemoryCache
+from brainer.lib.arena import ArenaCache
+from brainer.lib.cache import InMemoryCache, BoundedCache
+from brainer.lib.eviction import LRU
+from brainer.lib.persistence import (
+    AppendOnlyCache, BoundedAppendOnlyCache, MappedCache, EVERYSEC)
+from brainer.lib.hash import keys_in_ranges
+from brainer.lib.events import TOPOLOGY
+from brainer.lib.versions import version_span
+from brainer.lib.pubsub import Subscriber
 from brainer.broker.client import BrokerClient
+from brainer.node.client import NodeClient
+from brainer.node.oplog import OpLog
+
+# Sequence numbers are write versions, see `brainer.lib.versions`. A
+# node catching up asks for a second more than it has, as writes near
+# the end may have arrived out of order.
+REORDER_WINDOW = version_span(1)
+
+# How many snapshot streams a node serves at once. Joining nodes that
+# stall for too long find their cursor gone and start over.
+MAX_SNAPSHOT_STREAMS = 16
 
 
 class Node(BaseREP, SerializerMixin):
@@ -22,22 +42,86 @@ class Node(BaseREP, SerializerMixin):
         :param endpoint: A `txzmq.ZmqEndpoint` object.
         :param debug: If True, will log debug information.
         :param cache_class: Defaults to `cache.InMemoryCache`.
+        :param cache_kwargs: Passed on to `cache_class`, like the limits
+        of a `cache.BoundedCache`.
         :param client_class: Defaults to `BrokerClient`.
+        :param snapshot_chunk_size: Keys per chunk when pulling a
+        snapshot from other nodes. Defaults to 1000.
+        :param snapshot_rate: Chunks per second, at most, when pulling
+        a snapshot. Defaults to 0 (no limit).
+        :param oplog_size: How many writes to remember so nodes coming
+        back can catch up from us. Defaults to 100000.
+        :param node_id: The node id. Keep it across restarts so the node
+        is known to rejoin, and trusts the data it kept on disk. Defaults
+        to a new uuid4.
+        :param sweep_interval: Seconds between sweeps of expired keys.
+        Defaults to 0.1.
+        :param sweep_limit: Keys looked at per sweep, at most, so a sweep
+        never holds the reactor for long. Defaults to 1000.
+        :param snapshot_interval: Seconds between snapshots written to
+        disk, with a `MappedCache`. Defaults to 0 (never).
+        :param broker_publisher: The publisher address of the broker, or
+        a list of them, to learn of topology changes as soon as they are
+        published (see `Broker.publish_topology`). Defaults to None.
         """
         self._init_instance(endpoint.address, **kwargs)
         super(Node, self).__init__(factory, endpoint)
+        self._sweeper = task.LoopingCall(self.sweep)
+        self._sweeper.clock = self._clock
+        self._sweeper.start(self._sweep_interval, now=False)
+        snapshot_interval = kwargs.get('snapshot_interval', 0)
+        if snapshot_interval:
+            self._snapshotter = task.LoopingCall(self.save_snapshot)
+            self._snapshotter.clock = self._clock
+            self._snapshotter.start(snapshot_interval, now=False)
+        publishers = kwargs.get('broker_publisher')
+        if publishers:
+            if not isinstance(publishers, (list, tuple)):
+                publishers = [publishers]
+            self._subscriber = Subscriber.create(
+                publishers, [TOPOLOGY], self.topology_published,
+                factory=factory)
 
     def _init_instance(self, address, **kwargs):
-        self._id = None
+        self._id = kwargs.get('node_id')
         self._address = address
         self._is_registered = False
         self._broker_address = kwargs['broker']
         self._serializer = kwargs.get('serializer', umsgpack)
         self._debug = kwargs.get('debug', False)
         self._cache_class = kwargs.get('cache_class', InMemoryCache)
-        self._cache = self._cache_class()
+        self._cache = self._cache_class(**kwargs.get('cache_kwargs', {}))
         self._client_class = kwargs.get('client_class', BrokerClient)
-        self._allowed_actions = ('get', 'set', 'remove', 'ping', 'snapshot')
+        self._node_client_class = kwargs.get('node_client_class', NodeClient)
+        self._snapshot_chunk_size = kwargs.get('snapshot_chunk_size', 1000)
+        self._snapshot_rate = kwargs.get('snapshot_rate', 0)
+        self._clock = kwargs.get('clock', reactor)
+        self._oplog = OpLog(kwargs.get('oplog_size', 100000))
+        self._sweep_interval = kwargs.get('sweep_interval', 0.1)
+        self._sweep_limit = kwargs.get('sweep_limit', 1000)
+        # The highest sequence number (write version) we applied.
+        self._last_sequence = None
+        # Whether we started from a snapshot or log on disk, and only
+        # need the writes made since from other nodes. Only if it was
+        # ours: a node with another id holds other ranges of the ring.
+        self._restored = False
+        if isinstance(self._cache, (MappedCache, AppendOnlyCache)):
+            if self._id is not None and self._cache.owner == self._id:
+                self._last_sequence = self._cache.sequence
+                self._restored = self._last_sequence is not None
+            elif self._cache.sequence is not None:
+                log.msg('Data on disk is not from node {}, pulling '
+                        'snapshots.'.format(self._id))
+            self._cache.claim(self.id)
+        # Snapshot streams we are serving: stream id: [keys, filter].
+        self._snapshot_streams = OrderedDict()
+        # The latest topology version the broker told us about.
+        self._topology_version = None
+        self._allowed_actions = (
+            'get', 'set', 'remove', 'ping', 'snapshot', 'snapshot_chunk',
+            'mget', 'mset', 'mremove', 'topology', 'apply', 'oplog',
+            'merkle', 'merkle_range', 'merge', 'pull', 'cache_stats')
+        self._write_actions = ('set', 'remove', 'mset', 'mremove')
 
     @property
     def id(self):
@@ -64,7 +148,15 @@ class Node(BaseREP, SerializerMixin):
 
         action = message['action']
         if action not in self._allowed_actions:
-            self.reply_error("FORBBIDEN")
+            self.reply_error(
+                message_id, "FORBBIDEN", "You cannot run this command.")
+            return
+
+        if self.is_stale(message):
+            self.reply_error(
+                message_id, "STALE_TOPOLOGY",
+                "Topology version is {}.".format(self._topology_version))
+            return
 
         method = getattr(self, action)
         reply = method(message)
@@ -81,7 +173,168 @@ class Node(BaseREP, SerializerMixin):
         """
         return self._cache.snapshot()
 
-    def ping(self):
+    def snapshot_chunk(self, message):
+        """Returns a chunk of a snapshot of the cache. The first request
+        has no 'cursor', every reply carries the cursor to ask for the
+        next chunk, or None after the last one.
+
+        The keys are listed when the stream starts, values are read as
+        chunks are asked for. So a stream costs a list of keys instead
+        of a copy of the cache.
+
+        :param message: The message itself. 'count' is how many keys per
+        chunk. 'ranges' optionally keeps only the keys in some hash
+        ranges (see `brainer.lib.hash.moved_ranges`).
+        :returns: A dict with 'chunk' (see `InMemoryCache.snapshot`)
+        and 'cursor'.
+        """
+        count = message.get('count', 1000)
+        cursor = message.get('cursor')
+        if cursor is None:
+            stream_id, offset = str(uuid.uuid4()), 0
+            self._snapshot_streams[stream_id] = [
+                self._cache.keys(), message.get('ranges')]
+            while len(self._snapshot_streams) > MAX_SNAPSHOT_STREAMS:
+                self._snapshot_streams.popitem(last=False)
+        else:
+            stream_id, offset = cursor
+
+        if stream_id not in self._snapshot_streams:
+            return {'chunk': None, 'cursor': None, 'expired': True}
+
+        keys, ranges = self._snapshot_streams[stream_id]
+        chunk_keys = keys[offset:offset + count]
+        if ranges is not None:
+            chunk_keys = keys_in_ranges(chunk_keys, ranges)
+
+        offset += count
+        if offset < len(keys):
+            next_cursor = [stream_id, offset]
+        else:
+            del self._snapshot_streams[stream_id]
+            next_cursor = None
+
+        return {'chunk': self._cache.export(chunk_keys), 'cursor': next_cursor}
+
+    def oplog(self, message):
+        """Returns the writes we applied since a sequence number, so a
+        node coming back can catch up.
+
+        :param message: The message itself. 'since' is the sequence
+        number the caller has, 'count' how many writes to return at
+        most and 'ranges' filters them like in `snapshot_chunk`.
+        :returns: A dict with 'ops', the writes oldest first, and
+        'next', the sequence number to ask from for more (None once we
+        sent them all). 'ops' is None when we no longer have every
+        write since then, the caller needs a snapshot instead.
+        """
+        count = message.get('count', 1000)
+        ops = self._oplog.since(message['since'], count)
+        if ops is None:
+            return {'ops': None, 'next': None}
+
+        next_sequence = ops[-1]['version'] if len(ops) == count else None
+        ranges = message.get('ranges')
+        if ranges is not None:
+            ops = [op for op in (self._filter_op(op, ranges) for op in ops)
+                   if op is not None]
+        return {'ops': ops, 'next': next_sequence}
+
+    @staticmethod
+    def _filter_op(op, ranges):
+        """Keeps the part of a write touching keys in some hash ranges.
+        Returns None if there's nothing left.
+
+        :param op: A write message.
+        :param ranges: See `brainer.lib.hash.moved_ranges`.
+        """
+        if 'key' in op:
+            return op if keys_in_ranges([op['key']], ranges) else None
+        elif 'items' in op:
+            keys = keys_in_ranges(op['items'].keys(), ranges)
+            items = dict((key, op['items'][key]) for key in keys)
+            return dict(op, items=items) if items else None
+        elif 'keys' in op:
+            keys = keys_in_ranges(op['keys'], ranges)
+            return dict(op, keys=keys) if keys else None
+
+    def merkle(self, message):
+        """Returns digests of a level of the Merkle tree of the cache,
+        for replicas to find where they differ.
+
+        :param message: The message itself. 'level' is the tree level,
+        'indexes' the nodes in it (defaults to all). 'ranges' (see
+        `brainer.lib.hash.shared_ranges`) only digests the keys in some
+        hash ranges, the ones shared with the other replica.
+        :returns: A list of digests.
+        """
+        return self._cache.digests(
+            message['level'], message.get('indexes'), message.get('ranges'))
+
+    def merkle_range(self, message):
+        """Returns the keys of some leaves of the Merkle tree.
+
+        :param message: The message itself. 'buckets' are leaf indexes,
+        'ranges' filters keys like in `merkle`.
+        :returns: A snapshot (see `InMemoryCache.snapshot`).
+        """
+        keys = self._cache.bucket_keys(message['buckets'])
+        ranges = message.get('ranges')
+        if ranges is not None:
+            keys = keys_in_ranges(keys, ranges)
+        return self._cache.export(keys)
+
+    def merge(self, message):
+        """Applies keys sent by another replica, see `BaseCache.merge`.
+
+        :param message: The message itself. 'snapshot' is a snapshot
+        (see `InMemoryCache.snapshot`).
+        """
+        self._cache.merge(message['snapshot'])
+        return True
+
+    def is_stale(self, message):
+        """Clients routing keys by themselves send the topology version
+        of their ring. If it is older than ours, the key may not be ours.
+
+        :param message: The message itself.
+        """
+        version = message.get('topology')
+        return (version is not None and
+                self._topology_version is not None and
+                version < self._topology_version)
+
+    def topology(self, message):
+        """The broker tells us the topology changed. Brokers sharing
+        the nodes tell us in any order, older versions are ignored.
+
+        :param message: The message itself.
+        :returns: True if the topology version changed.
+        """
+        version = message['version']
+        if (self._topology_version is not None and
+                version <= self._topology_version):
+            return False
+        self._topology_version = version
+        return True
+
+    def topology_published(self, tag, message):
+        """A broker published a topology change, see `topology`.
+
+        :param tag: The message tag.
+        :param message: The message itself.
+        :returns: True if the topology version changed.
+        """
+        return self.topology({'version': message['topology']['version']})
+
+    def cache_stats(self, message):
+        """Returns the counters of the cache, see `BoundedCache.stats`.
+
+        :param message: The message itself.
+        """
+        return self._cache.stats()
+
+    def ping(self, message=None):
         """When Broker asks for a confirmation we are alive.
         """
         return True
@@ -108,27 +361,260 @@ class Node(BaseREP, SerializerMixin):
         if snapshot is not None:
             self._cache.replay(snapshot)
 
+    def pull(self, message):
+        """The broker tells us to copy some hash ranges from other
+        nodes, after the ring changed. The copy goes on in the
+        background, see `bootstrap`.
+
+        :param message: The message itself. 'sources' is a list of
+        [node_id, address, ranges], 'catch_up' is set when we held
+        these ranges before and only need the writes we missed.
+        """
+        self.bootstrap(message['sources'], message.get('catch_up', False))
+        return True
+
+    def bootstrap(self, sources, catch_up=False):
+        """Pulls hash ranges from other nodes, all of them at once.
+        Snapshots come chunk by chunk, every chunk is applied as it
+        arrives.
+
+        A node coming back after a short absence only pulls the writes
+        it missed, see `_catch_up`.
+
+        :param sources: A list of [node_id, address, ranges] to pull
+        from. See `brainer.lib.hash.moved_ranges` for the ranges.
+        :param catch_up: If True and we have data, pull the writes we
+        missed instead of snapshots. Always the case the first time after
+        starting from a snapshot or log on disk written under our id.
+        """
+        catch_up, self._restored = catch_up or self._restored, False
+        since = self._last_sequence if catch_up else None
+        if since is None:
+            dlist = [self._pull_snapshot(address, ranges)
+                     for _, address, ranges in sources]
+        else:
+            dlist = [self._catch_up(address, ranges, since - REORDER_WINDOW)
+                     for _, address, ranges in sources]
+        d = defer.DeferredList(dlist, consumeErrors=True)
+        d.addCallback(lambda _: log.msg('Ranges copied from {}.'.format(
+            ', '.join(node_id for node_id, _, _ in sources))))
+        return d
+
+    def _catch_up(self, address, ranges, since):
+        """Pulls the writes a node applied since a sequence number. If
+        it no longer has all of them, pulls its snapshot instead.
+
+        :param address: The node address.
+        :param ranges: The hash ranges to pull.
+        :param since: The sequence number to start from.
+        """
+        connection = self._node_client_class.create(address)
+        finished = defer.Deferred()
+
+        def request(sequence):
+            d = connection.oplog(
+                sequence, self._snapshot_chunk_size, ranges)
+            d.addCallbacks(apply_ops, fail)
+
+        def apply_ops(reply):
+            if reply['ops'] is None:
+                log.msg('Op log of {} truncated, pulling a snapshot.'.format(
+                    address))
+                connection.shutdown()
+                d = self._pull_snapshot(address, ranges)
+                d.chainDeferred(finished)
+                return
+
+            self.apply({'ops': reply['ops']})
+            if reply['next'] is None:
+                connection.shutdown()
+                finished.callback(address)
+            else:
+                request(reply['next'])
+
+        def fail(f):
+            connection.shutdown()
+            finished.errback(f)
+
+        request(since)
+        return finished
+
+    def _pull_snapshot(self, address, ranges):
+        """Pulls every chunk of the snapshot of a node.
+
+        :param address: The node address.
+        :param ranges: The hash ranges to pull.
+        """
+        connection = self._node_client_class.create(address)
+        finished = defer.Deferred()
+        delay = 1.0 / self._snapshot_rate if self._snapshot_rate else 0
+
+        def request(cursor):
+            d = connection.snapshot_chunk(
+                cursor, self._snapshot_chunk_size, ranges)
+            d.addCallbacks(apply_chunk, fail)
+
+        def apply_chunk(reply):
+            if reply.get('expired'):
+                log.msg('Snapshot of {} expired, starting over.'.format(
+                    address))
+            elif reply['chunk'] is not None:
+                self._cache.replay(reply['chunk'], update=True)
+                versions = reply['chunk'].get('version')
+                if versions:
+                    self._seen(max(versions.itervalues()))
+
+            cursor = reply['cursor']
+            if cursor is None and not reply.get('expired'):
+                connection.shutdown()
+                finished.callback(address)
+            elif delay:
+                self._clock.callLater(delay, request, cursor)
+            else:
+                request(cursor)
+
+        def fail(f):
+            connection.shutdown()
+            finished.errback(f)
+
+        request(None)
+        return finished
+
     def set(self, message):
         """Sets a key-value pair in the cache.
 
-        :param message: The message itself.
+        Writes carry the version the broker gave them. A write older
+        than what we already hold is acknowledged but not applied, so
+        replicas converge to the last write whatever the arrival order.
+
+        :param message: The message itself. 'expires' optionally sets
+        how many seconds the key lives.
+        """
+        self._log(message)
+        return self._set(
+            message['key'], message['value'], message.get('version'),
+            message.get('expires'))
+
+    def _set(self, key, value, version, expires=None):
+        if version is not None:
+            current = self._cache.version(key)
+            if current is not None and current > version:
+                return True
+
+        return self._cache.set(key, value, expires=expires, version=version)
+
+    def sweep(self):
+        """Removes some of the expired keys nobody read.
+        """
+        return self._cache.expire(self._sweep_limit)
+
+    def save_snapshot(self):
+        """Writes a snapshot of the cache to disk, in the background. See
+        `MappedCache.dump`.
         """
-        return self._cache.set(message['key'], message['value'])
+        d = self._cache.dump(self._last_sequence)
+        d.addErrback(lambda f: None)  # MappedCache logs it already.
+        return d
+
+    def _log(self, message):
+        """Logs a write in the op log and keeps track of the highest
+        sequence number we applied.
+
+        :param message: A write message.
+        """
+        self._oplog.append(message)
+        self._seen(message.get('version'))
+
+    def _seen(self, sequence):
+        if sequence is None:
+            return
+        if self._last_sequence is None or sequence > self._last_sequence:
+            self._last_sequence = sequence
 
     def get(self, message):
         """Gets a value (if any) in the cache based on the key.
 
-        :param message: The message itself.
-        :returns: A value or None if there isn't any.
+        :param message: The message itself. If it has 'versioned' set,
+        the version of the value is returned along with it.
+        :returns: A value or None if there isn't any. When versioned,
+        a [value, version] pair.
         """
-        return self._cache.get(message['key'])
+        value = self._cache.get(message['key'])
+        if message.get('versioned'):
+            return [value, self._cache.version(message['key'])]
+        return value
 
     def remove(self, message):
         """Removes a key from the cache.
 
+        Like `set`, a remove older than the value we hold is
+        acknowledged but not applied. The cache remembers the version of
+        the remove for a while, so older writes don't bring the key back.
+
         :param message: The Message itself.
         """
-        return self._cache.remove(message['key'])
+        self._log(message)
+        return self._remove(message['key'], message.get('version'))
+
+    def _remove(self, key, version):
+        if version is not None:
+            current = self._cache.version(key)
+            if current is not None and current > version:
+                return True
+
+        return self._cache.remove(key, version=version)
+
+    def mset(self, message):
+        """Sets many key-value pairs in the cache at once.
+
+        :param message: The message itself. 'items' is a dict of
+        key: value, all sharing the same 'version' and 'expires'.
+        :returns: A dict of key: reply, like `set` would reply.
+        """
+        self._log(message)
+        version, expires = message.get('version'), message.get('expires')
+        return dict(
+            (key, self._set(key, value, version, expires))
+            for key, value in message['items'].iteritems())
+
+    def mget(self, message):
+        """Gets many keys from the cache at once.
+
+        :param message: The message itself. 'keys' is a list of keys.
+        :returns: A dict of key: value (or [value, version] pairs if
+        'versioned' is set), like `get` would reply.
+        """
+        get, version = self._cache.get, self._cache.version
+        if message.get('versioned'):
+            return dict(
+                (key, [get(key), version(key)]) for key in message['keys'])
+        return dict((key, get(key)) for key in message['keys'])
+
+    def mremove(self, message):
+        """Removes many keys from the cache at once.
+
+        :param message: The message itself. 'keys' is a list of keys.
+        :returns: A dict of key: reply, like `remove` would reply.
+        """
+        self._log(message)
+        version = message.get('version')
+        return dict(
+            (key, self._remove(key, version)) for key in message['keys'])
+
+    def apply(self, message):
+        """Applies a batch of writes coalesced by the broker.
+
+        :param message: The message itself. 'ops' is a list of write
+        messages (set, remove, mset or mremove).
+        :returns: The list of replies, in the same order.
+        """
+        replies = []
+        for op in message['ops']:
+            if op['action'] not in self._write_actions:
+                replies.append(None)
+                continue
+            replies.append(getattr(self, op['action'])(op))
+        return replies
 
     def unregister(self):
         """Unregisters a node with a broker.
@@ -142,15 +628,77 @@ class Node(BaseREP, SerializerMixin):
 
     def on_shutdown(self):
         """Called when the reactor captures the shutdown signal. It calls
-        the broker to cleanly unregister the node.
+        the broker to cleanly unregister the node, and closes the cache.
         """
         log.msg('We are going to shut down NOW!')
         self.unregister()
+        self._cache.close()
 
 
-def run_node(host, broker, debug=False):
+def cache_options(max_items=0, max_bytes=0, eviction_policy=LRU,
+                  data_file=None, fsync=EVERYSEC, snapshot_file=None,
+                  arena=False):
+    """Returns the cache class and its keyword arguments for the options
+    of `run_node`.
+    """
+    if snapshot_file and (data_file or max_items or max_bytes):
+        raise ValueError(
+            'A snapshot file cannot be combined with a data file or limits.')
+    if arena and (snapshot_file or data_file or max_items or max_bytes):
+        raise ValueError(
+            'The arena cache cannot be combined with files or limits.')
+    cache_kwargs = {}
+    cache_class = InMemoryCache
+    if max_items or max_bytes:
+        cache_kwargs = {'max_items': max_items, 'max_bytes': max_bytes,
+                        'policy': eviction_policy}
+        cache_class = BoundedCache
+    if data_file:
+        cache_kwargs.update(path=data_file, fsync=fsync)
+        cache_class = (
+            BoundedAppendOnlyCache if cache_class is BoundedCache
+            else AppendOnlyCache)
+    if snapshot_file:
+        cache_kwargs = {'path': snapshot_file}
+        cache_class = MappedCache
+    if arena:
+        cache_class = ArenaCache
+    return cache_class, cache_kwargs
+
+
+def run_node(host, broker, debug=False, snapshot_chunk_size=1000,
+             snapshot_rate=0, oplog_size=100000, node_id=None,
+             sweep_interval=0.1, sweep_limit=1000, max_items=0, max_bytes=0,
+             eviction_policy=LRU, data_file=None, fsync=EVERYSEC,
+             snapshot_file=None, snapshot_interval=60, arena=False,
+             workers=0, broker_publisher=None):
     log.startLogging(sys.stdout)
-    node = Node.create(host, broker=broker, debug=debug)
+    options = dict(
+        max_items=max_items, max_bytes=max_bytes,
+        eviction_policy=eviction_policy, data_file=data_file, fsync=fsync,
+        snapshot_file=snapshot_file, arena=arena)
+    cache_class, cache_kwargs = cache_options(**options)
+    kwargs = dict(
+        broker=broker, debug=debug,
+        snapshot_chunk_size=snapshot_chunk_size, snapshot_rate=snapshot_rate,
+        oplog_size=oplog_size, node_id=node_id,
+        sweep_interval=sweep_interval, sweep_limit=sweep_limit,
+        broker_publisher=broker_publisher)
+    if workers:
+        # Imported here, it imports this module.
+        from brainer.node.sharded import start_workers, stop_workers
+        options.update(kwargs, host=host, snapshot_interval=snapshot_interval,
+                       node_id=node_id or str(uuid.uuid4()))
+        processes = start_workers(workers, options)
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', stop_workers, processes)
+        reactor.run()
+        return
+
+    node = Node.create(
+        host, cache_class=cache_class, cache_kwargs=cache_kwargs,
+        snapshot_interval=snapshot_interval if snapshot_file else 0,
+        **kwargs)
     reactor.callLater(0.1, node.register)
     reactor.addSystemEventTrigger('before', 'shutdown', node.on_shutdown)
     reactor.run()
@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+from bisect import bisect_right
+
+
+class OpLog(object):
+    """A bounded log of the writes a node applied, so a node coming back
+    after a short absence can catch up without a full snapshot.
+
+    Every write carries a sequence number, the version the broker gave
+    it. Writes can arrive slightly out of order, so they are kept sorted
+    by sequence (most arrive in order and just go at the end), and the
+    log remembers the highest sequence it dropped: asking for anything
+    older than it means some writes are gone, see `since`.
+    """
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: How many writes to keep. The oldest ones are
+        dropped first.
+        """
+        # Sequences and writes, in sequence order. The first `_start`
+        # were dropped, and are only deleted once they are half of the
+        # lists, so dropping a write doesn't move all the others.
+        self._sequences = []
+        self._ops = []
+        self._start = 0
+        self._max_size = max_size
+        self._truncated = 0
+
+    def __len__(self):
+        return len(self._ops) - self._start
+
+    def append(self, op):
+        """Logs a write. Writes without a version are not logged.
+
+        :param op: The write message, as the node got it.
+        """
+        version = op.get('version')
+        if version is None:
+            return
+
+        sequences = self._sequences
+        if len(sequences) > self._start and version < sequences[-1]:
+            index = bisect_right(sequences, version, self._start)
+            sequences.insert(index, version)
+            self._ops.insert(index, op)
+        else:
+            sequences.append(version)
+            self._ops.append(op)
+
+        while len(self) > self._max_size:
+            self._truncated = max(self._truncated, sequences[self._start])
+            self._ops[self._start] = None
+            self._start += 1
+        if self._start > len(sequences) // 2:
+            del sequences[:self._start]
+            del self._ops[:self._start]
+            self._start = 0
+
+    def since(self, sequence, count=None):
+        """Returns the writes newer than a sequence number, oldest first.
+
+        :param sequence: The last sequence number the caller has.
+        :param count: How many writes to return, at most.
+        :returns: A list of writes, or None if the log was truncated
+        past `sequence` and the caller needs a full snapshot.
+        """
+        if sequence < self._truncated:
+            return None
+
+        start = bisect_right(self._sequences, sequence, self._start)
+        if count is None:
+            return self._ops[start:]
+        return self._ops[start:start + count]
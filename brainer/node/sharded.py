@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+"""A node spread over worker processes, see `start_workers`.
+"""
+import os
+import sys
+import json
+import subprocess
+
+from twisted.python import log
+from twisted.internet import reactor, task
+
+from brainer.lib.hash import GROUP_SEPARATOR
+from brainer.node.node import run_node
+
+# Where the brainer package is, for worker processes to import it.
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def worker_endpoint(endpoint, index):
+    """Returns the endpoint a worker of a node binds. TCP workers take
+    the ports following the one of the node, IPC ones get the worker
+    index appended to the path.
+
+    :param endpoint: The endpoint of the node.
+    :param index: The worker index.
+    """
+    if endpoint.startswith('tcp://'):
+        address, _, port = endpoint.rpartition(':')
+        return '{}:{}'.format(address, int(port) + index)
+    return '{}.{}'.format(endpoint, index)
+
+
+def worker_id(node_id, index):
+    """Returns the node id of a worker. Workers of a node share a group
+    in the ring, so they are never replicas of the same keys, see
+    `brainer.lib.hash.group_of`.
+
+    :param node_id: The id of the node.
+    :param index: The worker index.
+    """
+    return '{}{}{}'.format(node_id, GROUP_SEPARATOR, index)
+
+
+def start_workers(count, options):
+    """Starts worker processes. Each one is a node of its own, see
+    `run_worker`, registered with the broker under `worker_id` and
+    listening on `worker_endpoint`, so requests reach it without going
+    through this process.
+
+    :param count: How many workers.
+    :param options: The keyword arguments of
+    `brainer.node.node.run_node`, with a 'node_id'. Workers get files of
+    their own, named after 'data_file' or 'snapshot_file' with the
+    worker index appended.
+    :returns: The list of processes.
+    """
+    processes = []
+    for index in range(count):
+        worker_options = dict(
+            options, host=worker_endpoint(options['host'], index),
+            node_id=worker_id(options['node_id'], index))
+        for name in ('data_file', 'snapshot_file'):
+            if worker_options.get(name):
+                worker_options[name] = '{}.{}'.format(
+                    worker_options[name], index)
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'brainer.node.sharded',
+             json.dumps(worker_options)],
+            env=dict(os.environ, PYTHONPATH=ROOT)))
+    return processes
+
+
+def stop_workers(processes):
+    """Stops the worker processes started by `start_workers`, and waits
+    for them to unregister.
+    """
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def run_worker(options):
+    """Runs a worker node, until the node that started it is gone.
+
+    :param options: Passed on to `brainer.node.node.run_node`.
+    """
+    parent = os.getppid()
+
+    def check_parent():
+        if os.getppid() != parent:
+            log.msg('Node is gone, stopping worker.')
+            reactor.stop()
+
+    task.LoopingCall(check_parent).start(1, now=False)
+    run_node(**options)
+
+
+if __name__ == '__main__':
+    run_worker(json.loads(sys.argv[1]))
@@ -0,0 +1,81 @@
+# -*- coding: utf8 -*-
+import zmq
+import umsgpack
+from twisted.trial import unittest
+
+from brainer.aioclient import AsyncBrainer, asyncio
+from brainer.lib.exceptions import RequestTimeoutError
+
+
+class AsyncBrainerTest(unittest.TestCase):
+    """Runs against a ROUTER socket standing for the broker."""
+    if asyncio is None:
+        skip = 'asyncio is not available.'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.context = zmq.Context()
+        self.broker = self.context.socket(zmq.ROUTER)
+        self.broker.bind('inproc://broker')
+        self.client = AsyncBrainer(
+            'inproc://broker', self.context, loop=self.loop)
+        self.client.connect()
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.close(linger=0)
+        self.context.term()
+        self.loop.close()
+
+    def receive_requests(self, count):
+        requests = []
+        for _ in range(count):
+            identity, request_id, empty, payload = (
+                self.broker.recv_multipart())
+            requests.append(
+                (identity, request_id, umsgpack.loads(payload)))
+        return requests
+
+    def reply(self, request, data):
+        identity, request_id, _ = request
+        self.broker.send_multipart(
+            [identity, request_id, b'', umsgpack.dumps(data)])
+
+    def test_concurrent_requests(self):
+        first = self.client.get('key1')
+        second = self.client.set('key2', 'value2')
+        self.assertEqual(self.client.pending(), 2)
+
+        requests = self.receive_requests(2)
+        self.assertEqual(requests[0][2], {'action': 'get', 'key': 'key1'})
+        self.reply(requests[1], True)
+        self.reply(requests[0], 'value1')
+
+        results = self.loop.run_until_complete(
+            asyncio.gather(first, second))
+        self.assertEqual(results, ['value1', True])
+        self.assertEqual(self.client.pending(), 0)
+
+    def test_client_timeout(self):
+        self.client._timeout = 0.01
+        future = self.client.get('key1')
+        self.assertRaises(
+            RequestTimeoutError, self.loop.run_until_complete, future)
+        self.assertEqual(self.client.pending(), 0)
+
+    def test_per_call_timeout(self):
+        future = asyncio.wait_for(self.client.get('key1'), 0.01)
+        self.assertRaises(
+            asyncio.TimeoutError, self.loop.run_until_complete, future)
+        # The request was cancelled, a late reply is dropped.
+        self.assertEqual(self.client.pending(), 0)
+        self.reply(self.receive_requests(1)[0], 'late')
+        self.client._on_readable()
+
+    def test_send_failure(self):
+        # Without a broker to queue requests for, sends fail at once.
+        client = AsyncBrainer('inproc://nobody', self.context, loop=self.loop)
+        future = client.get('key1')
+        self.assertRaises(zmq.Again, self.loop.run_until_complete, future)
+        self.assertEqual(client.pending(), 0)
+        client.socket.close(linger=0)
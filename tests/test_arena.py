@@ -0,0 +1,146 @@
+# -*- coding: utf8 -*-
+from mock import patch
+from twisted.trial import unittest
+
+from brainer.lib.arena import ArenaCache
+from brainer.lib.cache import InMemoryCache
+from brainer.lib.clock import monotonic
+
+
+class ArenaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ArenaCache(slab_size=256, capacity=8)
+
+    def test_set_get(self):
+        self.cache.set('a', {'b': [1, 2]})
+        self.cache.set(u'ключ', u'значение', version=5)
+        self.assertEqual(self.cache.get('a'), {'b': [1, 2]})
+        self.assertEqual(self.cache.get(u'ключ'), u'значение')
+        self.assertEqual(self.cache.get('missing'), None)
+        self.assertEqual(self.cache.version(u'ключ'), 5)
+        self.assertEqual(self.cache.version('a'), None)
+        self.assertEqual(sorted(self.cache.keys()), ['a', u'ключ'])
+
+    def test_overwrite_and_remove(self):
+        self.cache.set('a', 1)
+        self.cache.set('a', 2)
+        self.assertEqual(self.cache.get('a'), 2)
+        self.assertTrue(self.cache.remove('a'))
+        self.assertFalse(self.cache.remove('a'))
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_grows(self):
+        for i in range(1000):
+            self.cache.set('key{}'.format(i), i)
+        for i in range(0, 1000, 2):
+            self.cache.remove('key{}'.format(i))
+        self.assertEqual(len(self.cache), 500)
+        self.assertEqual(self.cache.get('key999'), 999)
+        self.assertEqual(self.cache.get('key998'), None)
+        self.assertTrue(len(self.cache._locations) >= 1024)
+
+    def test_compacts_slabs(self):
+        for i in range(200):
+            self.cache.set('key{}'.format(i % 10), 'x' * 20)
+        # Only a handful of slabs stay allocated.
+        live = [slab for slab in self.cache._slabs if slab is not None]
+        self.assertTrue(len(live) <= 3)
+        self.assertEqual(self.cache.stats()['payload'], 10 * (7 + 4 + 20))
+        for i in range(10):
+            self.assertEqual(self.cache.get('key{}'.format(i)), 'x' * 20)
+
+    def test_compaction_keeps_versions(self):
+        for i in range(50):
+            self.cache.set('key{}'.format(i % 5), [i], version=i,
+                           expires=60)
+        self.assertEqual(self.cache.get('key0'), [45])
+        self.assertEqual(self.cache.version('key4'), 49)
+        self.assertEqual(self.cache.export(['key1'])['version'], {'key1': 46})
+
+    def test_large_value(self):
+        self.cache.set('big', 'x' * 1000)
+        self.assertEqual(self.cache.get('big'), 'x' * 1000)
+        self.cache.remove('big')
+        self.assertEqual(self.cache.stats()['payload'], 0)
+
+    def test_expire(self):
+        self.cache.set('short', 1, expires=10)
+        self.cache.set('forever', 2)
+        later = monotonic() + 50
+        with patch('brainer.lib.arena.monotonic', return_value=later):
+            self.assertEqual(self.cache.expire(), 1)
+            self.cache.set('again', 3, expires=10)
+        self.assertEqual(sorted(self.cache.keys()), ['again', 'forever'])
+
+        with patch('brainer.lib.arena.monotonic', return_value=later + 50):
+            self.assertEqual(self.cache.get('again'), None)
+
+    def test_expire_limit(self):
+        for i in range(4):
+            self.cache.set('key{}'.format(i), i, expires=10)
+        capacity = len(self.cache._locations)
+        later = monotonic() + 50
+        with patch('brainer.lib.arena.monotonic', return_value=later):
+            removed = self.cache.expire(limit=capacity // 2)
+            removed += self.cache.expire(limit=capacity // 2)
+        self.assertEqual(removed, 4)
+
+    def test_matches_in_memory_cache(self):
+        other = InMemoryCache()
+        for cache in (self.cache, other):
+            cache.set('a', 1, version=10)
+            cache.set(u'b', [1, 'x'])
+            cache.set('c', 3, expires=60)
+            cache.remove('c')
+            cache.set('d', 4, version=11)
+            cache.remove('d', version=12)
+        self.assertEqual(self.cache.digests(0), other.digests(0))
+        self.assertEqual(self.cache.version('d'), 12)
+        self.assertEqual(self.cache.digest(u'b'), other.digest(u'b'))
+        bucket = other._tree.bucket('a')
+        self.assertEqual(
+            self.cache.bucket_keys([bucket]), other.bucket_keys([bucket]))
+        bucket = other._tree.bucket('d')
+        self.assertEqual(
+            self.cache.bucket_keys([bucket]), other.bucket_keys([bucket]))
+        self.assertEqual(self.cache.export(['a', 'b', 'x']),
+                         other.export(['a', 'b', 'x']))
+        self.assertEqual(self.cache.export(['d'])['tombstone']['d'][0], 12)
+
+        self.cache.replay(other.snapshot())
+        self.assertEqual(self.cache.digests(0), other.digests(0))
+        later = monotonic() + 2 * 60 * 60
+        # Tombstones keep time in the cache module.
+        with patch('brainer.lib.cache.monotonic', return_value=later):
+            self.cache.expire()
+        self.assertEqual(self.cache.removed_keys(), [])
+
+    def test_replay(self):
+        self.cache.set('old', 1)
+        self.cache.replay({
+            'data': {'a': 1, 'b': 2}, 'expiration': {'a': 60},
+            'version': {'b': 10}})
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'b'])
+        snapshot = self.cache.snapshot()
+        self.assertTrue(0 < snapshot['expiration']['a'] <= 60)
+        self.assertEqual(snapshot['version'], {'b': 10})
+
+        self.cache.set('c', 'newer', version=20)
+        self.cache.replay({
+            'data': {'b': 3, 'c': 'older'}, 'expiration': {},
+            'version': {'b': 11, 'c': 15}}, update=True)
+        self.assertEqual(self.cache.get('b'), 3)
+        self.assertEqual(self.cache.get('c'), 'newer')
+
+    def test_stats(self):
+        self.cache.set('a', 'x' * 10)
+        stats = self.cache.stats()
+        self.assertEqual(stats['items'], 1)
+        # Record header, key and value.
+        self.assertEqual(stats['payload'], 7 + 1 + 10)
+        self.assertEqual(stats['bytes'], 256 + 8 * 12)
+        self.assertEqual(stats['bytes_per_key'], 256 + 8 * 12)
+
+    def test_keys_must_be_strings(self):
+        self.assertRaises(TypeError, self.cache.set, 1, 'a')
@@ -3,13 +3,21 @@ import sys
 import uuid
 
 from mock import MagicMock, patch
+from twisted.internet import defer
+from twisted.python import failure
 from twisted.trial import unittest
 
 if 'brainer' not in sys.path:
     sys.path.append('brainer')
 
 from brainer.broker import Broker
-from brainer.lib.exceptions import ZeroNodeError
+from brainer.broker.coalescer import WriteCoalescer
+from brainer.broker.replication import ReplicationQueue, SHED
+from brainer.lib import quorum
+from brainer.lib.hash import moved_ranges, keys_in_ranges
+from brainer.lib.versions import MAX_BROKER_ID, version_micros
+from brainer.lib.exceptions import (
+    ZeroNodeError, QuorumError, BackpressureError)
 
 
 class TestBroker(Broker):
@@ -26,6 +34,7 @@ class BrokerTest(unittest.TestCase):
             'brainer.broker.broker.NodeClient',
             self.mock_node_client)
         self.node_patcher.start()
+        self.addCleanup(self.node_patcher.stop)
         self.broker = TestBroker(self.mock_factory, self.mock_endpoint)
 
     def get_id(self):
@@ -35,27 +44,45 @@ class BrokerTest(unittest.TestCase):
         server_id = self.get_id()
         self.broker.register_node(server_id, 'anaddress')
         self.assertEqual(self.broker._nodes, [server_id])
-        self.mock_node_client.create.assert_called_once_with('anaddress')
+        self.mock_node_client.create.assert_called_once_with(
+            'anaddress', factory=None, high_water_mark=0)
         self.assertIn(server_id, self.broker._nodes_connections)
 
+    def test_register_node_again(self):
+        self.broker._queue_size = 0
+        server_id = self.get_id()
+        self.broker.register_node(server_id, 'anaddress')
+        connection = self.broker._nodes_connections[server_id]
+        self.broker.register_node(server_id, 'anaddress')
+        self.assertEqual(self.broker._nodes, [server_id])
+        connection.shutdown.assert_called_once_with()
+
+        self.broker.register_node('node-1', 'address1')
+        self.broker.register_node(server_id, 'anaddress')
+        connection = self.broker._nodes_connections[server_id]
+        self.assertEqual(connection.pull.call_args[0][1], True)
+
     def test_register(self):
         self.broker.reply = MagicMock()
         server_id = self.get_id()
         message = {'id': server_id, 'address': 'anddress'}
         self.broker.register(13123123, message)
 
-        self.broker.snapshot = MagicMock()
+        self.broker.reply.assert_called_with(
+            13123123, {'action': 'register'})
+        self.broker.transfer = MagicMock(return_value={})
         self.assertEqual(self.broker._nodes, [server_id])
-        self.mock_node_client.create.assert_called_with('anddress')
+        self.mock_node_client.create.assert_called_with(
+            'anddress', factory=None, high_water_mark=0)
         self.assertIn(server_id, self.broker._nodes_connections)
-        self.broker.snapshot.assert_not_called()
 
         server_id2 = self.get_id()
         message = {'id': server_id2, 'address': 'anddress2'}
         self.broker.register(66666, message)
-        self.mock_node_client.create.assert_called_with('anddress2')
+        self.mock_node_client.create.assert_called_with(
+            'anddress2', factory=None, high_water_mark=0)
         self.assertIn(server_id2, self.broker._nodes_connections)
-        self.broker.snapshot.assert_called_with(server_id2)
+        self.assertEqual(self.broker.transfer.call_count, 1)
 
     def test_clean_connection_no_node(self):
         self.assertEqual(
@@ -77,60 +104,475 @@ class BrokerTest(unittest.TestCase):
         self.assertEqual(self.broker._nodes, [])
         connection.shutdown.assert_called_with()
 
+    def test_register_node_shares_factory(self):
+        self.broker._factory = factory = MagicMock()
+        self.broker._node_hwm = 1000
+        self.broker.register_node(self.get_id(), 'anaddress')
+        self.broker.register_node(self.get_id(), 'anaddress2')
+        self.mock_node_client.create.assert_any_call(
+            'anaddress', factory=factory, high_water_mark=1000)
+        self.mock_node_client.create.assert_any_call(
+            'anaddress2', factory=factory, high_water_mark=1000)
+
+    def test_register_node_coalesces_writes(self):
+        self.broker._coalesce_window = 0.01
+        node_id = self.get_id()
+        self.broker.register_node(node_id, 'anaddress')
+        connection = self.broker._nodes_connections[node_id]._connection
+        self.assertIsInstance(connection, WriteCoalescer)
+        self.assertIs(
+            connection._connection, self.mock_node_client.create())
+
+    def test_register_node_queues_writes(self):
+        node_id = self.get_id()
+        self.broker.register_node(node_id, 'anaddress')
+        self.assertIsInstance(
+            self.broker._nodes_connections[node_id], ReplicationQueue)
+
+        self.broker._queue_size = 0
+        node_id = self.get_id()
+        self.broker.register_node(node_id, 'anaddress')
+        self.assertIs(
+            self.broker._nodes_connections[node_id],
+            self.mock_node_client.create())
+
+    def test_backpressure(self):
+        id1, id2 = self.setup_two_nodes()
+        node1 = self.broker._nodes_connections[id1]
+        full = ReplicationQueue(MagicMock(), max_size=0, concurrency=0)
+        self.broker._nodes_connections[id2] = full
+        self.assertRaises(
+            BackpressureError, self.broker.batch,
+            [node1, full], quorum.ONE, 'set', {'key': 'key1'})
+        node1.set.assert_not_called()
+
+        self.broker._queue_policy = SHED
+        node1.set.return_value = defer.succeed(True)
+        d = self.broker.batch(
+            [node1, full], quorum.ONE, 'set', {'key': 'key1'})
+        self.assertEqual(self.successResultOf(d), [True])
+        self.assertEqual(full.shed, 1)
+
+    def test_stats(self):
+        id1, id2 = self.setup_two_nodes()
+        queue = ReplicationQueue(MagicMock())
+        queue._connection.cache_stats.return_value = defer.succeed(
+            {'items': 1})
+        self.broker._nodes_connections[id1] = queue
+        self.broker._nodes_connections[id2].cache_stats.return_value = (
+            defer.fail(Exception()))
+        self.broker.reply = MagicMock()
+        self.broker.stats(123, {'action': 'stats'})
+        self.broker.reply.assert_called_once_with(123, {
+            id1: dict(queue.stats(), cache={'items': 1}), id2: {}})
+
+    def test_update_ring(self):
+        self.assertEqual(self.broker._ring, None)
+        id1 = self.get_id()
+        self.broker.register_node(id1, 'anaddress')
+        ring = self.broker._ring
+        self.assertEqual(ring.nodes, (id1, ))
+
+        # Lookups reuse the same ring.
+        self.broker.get_node_by_key('key1')
+        self.assertIs(self.broker._ring, ring)
+
+        id2 = self.get_id()
+        self.broker.register_node(id2, 'anaddress2')
+        self.assertEqual(self.broker._ring.nodes, (id1, id2))
+
+        self.broker.unregister_node(id1)
+        self.assertEqual(self.broker._ring.nodes, (id2, ))
+        self.broker.unregister_node(id2)
+        self.assertEqual(self.broker._ring, None)
+
+    def test_topology(self):
+        self.broker.reply = MagicMock()
+        self.broker.register_node('node-1', 'address-1')
+        connection = self.broker._nodes_connections['node-1']
+        connection.topology.assert_called_with(1)
+
+        self.broker.register_node('node-2', 'address-2')
+        connection.topology.assert_called_with(2)
+        self.broker.topology(123, {'action': 'topology'})
+        self.broker.reply.assert_called_once_with(123, {
+            'action': 'topology', 'version': 2, 'vnodes': 160,
+            'replication': 2,
+            'nodes': [['node-1', 'address-1'], ['node-2', 'address-2']]})
+
+        self.broker.unregister_node('node-1')
+        self.assertEqual(self.broker._topology_version, 3)
+        self.assertEqual(self.broker.get_topology()['nodes'],
+                         [['node-2', 'address-2']])
+
     def test_get_node_by_key_no_node(self):
         self.assertRaises(ZeroNodeError, self.broker.get_node_by_key, 'what')
 
     def test_get_node_by_key(self):
         id1, id2 = self.setup_two_nodes()
         connection = self.broker.get_node_by_key('key1')
-        self.assertEqual(self.broker._nodes_connections[id2], connection)
-
-        connection = self.broker.get_node_by_key('key2')
-        self.assertEqual(self.broker._nodes_connections[id2], connection)
+        self.assertEqual(self.broker._nodes_connections[id1], connection)
 
         connection = self.broker.get_node_by_key('key3')
         self.assertEqual(self.broker._nodes_connections[id1], connection)
 
-    def test_snapshot(self):
-        self.broker._nodes_connections = {'id1': MagicMock, 'id2': MagicMock()}
-        self.broker.snapshot('id1')
-        node_to_be_called = self.broker._nodes_connections['id2']
-        node_to_be_called.snapshot.assert_called_once_with()
+        connection = self.broker.get_node_by_key('key4')
+        self.assertEqual(self.broker._nodes_connections[id2], connection)
+
+    def test_group_keys_by_node(self):
+        self.assertRaises(
+            ZeroNodeError, self.broker.group_keys_by_node, ['key1'])
+        id1, id2 = self.setup_two_nodes()
+        groups = self.broker.group_keys_by_node(
+            ['key1', 'key2', 'key3', 'key4'])
+        self.assertEqual(groups, {id1: ['key1', 'key2', 'key3'], id2: ['key4']})
+
+    def test_get_replication(self):
+        self.setup_two_nodes()
+        self.assertEqual(self.broker.get_replication(), 2)
+        self.assertTrue(self.broker.is_fully_replicated())
+        self.assertEqual(self.broker.get_replication({'replication': 1}), 1)
+        self.assertEqual(self.broker.get_replication({'replication': 9}), 2)
+
+        self.broker._replication = 1
+        self.assertEqual(self.broker.get_replication(), 1)
+        self.assertFalse(self.broker.is_fully_replicated())
+        self.assertEqual(self.broker.get_replication({'replication': 2}), 2)
+
+    def test_get_replication_groups(self):
+        # Two machines, two workers each.
+        self.broker._nodes = ['a/0', 'a/1', 'b/0', 'b/1']
+        self.broker._nodes_connections = dict(
+            (node_id, MagicMock()) for node_id in self.broker._nodes)
+        self.broker.update_ring()
+        self.assertEqual(self.broker.get_replication(), 2)
+        self.assertFalse(self.broker.is_fully_replicated())
+        replicas = self.broker._ring.get_replicas('key1', 2)
+        self.assertEqual(
+            sorted(node_id[0] for node_id in replicas), ['a', 'b'])
+
+    def test_get_nodes_by_key(self):
+        self.assertRaises(ZeroNodeError, self.broker.get_nodes_by_key, 'key1')
+        id1, id2 = self.setup_two_nodes()
+        connections = self.broker._nodes_connections
+        self.assertEqual(
+            self.broker.get_nodes_by_key('key1'),
+            [connections[id1], connections[id2]])
+        self.assertEqual(
+            self.broker.get_nodes_by_key('key4', 1), [connections[id2]])
+
+    def test_set_with_replication(self):
+        self.broker._replication = 1
+        id1, id2 = self.setup_two_nodes()
+        message = {'key': 'key4', 'value': 'value'}
+        self.broker.set(1231231, message)
+        self.broker._nodes_connections[id2].set.assert_called_once_with(
+            message)
+        self.broker._nodes_connections[id1].set.assert_not_called()
+
+        message = {'key': 'key4', 'value': 'value', 'replication': 2}
+        self.broker.set(1231231, message)
+        self.broker._nodes_connections[id1].set.assert_called_once_with(
+            message)
+
+    def test_transfer_on_join(self):
+        self.broker._queue_size = 0
+        self.broker._replication = 1
+        self.broker.register_node('node-1', 'address1')
+        old_ring = self.broker._ring
+        self.broker.register_node('node-2', 'address2')
+
+        node2 = self.broker._nodes_connections['node-2']
+        ranges = moved_ranges(old_ring, self.broker._ring, 1)
+        node2.pull.assert_called_once_with(
+            [['node-1', 'address1', ranges['node-2']['node-1']]], False)
+        # key4 moved to the second node, key1 stayed.
+        sources = node2.pull.call_args[0][0]
+        self.assertEqual(
+            keys_in_ranges(['key1', 'key4'], sources[0][2]), ['key4'])
+
+    def test_transfer_on_leave(self):
+        self.broker._queue_size = 0
+        self.broker._replication = 2
+        self.mock_node_client.create.side_effect = (
+            lambda *args, **kwargs: MagicMock())
+        for node_id in ('node-1', 'node-2', 'node-3'):
+            self.broker.register_node(node_id, node_id + '-address')
+        connections = dict(self.broker._nodes_connections)
+        for connection in connections.values():
+            connection.pull.reset_mock()
+
+        self.broker.unregister_node('node-3')
+        for node_id in ('node-1', 'node-2'):
+            sources = connections[node_id].pull.call_args[0][0]
+            self.assertEqual(
+                [source for source, _, _ in sources],
+                [{'node-1': 'node-2', 'node-2': 'node-1'}[node_id]])
 
     def setup_two_nodes(self):
-        id1, id2 = self.get_id(), self.get_id()
+        # Fixed ids, so the ring placement is deterministic.
+        id1, id2 = 'node-1', 'node-2'
         self.broker._nodes = [id1, id2]
         self.broker._nodes_connections = {id1: MagicMock(), id2: MagicMock()}
+        self.broker.update_ring()
         return id1, id2
 
     def test_get(self):
         id1, id2 = self.setup_two_nodes()
         message = {'key': 'key1'}
         self.broker.get(1231231, message)
-        expected_node = self.broker._nodes_connections[id2]
+        expected_node = self.broker._nodes_connections[id1]
         expected_node.get.assert_called_once_with(message)
 
-        message = {'key': 'key3'}
+        message = {'key': 'key4'}
         self.broker.get(1231231, message)
-        expected_node = self.broker._nodes_connections[id1]
+        expected_node = self.broker._nodes_connections[id2]
         expected_node.get.assert_called_once_with(message)
 
     def test_batch_wait_all(self):
         id1, id2 = self.setup_two_nodes()
         main_node = self.broker._nodes_connections[id1]
         secondary_node = self.broker._nodes_connections[id2]
-        d = self.broker.batch(main_node, True, 'dummy', 'arg1', arg2=2)
+        main_node.dummy.return_value = defer.succeed(True)
+        secondary_node.dummy.return_value = secondary_defer = defer.Deferred()
+        d = self.broker.batch(
+            [main_node, secondary_node], quorum.ALL, 'dummy', 'arg1', arg2=2)
 
         main_node.dummy.assert_called_with('arg1', arg2=2)
         secondary_node.dummy.assert_called_with('arg1', arg2=2)
-        self.assertEqual(len(d._deferredList), 2)  # wait all
+        self.assertNoResult(d)  # wait all
+        secondary_defer.callback(True)
+        self.assertEqual(self.successResultOf(d), [True, True])
 
     def test_batch_dont_wait_all(self):
         id1, id2 = self.setup_two_nodes()
         main_node = self.broker._nodes_connections[id1]
         secondary_node = self.broker._nodes_connections[id2]
-        d = self.broker.batch(main_node, False, 'dummy', 'arg1', arg2=2)
+        main_node.dummy.return_value = defer.succeed(True)
+        secondary_node.dummy.return_value = defer.Deferred()
+        d = self.broker.batch(
+            [main_node, secondary_node], quorum.ONE, 'dummy', 'arg1', arg2=2)
 
         main_node.dummy.assert_called_with('arg1', arg2=2)
         secondary_node.dummy.assert_called_with('arg1', arg2=2)
-        self.assertEqual(len(d._deferredList), 1)  # wait all
+        self.assertEqual(self.successResultOf(d), [True])
+
+    def test_set_stamps_version(self):
+        self.broker.reply = MagicMock()
+        id1, id2 = self.setup_two_nodes()
+        for node in self.broker._nodes_connections.values():
+            node.set.return_value = defer.succeed(True)
+
+        self.broker.set(1231231, {'key': 'key1', 'value': 1, 'w': 'quorum'})
+        first = self.broker._nodes_connections[id1].set.call_args[0][0]
+        self.broker.set(1231231, {'key': 'key1', 'value': 2})
+        second = self.broker._nodes_connections[id1].set.call_args[0][0]
+        self.assertTrue(second['version'] > first['version'])
+        self.broker.reply.assert_called_with(1231231, True)
+
+    def test_get_with_read_quorum(self):
+        self.broker.reply = MagicMock()
+        id1, id2 = self.setup_two_nodes()
+        self.broker._nodes_connections[id1].get.return_value = (
+            defer.succeed(['old', 1]))
+        self.broker._nodes_connections[id2].get.return_value = (
+            defer.succeed(['new', 2]))
+
+        message = {'key': 'key1', 'r': 'all'}
+        self.broker.get(1231231, message)
+        self.broker._nodes_connections[id1].get.assert_called_once_with(
+            {'key': 'key1', 'r': 'all', 'versioned': True})
+        self.broker.reply.assert_called_once_with(1231231, 'new')
+
+    def test_on_error_codes(self):
+        self.broker.reply_error = MagicMock()
+        self.broker._on_error(
+            failure.Failure(QuorumError('1 of 2 failed.')), 'set', 123)
+        self.broker.reply_error.assert_called_with(
+            123, 'QUORUM_FAILED', '1 of 2 failed.')
+
+        self.broker._on_error(failure.Failure(ZeroNodeError()), 'set', 123)
+        self.broker.reply_error.assert_called_with(
+            123, 'ZERO_NODES', 'There are no nodes registered.')
+
+        self.broker._on_error(
+            failure.Failure(BackpressureError('Too far behind.')), 'set', 123)
+        self.broker.reply_error.assert_called_with(
+            123, 'BACKPRESSURE', 'Too far behind.')
+
+    def test_mset(self):
+        self.broker.reply = MagicMock()
+        self.broker._replication = 1
+        id1, id2 = self.setup_two_nodes()
+        node1 = self.broker._nodes_connections[id1]
+        node2 = self.broker._nodes_connections[id2]
+        node1.mset.return_value = defer.succeed({'key1': True, 'key3': True})
+        node2.mset.return_value = defer.succeed({'key4': True})
+
+        self.broker.mset(
+            123, {'items': {'key1': 1, 'key3': 3, 'key4': 4}, 'expires': 5})
+        # One message per node, with all its keys.
+        request = node1.mset.call_args[0][0]
+        self.assertEqual(request['items'], {'key1': 1, 'key3': 3})
+        self.assertEqual(request['expires'], 5)
+        request = node2.mset.call_args[0][0]
+        self.assertEqual(request['items'], {'key4': 4})
+        self.broker.reply.assert_called_once_with(
+            123, {'key1': True, 'key3': True, 'key4': True})
+
+    def test_mset_quorum_failed(self):
+        self.broker.reply = MagicMock()
+        id1, id2 = self.setup_two_nodes()
+        node1 = self.broker._nodes_connections[id1]
+        node2 = self.broker._nodes_connections[id2]
+        node1.mset.return_value = defer.succeed({'key1': True})
+        node2.mset.return_value = defer.fail(ValueError())
+
+        d = self.broker.mset(123, {'items': {'key1': 1}})
+        self.failureResultOf(d, QuorumError)
+
+        node1.mset.return_value = defer.succeed({'key1': True})
+        node2.mset.return_value = defer.fail(ValueError())
+        self.broker.mset(123, {'items': {'key1': 1}, 'w': 'one'})
+        self.broker.reply.assert_called_once_with(123, {'key1': True})
+
+    def test_mget(self):
+        self.broker.reply = MagicMock()
+        id1, id2 = self.setup_two_nodes()
+        node1 = self.broker._nodes_connections[id1]
+        node2 = self.broker._nodes_connections[id2]
+        node1.mget.return_value = defer.succeed({'key1': 1, 'key3': 3})
+        node2.mget.return_value = defer.succeed({'key4': 4})
+
+        self.broker.mget(123, {'keys': ['key1', 'key3', 'key4', 'key1']})
+        node1.mget.assert_called_once_with(
+            {'action': 'mget', 'keys': ['key1', 'key3'], 'versioned': False})
+        self.broker.reply.assert_called_once_with(
+            123, {'key1': 1, 'key3': 3, 'key4': 4})
+
+    def test_mget_read_quorum(self):
+        self.broker.reply = MagicMock()
+        id1, id2 = self.setup_two_nodes()
+        node1 = self.broker._nodes_connections[id1]
+        node2 = self.broker._nodes_connections[id2]
+        node1.mget.return_value = defer.succeed({'key1': ['old', 1]})
+        node2.mget.return_value = defer.succeed({'key1': ['new', 2]})
+
+        self.broker.mget(123, {'keys': ['key1'], 'r': 'all'})
+        self.broker.reply.assert_called_once_with(123, {'key1': 'new'})
+
+    def test_mremove(self):
+        self.broker.reply = MagicMock()
+        id1, id2 = self.setup_two_nodes()
+        node1 = self.broker._nodes_connections[id1]
+        node2 = self.broker._nodes_connections[id2]
+        node1.mremove.return_value = defer.succeed({'key1': True})
+        node2.mremove.return_value = defer.succeed({'key1': False})
+
+        self.broker.next_version = MagicMock(return_value=10)
+        self.broker.mremove(123, {'keys': ['key1'], 'w': 'one'})
+        node2.mremove.assert_called_once_with(
+            {'action': 'mremove', 'keys': ['key1'], 'version': 10})
+        self.broker.reply.assert_called_once_with(123, {'key1': True})
+
+    def published(self, tag):
+        return [call[0][1] for call in
+                self.broker._publisher.send_message.call_args_list
+                if call[0][0] == tag]
+
+    def test_publish_members(self):
+        self.broker._publisher = MagicMock()
+        self.broker.register_node('node-1', 'address-1')
+        [message] = self.published('membership')
+        self.assertEqual(message['topology'], 1)
+        [[node_id, address, stamp, registered]] = message['members']
+        self.assertEqual([node_id, address, registered],
+                         ['node-1', 'address-1', True])
+
+        self.broker.unregister_node('node-1')
+        message = self.published('membership')[-1]
+        self.assertEqual(message['topology'], 2)
+        [[node_id, address, later, registered]] = message['members']
+        self.assertTrue(later > stamp)
+        self.assertFalse(registered)
+
+    def test_merge_members(self):
+        self.broker._queue_size = 0
+        self.broker.transfer = MagicMock()
+        self.broker.register_node('node-1', 'address-1')
+        self.assertTrue(self.broker.merge_members(
+            [['node-2', 'address-2', 10 ** 18, True]], version=5))
+        self.assertEqual(self.broker._nodes, ['node-1', 'node-2'])
+        self.assertEqual(self.broker._ring.nodes, ('node-1', 'node-2'))
+        self.assertEqual(self.broker._topology_version, 5)
+        connection = self.broker._nodes_connections['node-2']
+        connection.topology.assert_called_with(5)
+        # Peers tell nodes to copy keys, not us.
+        self.broker.transfer.assert_not_called()
+        self.assertTrue(self.broker.next_version() > 10 ** 18)
+
+        # Older changes are ignored.
+        self.assertFalse(self.broker.merge_members(
+            [['node-2', None, 10, False]], version=3))
+        self.assertEqual(self.broker._topology_version, 5)
+
+        self.assertFalse(self.broker.merge_members(
+            [['node-2', 'address-2', 10 ** 18, True]], version=7))
+        self.assertEqual(self.broker._topology_version, 7)
+
+        self.assertTrue(self.broker.merge_members(
+            [['node-2', None, 10 ** 18 + 1, False]], version=7))
+        self.assertEqual(self.broker._nodes, ['node-1'])
+        self.assertEqual(self.broker._topology_version, 8)
+        connection.shutdown.assert_called_once_with()
+
+    def test_versions_carry_the_broker_id(self):
+        brokers = []
+        for broker_id in (1, 2):
+            broker = TestBroker(MagicMock(), MagicMock())
+            broker._init_instance(broker_id=broker_id)
+            brokers.append(broker)
+        with patch('brainer.broker.broker.time.time', return_value=1000.0):
+            first, second = [broker.next_version() for broker in brokers]
+            # Same microsecond, still apart.
+            self.assertNotEqual(first, second)
+            self.assertEqual(version_micros(first), version_micros(second))
+            later = brokers[0].next_version()
+        self.assertTrue(later > first)
+        self.assertEqual(later & MAX_BROKER_ID, 1)
+
+        self.assertRaises(
+            ValueError, TestBroker(MagicMock(), MagicMock())._init_instance,
+            broker_id=MAX_BROKER_ID + 1)
+
+    def test_peers_need_a_publisher(self):
+        self.assertRaises(
+            ValueError, TestBroker(MagicMock(), MagicMock())._init_instance,
+            peers=['ipc:///tmp/peer.sock'])
+
+    def test_publish_topology(self):
+        self.broker._publisher = MagicMock()
+        self.broker.register_node('node-1', 'address-1')
+        [message] = self.published('topology')
+        self.assertEqual(message['event'], 'joined')
+        self.assertEqual(message['node_id'], 'node-1')
+        self.assertEqual(message['topology'], self.broker.get_topology())
+
+        self.broker.merge_members(
+            [['node-2', 'address-2', 10 ** 18, True]], version=5)
+        message = self.published('topology')[-1]
+        self.assertEqual([message['event'], message['node_id']],
+                         ['joined', 'node-2'])
+        self.assertEqual(message['topology']['version'], 5)
+
+        self.broker.merge_members([], version=6)
+        message = self.published('topology')[-1]
+        self.assertIsNone(message['event'])
+        self.assertEqual(message['topology']['version'], 6)
+
+        self.broker.unregister_node('node-1')
+        message = self.published('topology')[-1]
+        self.assertEqual([message['event'], message['node_id']],
+                         ['left', 'node-1'])
+        self.assertEqual(message['topology']['nodes'],
+                         [['node-2', 'address-2']])
@@ -1,10 +1,9 @@
 # -*- coding: utf8 -*-
-from datetime import datetime, timedelta
-
 from mock import patch
 from twisted.trial import unittest
 
-from brainer.lib.cache import InMemoryCache, BaseCache
+from brainer.lib.cache import InMemoryCache, BaseCache, BoundedCache
+from brainer.lib.clock import monotonic
 
 
 class BaseCacheTest(unittest.TestCase):
@@ -23,6 +22,9 @@ class BaseCacheTest(unittest.TestCase):
     def test_remove(self):
         self.assertRaises(NotImplementedError, self.cache.remove, 'key')
 
+    def test_version(self):
+        self.assertRaises(NotImplementedError, self.cache.version, 'key')
+
 
 class InMemoryCacheTest(unittest.TestCase):
     def setUp(self):
@@ -45,19 +47,81 @@ class InMemoryCacheTest(unittest.TestCase):
         self.cache.set('will_be_expired', True, 10)
         my_value = self.cache.get('will_be_expired')
         self.assertEqual(my_value, True)
-        with patch('brainer.lib.cache.datetime') as mock_datetime:
+        later = monotonic() + 2 * 60 * 60
+        with patch('brainer.lib.cache.monotonic', return_value=later):
             # It's 2 hours later now.
-            mock_datetime.now.return_value = (
-                datetime.now() + timedelta(hours=2))
-
             my_value = self.cache.get('will_be_expired')
             self.assertEqual(my_value, None)
 
+    def test_version(self):
+        self.assertEqual(self.cache.version('test'), None)
+        self.cache.set('test', 1, version=10)
+        self.assertEqual(self.cache.version('test'), 10)
+        self.assertEqual(self.cache.snapshot()['version'], {'test': 10})
+        self.cache.set('test', 1)
+        self.assertEqual(self.cache.version('test'), None)
+        self.cache.set('test', 1, version=11)
+        self.cache.remove('test')
+        self.assertEqual(self.cache.version('test'), None)
+
+    def test_replay(self):
+        self.cache.replay({
+            'data': {'a': 1}, 'expiration': {}, 'version': {'a': 3}})
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.version('a'), 3)
+
+        # Snapshots without versions are fine too.
+        self.cache.replay({'data': {'b': 2}, 'expiration': {}}, update=True)
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(self.cache.version('a'), 3)
+
     def test_remove(self):
         self.cache.set('test', 1)
         self.assertEqual(self.cache.remove('test'), True)
         self.assertEqual(self.cache.remove('test'), False)
 
+    def test_versioned_remove_leaves_a_tombstone(self):
+        self.cache.set('a', 1, version=10)
+        self.assertEqual(self.cache.remove('a', version=11), True)
+        self.assertEqual(self.cache.version('a'), 11)
+        self.assertEqual(self.cache.removed_keys(), ['a'])
+        self.assertNotEqual(self.cache.digests(0), InMemoryCache().digests(0))
+        self.assertEqual(self.cache.export(['a'])['tombstone'].keys(), ['a'])
+
+        # An older write arriving late doesn't bring the key back.
+        self.cache.replay({
+            'data': {'a': 1}, 'expiration': {}, 'version': {'a': 10}},
+            update=True)
+        self.assertEqual(self.cache.get('a'), None)
+
+        self.cache.set('a', 2, version=12)
+        self.assertEqual(self.cache.removed_keys(), [])
+        self.assertEqual(self.cache.version('a'), 12)
+
+    def test_replay_tombstones(self):
+        self.cache.set('a', 1, version=10)
+        self.cache.set('b', 2, version=20)
+        self.cache.replay({
+            'data': {}, 'expiration': {}, 'version': {},
+            'tombstone': {'a': [11, 60], 'b': [15, 60]}}, update=True)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+
+        other = InMemoryCache()
+        other.replay(self.cache.snapshot())
+        self.assertEqual(other.version('a'), 11)
+        self.assertEqual(other.digests(0), self.cache.digests(0))
+
+    def test_tombstones_expire(self):
+        cache = InMemoryCache(tombstone_grace=60)
+        cache.set('a', 1, version=10)
+        cache.remove('a', version=11)
+        later = monotonic() + 61
+        with patch('brainer.lib.cache.monotonic', return_value=later):
+            cache.expire()
+        self.assertEqual(cache.version('a'), None)
+        self.assertEqual(cache.digests(0), InMemoryCache().digests(0))
+
     def test_get(self):
         self.assertEqual(self.cache.get(None), None)
         self.assertRaises(TypeError, self.cache.get, [])
@@ -65,3 +129,128 @@ class InMemoryCacheTest(unittest.TestCase):
         self.cache.set('test', [1, 2, 3])
         self.assertEqual(
             self.cache.get('test'), [1, 2, 3])
+
+    def test_replay_update_keeps_newer(self):
+        self.cache.set('a', 'new', version=10)
+        self.cache.replay({
+            'data': {'a': 'old', 'b': 2}, 'expiration': {},
+            'version': {'a': 5, 'b': 1}}, update=True)
+        self.assertEqual(self.cache.get('a'), 'new')
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_export(self):
+        self.cache.set('a', 1, version=3)
+        self.cache.set('b', 2, expires=10)
+        snapshot = self.cache.export(['a', 'b', 'missing'])
+        self.assertEqual(snapshot['data'], {'a': 1, 'b': 2})
+        self.assertEqual(snapshot['version'], {'a': 3})
+        self.assertEqual(snapshot['expiration'].keys(), ['b'])
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'b'])
+
+    def test_expire(self):
+        self.cache.set('short', 1, expires=10)
+        self.cache.set('long', 2, expires=100)
+        self.cache.set('reset', 3, expires=10)
+        self.cache.set('reset', 3)
+        self.cache.set('forever', 4)
+
+        later = monotonic() + 50
+        with patch('brainer.lib.cache.monotonic', return_value=later):
+            self.assertEqual(self.cache.expire(limit=1), 1)
+            self.assertEqual(self.cache.expire(), 0)
+        self.assertEqual(
+            sorted(self.cache.keys()), ['forever', 'long', 'reset'])
+        self.assertEqual(self.cache._expiration.keys(), ['long'])
+
+    def test_snapshot_exports_seconds_left(self):
+        self.cache.set('a', 1, expires=10)
+        with patch('brainer.lib.cache.monotonic',
+                   return_value=self.cache._expiration['a'] - 4):
+            self.assertEqual(self.cache.snapshot()['expiration'], {'a': 4})
+            self.assertEqual(self.cache.export(['a'])['expiration'], {'a': 4})
+
+        other = InMemoryCache()
+        other.replay({'data': {'a': 1}, 'expiration': {'a': 4}})
+        self.assertTrue(other._expiration['a'] - monotonic() <= 4)
+
+
+class BoundedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = BoundedCache(
+            max_items=3, max_bytes=100, sizeof=lambda key, value: value)
+
+    def test_max_items(self):
+        for key in 'abc':
+            self.cache.set(key, 1)
+        self.cache.get('a')
+        self.cache.set('d', 1)
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'c', 'd'])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        self.cache.set('a', 40)
+        self.cache.set('b', 40)
+        self.cache.set('a', 30)
+        self.assertEqual(self.cache.stats()['bytes'], 70)
+        self.cache.set('c', 40)
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'c'])
+        self.assertEqual(self.cache.stats(), {
+            'items': 2, 'bytes': 70, 'max_items': 3, 'max_bytes': 100,
+            'evictions': 1, 'evicted_bytes': 40})
+
+    def test_too_large(self):
+        self.cache.set('a', 10)
+        self.assertFalse(self.cache.set('a', 101))
+        self.assertEqual(self.cache.keys(), [])
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_remove(self):
+        self.cache.set('a', 10)
+        self.cache.remove('a')
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+        self.assertEqual(self.cache._policy.victim(), None)
+
+    def test_no_byte_limit(self):
+        sizes = []
+        cache = BoundedCache(
+            max_items=2, sizeof=lambda key, value: sizes.append(key))
+        cache.set('a', 1)
+        cache.set('b', 1)
+        cache.get('a')
+        cache.set('c', 1)
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+        self.assertEqual(sizes, [])
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_merge_updates_held_keys_only(self):
+        self.cache.set('a', 10, version=1)
+        self.cache.set('b', 10, version=1)
+        self.cache.merge({
+            'data': {'a': 20, 'evicted': 10}, 'expiration': {},
+            'version': {'a': 2, 'evicted': 2},
+            'tombstone': {'b': [2, 60]}})
+        self.assertEqual(self.cache.keys(), ['a'])
+        self.assertEqual(self.cache.get('a'), 20)
+        self.assertEqual(self.cache.version('b'), 2)
+        self.assertEqual(self.cache.stats()['bytes'], 20)
+
+    def test_ttl_policy(self):
+        cache = BoundedCache(max_items=2, policy='ttl')
+        cache.set('forever', 1)
+        cache.set('soon', 1, expires=10)
+        cache.set('late', 1, expires=20)
+        self.assertEqual(sorted(cache.keys()), ['forever', 'late'])
+
+    def test_replay(self):
+        for key in 'abc':
+            self.cache.set(key, 1)
+        self.cache.replay({
+            'data': {'x': 60, 'y': 60}, 'expiration': {}, 'version': {}})
+        self.assertEqual(len(self.cache.keys()), 1)
+        self.assertEqual(self.cache.stats()['bytes'], 60)
+
+        self.cache.replay({
+            'data': {'z': 10, 'w': 10, 'v': 10}, 'expiration': {}},
+            update=True)
+        self.assertEqual(len(self.cache.keys()), 3)
+        self.assertEqual(self.cache.stats()['bytes'], 30)
@@ -1,8 +1,15 @@
 # -*- coding: utf8 -*-
+import time
+import threading
+
+import zmq
+import umsgpack
 from mock import MagicMock, patch
 from twisted.trial import unittest
 
-from brainer.client import Brainer
+from brainer.client import (
+    Brainer, PipelinedBrainer, BrainerPool, SmartBrainer, TopologySubscriber)
+from brainer.lib.exceptions import RequestTimeoutError, PoolExhaustedError
 
 
 class BrainerClientTest(unittest.TestCase):
@@ -24,6 +31,13 @@ class BrainerClientTest(unittest.TestCase):
         socket = self.mock_zmq.Context().socket()
         socket.connect.assert_called_once_with(self.address)
 
+    def test_connect_many_brokers(self):
+        brainer = Brainer(['address1', 'address2'])
+        brainer.connect()
+        self.assertEqual(
+            [call[0][0] for call in brainer.socket.connect.call_args_list],
+            ['address1', 'address2'])
+
     def test_get(self):
         self.assertRaises(TypeError, self.brainer.get)  # no key
         with patch('brainer.client.Brainer._request') as mock_request:
@@ -46,9 +60,375 @@ class BrainerClientTest(unittest.TestCase):
                 "key": "keytest2", "action": "set",
                 "value": "valuetest2", "wait_all": False})
 
+            self.brainer.set('keytest3', 'valuetest3', replication=2)
+            mock_request.assert_called_with({
+                "key": "keytest3", "action": "set",
+                "value": "valuetest3", "wait_all": True, "replication": 2})
+
     def test_remove(self):
         self.assertRaises(TypeError, self.brainer.remove)  # no key
         with patch('brainer.client.Brainer._request') as mock_request:
             self.brainer.remove('keytest')
             mock_request.assert_called_once_with(
                 {"key": "keytest", "action": "remove", 'wait_all': True})
+
+    def test_get_many(self):
+        with patch('brainer.client.Brainer._request') as mock_request:
+            self.brainer.get_many(['key1', 'key2'])
+            mock_request.assert_called_once_with(
+                {"keys": ["key1", "key2"], "action": "mget"})
+
+    def test_set_many(self):
+        with patch('brainer.client.Brainer._request') as mock_request:
+            self.brainer.set_many({'key1': 1, 'key2': 2}, w='quorum')
+            mock_request.assert_called_once_with({
+                "items": {'key1': 1, 'key2': 2}, "action": "mset",
+                "wait_all": True, "w": "quorum"})
+
+            self.brainer.set_many({'key1': 1}, expires=10)
+            mock_request.assert_called_with({
+                "items": {'key1': 1}, "action": "mset",
+                "wait_all": True, "expires": 10})
+
+    def test_set_expires(self):
+        with patch('brainer.client.Brainer._request') as mock_request:
+            self.brainer.set('keytest', 'valuetest', expires=1.5)
+            mock_request.assert_called_once_with({
+                "key": "keytest", "action": "set", "value": "valuetest",
+                "wait_all": True, "expires": 1.5})
+
+    def test_remove_many(self):
+        with patch('brainer.client.Brainer._request') as mock_request:
+            self.brainer.remove_many(['key1', 'key2'])
+            mock_request.assert_called_once_with({
+                "keys": ["key1", "key2"], "action": "mremove",
+                "wait_all": True})
+
+    def test_timeout(self):
+        self.brainer.timeout = 1
+        socket = self.mock_zmq.Context().socket()
+        socket.poll.return_value = 0
+        self.assertRaises(RequestTimeoutError, self.brainer.get, 'keytest')
+        socket.poll.assert_called_once_with(1000)
+        self.assertTrue(self.brainer.broken)
+
+
+class FakeBrainer(object):
+    def __init__(self, address, context=None, timeout=None):
+        self.address = address
+        self.context = context
+        self.broken = False
+        self.closed = False
+        self.connect = MagicMock()
+
+    def close(self):
+        self.closed = True
+
+    def _request(self, message):
+        return message
+
+
+class BrainerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.context = MagicMock()
+        self.pool = BrainerPool(
+            'anaddress', max_connections=2, wait=0.01,
+            context=self.context, client_class=FakeBrainer)
+
+    def test_request(self):
+        self.assertEqual(
+            self.pool.get('keytest'), {'action': 'get', 'key': 'keytest'})
+        self.assertEqual(len(self.pool), 1)
+
+    def test_reuses_connections(self):
+        with self.pool.connection() as client:
+            client.connect.assert_called_once_with()
+            self.assertIs(client.context, self.context)
+
+        with self.pool.connection() as same_client:
+            self.assertIs(same_client, client)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_max_connections(self):
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertRaises(PoolExhaustedError, self.pool.acquire)
+
+        self.pool.release(first)
+        self.assertIs(self.pool.acquire(), first)
+
+    def test_replaces_broken_connections(self):
+        with self.pool.connection() as client:
+            client.broken = True
+
+        self.assertTrue(client.closed)
+        self.assertEqual(len(self.pool), 0)
+        with self.pool.connection() as new_client:
+            self.assertIsNot(new_client, client)
+
+    def test_waiters_see_broken_connections_go(self):
+        self.pool._wait = 5
+        first, second = self.pool.acquire(), self.pool.acquire()
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(self.pool.acquire()))
+        waiter.start()
+        # Let the waiter find the pool full and start waiting.
+        time.sleep(0.1)
+        second.broken = True
+        self.pool.release(second)
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        self.assertNotIn(acquired[0], (first, second))
+        self.assertEqual(len(self.pool), 2)
+
+    def test_close(self):
+        with self.pool.connection() as client:
+            pass
+        self.pool.close()
+        self.assertTrue(client.closed)
+        self.assertEqual(len(self.pool), 0)
+
+
+class SmartBrainerTest(unittest.TestCase):
+    def setUp(self):
+        self.topology = {
+            'version': 1, 'vnodes': 160, 'replication': 2,
+            'nodes': [['node-1', 'address-1'], ['node-2', 'address-2']]}
+        self.node_clients = {}
+        self.patcher = patch('brainer.client.Brainer', self.create_node)
+        self.patcher.start()
+        self.brainer = SmartBrainer('broker', MagicMock())
+        self.brainer._request = MagicMock(side_effect=self.broker_request)
+        self.brainer.connect()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create_node(self, address, context, timeout):
+        client = self.node_clients[address] = MagicMock()
+        client.address = address
+        return client
+
+    def broker_request(self, message):
+        if message['action'] == 'topology':
+            return self.topology
+        return 'from broker'
+
+    def test_refresh(self):
+        self.assertEqual(self.brainer.topology_version, 1)
+        self.assertEqual(
+            sorted(self.brainer._node_clients), ['node-1', 'node-2'])
+        self.node_clients['address-1'].connect.assert_called_once_with()
+
+        self.topology = {
+            'version': 2, 'vnodes': 160, 'replication': 2,
+            'nodes': [['node-2', 'address-2'], ['node-3', 'address-3']]}
+        self.brainer.refresh()
+        self.assertEqual(
+            sorted(self.brainer._node_clients), ['node-2', 'node-3'])
+        self.node_clients['address-1'].close.assert_called_once_with()
+
+    def test_get_goes_to_the_node(self):
+        node = self.node_clients['address-1']
+        node._receive.return_value = 'value1'
+        self.assertEqual(self.brainer.get('key1'), 'value1')
+        node._send.assert_called_once_with(
+            {'action': 'get', 'key': 'key1', 'topology': 1})
+
+        # Asking more replicas goes through the broker.
+        self.assertEqual(self.brainer.get('key1', r='all'), 'from broker')
+
+    def test_get_stale_topology(self):
+        stale = {'success': False, 'code': 'STALE_TOPOLOGY', 'message': ''}
+        node = self.node_clients['address-1']
+        node._receive.side_effect = [stale, 'value1']
+        self.topology = dict(self.topology, version=2)
+        self.assertEqual(self.brainer.get('key1'), 'value1')
+        self.assertEqual(self.brainer.topology_version, 2)
+        node._send.assert_called_with(
+            {'action': 'get', 'key': 'key1', 'topology': 2})
+
+    def test_get_node_timeout(self):
+        node = self.node_clients['address-1']
+        node._receive.side_effect = RequestTimeoutError(1)
+        self.assertEqual(self.brainer.get('key1'), 'from broker')
+        node.close.assert_called_once_with()
+        self.assertIsNot(self.brainer._node_clients['node-1'], node)
+
+    def test_get_many(self):
+        node1 = self.node_clients['address-1']
+        node2 = self.node_clients['address-2']
+        node1._receive.return_value = {'key1': 1, 'key3': 3}
+        node2._receive.return_value = {'key4': 4}
+        self.assertEqual(
+            self.brainer.get_many(['key1', 'key3', 'key4']),
+            {'key1': 1, 'key3': 3, 'key4': 4})
+        node1._send.assert_called_once_with(
+            {'action': 'mget', 'keys': ['key1', 'key3'], 'topology': 1})
+
+    def test_get_many_stale_topology(self):
+        node1 = self.node_clients['address-1']
+        node2 = self.node_clients['address-2']
+        node1._receive.return_value = {'key1': 1}
+        node2._receive.return_value = {
+            'success': False, 'code': 'STALE_TOPOLOGY', 'message': ''}
+        self.assertEqual(
+            self.brainer.get_many(['key1', 'key4']), 'from broker')
+
+
+    def test_update_from_publisher(self):
+        brainer = SmartBrainer('broker', MagicMock(), publisher='publisher')
+        brainer._request = MagicMock(side_effect=self.broker_request)
+        brainer._subscriber = MagicMock()
+        brainer._subscriber.receive_all.return_value = []
+        brainer.connect()
+        brainer._subscriber.connect.assert_called_once_with()
+        self.assertFalse(brainer.update())
+
+        newer = {'version': 3, 'vnodes': 160, 'replication': 1,
+                 'nodes': [['node-3', 'address-3']]}
+        brainer._subscriber.receive_all.return_value = [
+            {'event': 'joined', 'node_id': 'node-3', 'topology': newer},
+            {'event': None, 'node_id': None,
+             'topology': dict(self.topology, version=2)}]
+        self.assertTrue(brainer.update())
+        self.assertEqual(brainer.topology_version, 3)
+        brainer._subscriber.receive_all.return_value = []
+        self.node_clients['address-3']._receive.return_value = 'value'
+        self.assertEqual(brainer.get('key1'), 'value')
+        self.assertEqual(list(brainer._node_clients), ['node-3'])
+        self.assertEqual(brainer._request.call_count, 1)
+
+        brainer._subscriber.receive_all.return_value = [
+            {'event': None, 'node_id': None, 'topology': self.topology}]
+        self.assertFalse(brainer.update())
+        self.assertEqual(brainer.topology_version, 3)
+
+
+class TopologySubscriberTest(unittest.TestCase):
+    """Runs against a PUB socket standing for the broker publisher."""
+    def setUp(self):
+        self.context = zmq.Context()
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.bind('inproc://publisher')
+        self.subscriber = TopologySubscriber(
+            'inproc://publisher', self.context)
+        self.subscriber.connect()
+
+    def tearDown(self):
+        self.subscriber.close()
+        self.publisher.close(linger=0)
+        self.context.term()
+
+    def test_receive(self):
+        message = {'event': 'left', 'node_id': 'node-1',
+                   'topology': {'version': 2}}
+        self.publisher.send(b'membership\0' + umsgpack.packb({}))
+        # Subscriptions take a moment to reach the publisher.
+        for _ in range(100):
+            self.publisher.send(b'topology\0' + umsgpack.packb(message))
+            received = self.subscriber.receive(timeout=0.01)
+            if received is not None:
+                break
+        self.assertEqual(received, message)
+        self.subscriber.receive_all()
+        self.assertIsNone(self.subscriber.receive(timeout=0))
+
+
+    def test_subscribes_with_bytes(self):
+        # pyzmq takes socket options as bytes only, on Python 3 too.
+        subscriber = TopologySubscriber('inproc://publisher', self.context)
+        subscriber.socket = MagicMock()
+        subscriber.connect()
+        subscriber.socket.setsockopt.assert_called_once_with(
+            zmq.SUBSCRIBE, b'topology')
+        prefix = subscriber.socket.setsockopt.call_args[0][1]
+        self.assertIsInstance(prefix, bytes)
+
+
+class PipelinedBrainerTest(unittest.TestCase):
+    """Runs against a ROUTER socket standing for the broker."""
+    def setUp(self):
+        self.context = zmq.Context()
+        self.broker = self.context.socket(zmq.ROUTER)
+        self.broker.bind('inproc://broker')
+        self.brainer = PipelinedBrainer('inproc://broker', self.context)
+        self.brainer.connect()
+
+    def tearDown(self):
+        self.brainer.socket.close(linger=0)
+        self.broker.close(linger=0)
+        self.context.term()
+
+    def receive_requests(self, count):
+        requests = []
+        for _ in range(count):
+            identity, request_id, empty, payload = (
+                self.broker.recv_multipart())
+            requests.append(
+                (identity, request_id, umsgpack.loads(payload)))
+        return requests
+
+    def reply(self, request, data):
+        identity, request_id, _ = request
+        self.broker.send_multipart(
+            [identity, request_id, b'', umsgpack.dumps(data)])
+
+    def test_out_of_order_replies(self):
+        first = self.brainer.get('key1')
+        second = self.brainer.get('key2')
+        self.assertEqual(self.brainer.pending(), 2)
+
+        requests = self.receive_requests(2)
+        self.assertEqual(requests[0][2], {'action': 'get', 'key': 'key1'})
+        self.reply(requests[1], 'value2')
+        self.reply(requests[0], 'value1')
+
+        self.assertEqual(first.result(timeout=1), 'value1')
+        self.assertTrue(second.done())
+        self.assertEqual(second.result(), 'value2')
+        self.assertEqual(self.brainer.pending(), 0)
+
+    def test_timeout(self):
+        future = self.brainer.get('key1')
+        self.assertRaises(RequestTimeoutError, future.result, 0.01)
+        self.assertFalse(future.done())
+
+    def test_request_ids(self):
+        other = PipelinedBrainer('inproc://broker', self.context)
+        other.connect()
+        try:
+            self.brainer.get('key1')
+            other.get('key1')
+            first, second = self.receive_requests(2)
+        finally:
+            other.socket.close(linger=0)
+        self.assertEqual(len(first[1]), 16)
+        self.assertNotEqual(first[1], second[1])
+
+    def serve_on_receive(self, replies):
+        """The broker answers, in reverse order, right before the client
+        reads its first reply."""
+        receive = self.brainer.receive
+
+        def serve(timeout=None):
+            self.brainer.receive = receive
+            requests = self.receive_requests(len(replies))
+            for request, data in reversed(zip(requests, replies)):
+                self.reply(request, data)
+            return receive(timeout)
+
+        self.brainer.receive = serve
+
+    def test_pipeline(self):
+        with self.brainer.pipeline() as pipe:
+            pipe.set('key1', 'value1')
+            pipe.get('key1')
+            self.assertEqual(len(pipe), 2)
+            # Nothing is sent until the pipeline is executed.
+            self.assertEqual(self.brainer.pending(), 0)
+            self.serve_on_receive([True, 'value1'])
+
+        self.assertEqual(pipe.results, [True, 'value1'])
+        self.assertEqual(len(pipe), 0)
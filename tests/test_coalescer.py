@@ -0,0 +1,59 @@
+# -*- coding: utf8 -*-
+from mock import MagicMock
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from brainer.broker.coalescer import WriteCoalescer
+
+
+class WriteCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connection = MagicMock()
+        self.reply = defer.Deferred()
+        self.connection.sendMsg.return_value = self.reply
+        self.coalescer = WriteCoalescer(
+            self.connection, window=0.01, max_size=3, clock=self.clock)
+
+    def test_window(self):
+        first = self.coalescer.set({'action': 'set', 'key': 'a'})
+        second = self.coalescer.remove({'action': 'remove', 'key': 'b'})
+        self.assertEqual(len(self.coalescer), 2)
+        self.connection.sendMsg.assert_not_called()
+
+        self.clock.advance(0.01)
+        self.connection.sendMsg.assert_called_once_with({
+            'action': 'apply',
+            'ops': [{'action': 'set', 'key': 'a'},
+                    {'action': 'remove', 'key': 'b'}]})
+        self.assertEqual(len(self.coalescer), 0)
+
+        self.reply.callback([True, False])
+        self.assertEqual(self.successResultOf(first), True)
+        self.assertEqual(self.successResultOf(second), False)
+
+    def test_max_size(self):
+        for key in ('a', 'b', 'c'):
+            self.coalescer.set({'action': 'set', 'key': key})
+        self.assertEqual(self.connection.sendMsg.call_count, 1)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_failure(self):
+        first = self.coalescer.set({'action': 'set', 'key': 'a'})
+        second = self.coalescer.mset({'action': 'mset', 'items': {}})
+        self.coalescer.flush()
+        self.reply.errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+
+    def test_other_methods_pass_through(self):
+        self.coalescer.get({'action': 'get', 'key': 'a'})
+        self.connection.get.assert_called_once_with(
+            {'action': 'get', 'key': 'a'})
+
+    def test_shutdown(self):
+        d = self.coalescer.set({'action': 'set', 'key': 'a'})
+        self.coalescer.shutdown()
+        self.failureResultOf(d, defer.CancelledError)
+        self.connection.shutdown.assert_called_once_with()
+        self.assertFalse(self.clock.getDelayedCalls())
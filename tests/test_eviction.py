@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+from twisted.trial import unittest
+
+from brainer.lib.eviction import (
+    EvictionPolicy, LRUPolicy, LFUPolicy, TTLPolicy, get_policy)
+
+
+class LRUPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = LRUPolicy()
+        for key in 'abc':
+            self.policy.add(key)
+
+    def test_victim(self):
+        self.assertEqual(self.policy.victim(), 'a')
+        self.policy.touch('a')
+        self.assertEqual(self.policy.victim(), 'b')
+        self.policy.update('b')
+        self.assertEqual(self.policy.victim(), 'c')
+        self.policy.discard('c')
+        self.assertEqual(self.policy.victim(), 'a')
+
+    def test_empty(self):
+        for key in 'abc':
+            self.policy.discard(key)
+        self.assertEqual(self.policy.victim(), None)
+
+    def test_queue_is_compacted(self):
+        for _ in range(5000):
+            self.policy.touch('b')
+        self.assertTrue(len(self.policy._queue) <= 1030)
+        self.assertEqual(self.policy.victim(), 'a')
+        self.policy.discard('a')
+        self.assertEqual(self.policy.victim(), 'c')
+
+
+class LFUPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = LFUPolicy(random=lambda: 0)
+        for key in 'abc':
+            self.policy.add(key)
+
+    def test_victim(self):
+        self.assertEqual(self.policy.victim(), 'a')
+        self.policy.touch('a')
+        self.policy.touch('b')
+        self.assertEqual(self.policy.victim(), 'c')
+        self.policy.discard('c')
+        # Same count, the oldest goes first.
+        self.assertEqual(self.policy.victim(), 'a')
+        self.policy.touch('b')
+        self.policy.discard('a')
+        self.assertEqual(self.policy.victim(), 'b')
+        self.policy.discard('b')
+        self.assertEqual(self.policy.victim(), None)
+
+    def test_counters_are_logarithmic(self):
+        policy = LFUPolicy(factor=10, random=lambda: 0.5)
+        policy.add('a')
+        policy.touch('a')
+        self.assertEqual(policy._counters['a'], LFUPolicy.INITIAL + 1)
+        # 1 / (1 * 10 + 1) is less than 0.5, no luck this time.
+        policy.touch('a')
+        self.assertEqual(policy._counters['a'], LFUPolicy.INITIAL + 1)
+
+    def test_counters_saturate(self):
+        self.policy._move('a', LFUPolicy.MAX_COUNTER)
+        self.policy.touch('a')
+        self.assertEqual(self.policy._counters['a'], LFUPolicy.MAX_COUNTER)
+
+
+class TTLPolicyTest(unittest.TestCase):
+    def test_victim(self):
+        policy = TTLPolicy()
+        policy.add('forever')
+        policy.add('late', 20)
+        policy.add('soon', 10)
+        self.assertEqual(policy.victim(), 'soon')
+        policy.update('soon', 30)
+        self.assertEqual(policy.victim(), 'late')
+        policy.discard('late')
+        self.assertEqual(policy.victim(), 'soon')
+        policy.update('soon')
+        self.assertEqual(policy.victim(), 'forever')
+        policy.touch('forever')
+        self.assertEqual(policy.victim(), 'soon')
+
+    def test_heap_is_compacted(self):
+        policy = TTLPolicy()
+        for deadline in range(5000):
+            policy.update('key', deadline)
+        self.assertTrue(len(policy._heap) <= 1026)
+        self.assertEqual(policy.victim(), 'key')
+        self.assertEqual(policy._heap, [(4999, 'key')])
+
+
+class GetPolicyTest(unittest.TestCase):
+    def test_get_policy(self):
+        self.assertIsInstance(get_policy('lru'), LRUPolicy)
+        self.assertIsInstance(get_policy('lfu'), LFUPolicy)
+        self.assertIsInstance(get_policy('ttl'), TTLPolicy)
+        policy = LRUPolicy()
+        self.assertIs(get_policy(policy), policy)
+        self.assertRaises(ValueError, get_policy, 'fifo')
+
+    def test_base(self):
+        policy = EvictionPolicy()
+        self.assertRaises(NotImplementedError, policy.add, 'key')
+        self.assertRaises(NotImplementedError, policy.victim)
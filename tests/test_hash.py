@@ -1,8 +1,12 @@
 # -*- coding: utf8 -*-
+from collections import Counter
+
 from twisted.trial import unittest
 
 
-from brainer.lib.hash import ConsistentHash, my_hash
+from brainer.lib.hash import (
+    ConsistentHash, HashRing, my_hash, hash64, search_sorted, shared_ranges,
+    keys_in_ranges, group_of)
 
 
 class ConsistentHashTest(unittest.TestCase):
@@ -50,6 +54,32 @@ class ConsistentHashTest(unittest.TestCase):
         self.assertEqual(ch.get_machine('key5'), 1)
         self.assertEqual(ch.get_machine('key6'), 2)
 
+    def test_hash_values_are_sorted(self):
+        ch = ConsistentHash(7, 3)
+        self.assertEqual(len(ch.hash_values), 21)
+        self.assertEqual(ch.hash_values, sorted(ch.hash_values))
+        self.assertEqual(ch.hash_values, [h for (_, _, h) in ch.hash_tuples])
+
+    def test_consistent_hash_wraps_around(self):
+        ch = ConsistentHash(3, 1)
+        # 'key' hashes past the last point of the ring, so it goes
+        # back to the first machine of the ring.
+        self.assertTrue(my_hash('key') > ch.hash_values[-1])
+        self.assertEqual(ch.get_machine('key'), ch.hash_tuples[0][0])
+
+    def test_get_machines(self):
+        ch = ConsistentHash(200, 20)
+        keys = ['key', 'key2', 'key3', 'key4', 'key5', 'key6']
+        self.assertEqual(
+            ch.get_machines(keys), [ch.get_machine(key) for key in keys])
+        self.assertEqual(ch.get_machines([]), [])
+
+    def test_search_sorted(self):
+        points = [10, 20, 30]
+        self.assertEqual(
+            search_sorted(points, [35, 5, 20, 21, 10, 30]),
+            [0, 0, 1, 2, 0, 2])
+
     def test_consistent_hash_200_machines_20_replicas(self):
         ch = ConsistentHash(200, 20)
 
@@ -59,3 +89,116 @@ class ConsistentHashTest(unittest.TestCase):
         self.assertEqual(ch.get_machine('key4'), 141)
         self.assertEqual(ch.get_machine('key5'), 22)
         self.assertEqual(ch.get_machine('key6'), 121)
+
+
+class HashRingTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = ['node-{}'.format(i) for i in range(20)]
+
+    def test_hash64(self):
+        self.assertEqual(hash64('key'), 4354430579665871434)
+        self.assertEqual(hash64(u'key'), hash64('key'))
+        self.assertTrue(0 <= hash64('key2') < 2 ** 64)
+
+    def test_no_nodes(self):
+        self.assertRaises(ValueError, HashRing, [])
+
+    def test_no_vnodes(self):
+        self.assertRaises(ValueError, HashRing, ['node-1'], 0)
+
+    def test_points(self):
+        ring = HashRing(self.nodes, vnodes=10)
+        self.assertEqual(len(ring), 200)
+        self.assertEqual(ring.points, sorted(ring.points))
+        self.assertEqual(Counter(ring.owners)['node-3'], 10)
+
+    def test_one_node(self):
+        ring = HashRing(['node-1'])
+        self.assertEqual(ring.get_node('key'), 'node-1')
+        self.assertEqual(ring.get_node('key2'), 'node-1')
+
+    def test_get_node(self):
+        ring = HashRing(['node-1', 'node-2'])
+        self.assertEqual(ring.get_node('key1'), 'node-1')
+        self.assertEqual(ring.get_node('key2'), 'node-1')
+        self.assertEqual(ring.get_node('key4'), 'node-2')
+
+    def test_get_nodes(self):
+        ring = HashRing(self.nodes)
+        keys = ['key-{}'.format(i) for i in range(5000)]
+        self.assertEqual(
+            ring.get_nodes(keys), [ring.get_node(key) for key in keys])
+
+    def test_get_replicas(self):
+        ring = HashRing(self.nodes)
+        replicas = ring.get_replicas('key1', 3)
+        self.assertEqual(len(set(replicas)), 3)
+        self.assertEqual(replicas[0], ring.get_node('key1'))
+        self.assertEqual(ring.get_replicas('key1', 2), replicas[:2])
+        # Never more replicas than nodes.
+        self.assertEqual(len(ring.get_replicas('key1', 50)), 20)
+
+    def test_replicas_of_distinct_groups(self):
+        nodes = ['machine-{}/{}'.format(machine, worker)
+                 for machine in range(3) for worker in range(4)]
+        ring = HashRing(nodes)
+        self.assertEqual(ring.groups, frozenset(
+            ['machine-0', 'machine-1', 'machine-2']))
+        for i in range(200):
+            replicas = ring.get_replicas('key-{}'.format(i), 5)
+            self.assertEqual(len(replicas), 3)
+            self.assertEqual(
+                len(set(group_of(node) for node in replicas)), 3)
+
+    def test_get_replicas_many(self):
+        ring = HashRing(self.nodes)
+        keys = ['key-{}'.format(i) for i in range(500)]
+        self.assertEqual(
+            ring.get_replicas_many(keys, 3),
+            [ring.get_replicas(key, 3) for key in keys])
+
+    def test_shared_ranges(self):
+        ring = HashRing(self.nodes[:5], vnodes=20)
+        keys = ['key-{}'.format(i) for i in range(2000)]
+        peers = ['node-1', 'node-3']
+        ranges = shared_ranges(ring, 2, peers)
+        self.assertEqual(ranges, sorted(ranges))
+        shared = [key for key in keys
+                  if sorted(ring.get_replicas(key, 2)) == peers]
+        self.assertTrue(shared)
+        self.assertEqual(keys_in_ranges(keys, ranges), shared)
+        self.assertEqual(
+            shared_ranges(ring, 5, peers), [[-1, 2 ** 64 - 1]])
+
+    def test_pluggable_hash_function(self):
+        ring = HashRing(['a', 'b'], vnodes=1, hash_function=len)
+        # 'a-0' and 'b-0' both hash to 3, anything longer wraps around.
+        self.assertEqual(ring.points, [3, 3])
+        self.assertEqual(ring.get_node('xx'), 'a')
+        self.assertEqual(ring.get_node('xxxxx'), 'a')
+
+    def test_adding_a_node_only_moves_its_keys(self):
+        keys = ['key-{}'.format(i) for i in range(2000)]
+        before = HashRing(self.nodes)
+        after = HashRing(self.nodes + ['node-new'])
+        for key in keys:
+            node = after.get_node(key)
+            if node != 'node-new':
+                self.assertEqual(node, before.get_node(key))
+
+    def test_distribution(self):
+        """Reports how evenly keys are spread across 20 nodes."""
+        keys = ['key-{}'.format(i) for i in range(100000)]
+        mean = len(keys) / float(len(self.nodes))
+
+        ring = HashRing(self.nodes)
+        load = Counter(ring.get_node(key) for key in keys)
+        spread = (min(load.values()) / mean, max(load.values()) / mean)
+        self.assertEqual(len(load), len(self.nodes))
+        self.assertTrue(spread[0] > 0.75, spread)
+        self.assertTrue(spread[1] < 1.25, spread)
+
+        # Compared to a single point per node.
+        ring = HashRing(self.nodes, vnodes=1)
+        load = Counter(ring.get_node(key) for key in keys)
+        self.assertTrue(max(load.values()) / mean > spread[1])
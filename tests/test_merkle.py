@@ -0,0 +1,68 @@
+# -*- coding: utf8 -*-
+from twisted.trial import unittest
+
+from brainer.lib import merkle
+from brainer.lib.hash import hash64, keys_in_ranges
+from brainer.lib.merkle import MerkleTree, item_digest
+
+
+class MerkleTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = MerkleTree(depth=4)
+
+    def test_incremental(self):
+        digest = item_digest('a', 1, version=10)
+        self.tree.update('a', None, digest)
+        self.assertEqual(self.tree.digests(0), [digest])
+        self.assertEqual(self.tree.keys([self.tree.bucket('a')]), ['a'])
+        self.assertEqual(sum(1 for d in self.tree.digests(4) if d), 1)
+
+        self.tree.update('a', digest, None)
+        self.assertEqual(self.tree.digests(0), [0])
+        self.assertEqual(self.tree.keys(range(16)), [])
+
+    def test_build_matches_updates(self):
+        items = [(key, item_digest(key, key)) for key in 'abcdefgh']
+        for key, digest in items:
+            self.tree.update(key, None, digest)
+        built = MerkleTree.build(items, depth=4)
+        self.assertEqual(built.digests(4), self.tree.digests(4))
+        self.assertEqual(
+            built.digests(2, [1, 3]), self.tree.digests(2, [1, 3]))
+
+    def test_digest_by_version(self):
+        self.assertEqual(
+            item_digest('a', 1, version=10), item_digest('a', 2, version=10))
+        self.assertNotEqual(item_digest('a', 1), item_digest('a', 2))
+
+    def test_view(self):
+        items = dict((key, item_digest(key, key)) for key in 'abcdefgh')
+        for key, digest in items.items():
+            self.tree.update(key, None, digest)
+        ranges = [[-1, hash64('c')], [hash64('e'), 2 ** 63]]
+
+        def built():
+            keys = keys_in_ranges(sorted(items), ranges)
+            return MerkleTree.build(
+                [(key, items[key]) for key in keys], depth=4).digests(4)
+
+        view = self.tree.view(ranges, items.iterkeys, items.get)
+        self.assertEqual(view.digests(4), built())
+        self.assertIs(self.tree.view(ranges, None, None), view)
+
+        # Kept up to date along with the tree.
+        for key in 'abcdefgh':
+            self.tree.update(key, items[key], item_digest(key, 1))
+            items[key] = item_digest(key, 1)
+        self.tree.update('c', items.pop('c'), None)
+        self.tree.update('x', None, item_digest('x', 1))
+        items['x'] = item_digest('x', 1)
+        self.assertEqual(view.digests(4), built())
+
+    def test_views_are_bounded(self):
+        self.patch(merkle, 'MAX_VIEWS', 2)
+        self.tree.update('a', None, item_digest('a', 1))
+        views = [self.tree.view([[-1, end]], list, None)
+                 for end in (10, 20, 30)]
+        self.assertEqual(len(self.tree._views), 2)
+        self.assertIsNot(self.tree.view([[-1, 10]], list, None), views[0])
@@ -0,0 +1,53 @@
+# -*- coding: utf8 -*-
+import sys
+
+from mock import MagicMock
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+if 'brainer' not in sys.path:
+    sys.path.append('brainer')
+
+from brainer.broker.monitor import NodeMonitor
+
+
+class NodeMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = MagicMock()
+        self.node = MagicMock()
+        self.broker._nodes_connections = {'node-1': self.node}
+        self.clock = task.Clock()
+        self.monitor = NodeMonitor(self.broker, interval=5, clock=self.clock)
+
+    def test_runs_every_interval(self):
+        self.node.ping.return_value = defer.succeed(True)
+        self.monitor.start()
+        self.node.ping.assert_not_called()
+        self.clock.advance(5)
+        self.node.ping.assert_called_once_with()
+        self.monitor.stop()
+        self.clock.advance(5)
+        self.assertEqual(self.node.ping.call_count, 1)
+
+    def test_suspected_and_recovered(self):
+        self.node.ping.side_effect = lambda: defer.fail(
+            RuntimeError('timeout'))
+        self.monitor.run()
+        self.broker.publish_topology.assert_called_once_with(
+            'suspected', 'node-1')
+        self.monitor.run()
+        self.assertEqual(self.broker.publish_topology.call_count, 1)
+
+        self.node.ping.side_effect = lambda: defer.succeed(True)
+        self.monitor.run()
+        self.broker.publish_topology.assert_called_with(
+            'recovered', 'node-1')
+        self.assertEqual(self.monitor.suspected, set())
+
+    def test_node_gone_meanwhile(self):
+        d = defer.Deferred()
+        self.node.ping.return_value = d
+        self.monitor.run()
+        self.broker._nodes_connections = {}
+        d.errback(RuntimeError('timeout'))
+        self.broker.publish_topology.assert_not_called()
@@ -2,13 +2,19 @@
 import sys
 import uuid
 
+import umsgpack
 from mock import MagicMock, patch
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
 if 'brainer' not in sys.path:
     sys.path.append('brainer')
 
 from brainer.node import Node
+from brainer.lib.cache import InMemoryCache, BoundedCache
+from brainer.lib.persistence import AppendOnlyCache, MappedCache
+from brainer.lib.hash import HashRing, moved_ranges
+from brainer.lib.versions import make_version
 
 
 class TestNode(Node):
@@ -25,6 +31,7 @@ class NodeTest(unittest.TestCase):
             'brainer.node.node.BrokerClient',
             self.mock_node_client)
         self.broker_patcher.start()
+        self.addCleanup(self.broker_patcher.stop)
         self.node = TestNode(
             self.mock_factory,
             self.mock_endpoint,
@@ -48,6 +55,261 @@ class NodeTest(unittest.TestCase):
         self.node._connected(message)
         self.node._cache.replay.assert_called_with(message['snapshot'])
 
+    def test_pull(self):
+        self.node.bootstrap = MagicMock()
+        sources = [['node-1', 'address1', [[-1, 100]]]]
+        self.assertTrue(
+            self.node.pull({'sources': sources, 'catch_up': True}))
+        self.node.bootstrap.assert_called_once_with(sources, True)
+
+    def test_snapshot_chunk(self):
+        self.node._cache = InMemoryCache()
+        for key in ('a', 'b', 'c'):
+            self.node._cache.set(key, key.upper(), version=1)
+
+        reply = self.node.snapshot_chunk({'count': 2})
+        chunk = dict(reply['chunk']['data'])
+        self.assertEqual(len(chunk), 2)
+        reply = self.node.snapshot_chunk(
+            {'count': 2, 'cursor': reply['cursor']})
+        chunk.update(reply['chunk']['data'])
+        self.assertEqual(reply['cursor'], None)
+        self.assertEqual(chunk, {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertEqual(self.node._snapshot_streams, {})
+
+        reply = self.node.snapshot_chunk({'cursor': ['gone', 0]})
+        self.assertTrue(reply['expired'])
+
+    @staticmethod
+    def moved_ranges():
+        # Only key4 moves to the second node.
+        return moved_ranges(
+            HashRing(['node-1']), HashRing(['node-1', 'node-2']),
+            1)['node-2']['node-1']
+
+    def test_snapshot_chunk_filtered(self):
+        self.node._cache = InMemoryCache()
+        self.node._cache.set('key1', 1)
+        self.node._cache.set('key4', 4)
+        reply = self.node.snapshot_chunk({'ranges': self.moved_ranges()})
+        self.assertEqual(reply['chunk']['data'], {'key4': 4})
+
+    def test_bootstrap(self):
+        self.node._cache = InMemoryCache()
+        self.node._cache.set('b', 'newer', version=10)
+        self.node._snapshot_rate = 1
+        self.node._clock = clock = task.Clock()
+        self.node._node_client_class = node_client = MagicMock()
+        connection = node_client.create.return_value
+        connection.snapshot_chunk.side_effect = [
+            defer.succeed({
+                'chunk': {'data': {'a': 1}, 'expiration': {},
+                          'version': {'a': 1}},
+                'cursor': ['stream', 1]}),
+            defer.succeed({
+                'chunk': {'data': {'b': 'older'}, 'expiration': {},
+                          'version': {'b': 2}},
+                'cursor': None})]
+
+        d = self.node.bootstrap([['node-1', 'address1', None]])
+        node_client.create.assert_called_once_with('address1')
+        connection.snapshot_chunk.assert_called_once_with(None, 1000, None)
+        self.assertEqual(self.node._cache.get('a'), 1)
+        self.assertNoResult(d)
+
+        clock.advance(1)
+        connection.snapshot_chunk.assert_called_with(
+            ['stream', 1], 1000, None)
+        self.successResultOf(d)
+        self.assertEqual(self.node._cache.get('b'), 'newer')
+        connection.shutdown.assert_called_once_with()
+
+    def test_bootstrap_bounded(self):
+        # Snapshots are copied in full, unlike repairs (see
+        # `BoundedCache.merge`).
+        self.node._cache = BoundedCache(max_items=10)
+        self.node._node_client_class = node_client = MagicMock()
+        connection = node_client.create.return_value
+        connection.snapshot_chunk.return_value = defer.succeed({
+            'chunk': {'data': {'a': 1, 'b': 2}, 'expiration': {},
+                      'version': {'a': 1, 'b': 2}},
+            'cursor': None})
+
+        d = self.node.bootstrap([['node-1', 'address1', None]])
+        self.successResultOf(d)
+        self.assertEqual(sorted(self.node._cache.keys()), ['a', 'b'])
+
+    def test_oplog(self):
+        self.node._cache = InMemoryCache()
+        self.node.set(
+            {'action': 'set', 'key': 'key1', 'value': 1, 'version': 5})
+        self.node.mset(
+            {'action': 'mset', 'items': {'key1': 1, 'key4': 4},
+             'version': 6})
+        self.node.remove({'action': 'remove', 'key': 'key4', 'version': 7})
+        self.assertEqual(self.node._last_sequence, 7)
+
+        reply = self.node.oplog({'since': 5, 'count': 1})
+        self.assertEqual(reply['next'], 6)
+        self.assertEqual([op['version'] for op in reply['ops']], [6])
+
+        reply = self.node.oplog({'since': 0, 'ranges': self.moved_ranges()})
+        self.assertEqual(reply['next'], None)
+        self.assertEqual(reply['ops'], [
+            {'action': 'mset', 'items': {'key4': 4}, 'version': 6},
+            {'action': 'remove', 'key': 'key4', 'version': 7}])
+
+    def test_catch_up(self):
+        self.node._cache = InMemoryCache()
+        self.node._node_client_class = node_client = MagicMock()
+        connection = node_client.create.return_value
+        connection.oplog.side_effect = [
+            defer.succeed({
+                'ops': [{'action': 'set', 'key': 'a', 'value': 1,
+                         'version': make_version(5000000)}],
+                'next': make_version(5000000)}),
+            defer.succeed({
+                'ops': [{'action': 'remove', 'key': 'a',
+                         'version': make_version(6000000)}],
+                'next': None})]
+
+        self.node._last_sequence = make_version(4000000)
+        d = self.node.bootstrap(
+            [['node-1', 'address1', None]], catch_up=True)
+        connection.oplog.assert_any_call(make_version(3000000), 1000, None)
+        connection.oplog.assert_called_with(make_version(5000000), 1000, None)
+        self.successResultOf(d)
+        self.assertEqual(self.node._cache.get('a'), None)
+        self.assertEqual(self.node._last_sequence, make_version(6000000))
+        connection.snapshot_chunk.assert_not_called()
+
+    def test_restored_catches_up(self):
+        path = self.mktemp()
+        cache = MappedCache(path)
+        cache.claim('node-1')
+        cache.set('a', 1, version=make_version(4000000))
+        with patch('brainer.lib.persistence.deferToThread',
+                   defer.maybeDeferred):
+            self.successResultOf(cache.dump(make_version(4000000)))
+        cache.close()
+
+        node = TestNode(
+            self.mock_factory, self.mock_endpoint, broker='anaddress',
+            node_id='node-1', cache_class=MappedCache,
+            cache_kwargs={'path': path})
+        self.assertEqual(node._cache.get('a'), 1)
+        self.assertEqual(node._last_sequence, make_version(4000000))
+        node._catch_up = MagicMock()
+        node._pull_snapshot = MagicMock()
+        node.bootstrap([['node-1', 'address1', None]])
+        node._catch_up.assert_called_once_with('address1', None, make_version(3000000))
+
+        # Only the first time, later ranges are new to us.
+        node.bootstrap([['node-1', 'address1', None]])
+        node._pull_snapshot.assert_called_once_with('address1', None)
+
+    def restart(self, cache_class, path, node_id, **cache_kwargs):
+        cache = cache_class(path, **cache_kwargs)
+        cache.claim('node-1')
+        cache.set('a', 1, version=make_version(4000000))
+        if cache_class is MappedCache:
+            with patch('brainer.lib.persistence.deferToThread',
+                       defer.maybeDeferred):
+                self.successResultOf(cache.dump(make_version(4000000)))
+        cache.close()
+
+        cache_kwargs['path'] = path
+        node = TestNode(
+            self.mock_factory, self.mock_endpoint, broker='anaddress',
+            node_id=node_id, cache_class=cache_class,
+            cache_kwargs=cache_kwargs)
+        self.addCleanup(node._cache.close)
+        return node
+
+    def test_restored_from_log(self):
+        node = self.restart(
+            AppendOnlyCache, self.mktemp(), 'node-1', clock=task.Clock())
+        self.assertEqual(node._last_sequence, make_version(4000000))
+        self.assertTrue(node._restored)
+
+    def test_restored_under_another_id(self):
+        # Its ranges of the ring are not the ones the data was for, so
+        # the writes made since are not all it is missing.
+        caches = [(MappedCache, {}),
+                  (AppendOnlyCache, {'clock': task.Clock()})]
+        for node_id in ('node-2', None):
+            for cache_class, kwargs in caches:
+                path = self.mktemp()
+                node = self.restart(cache_class, path, node_id, **kwargs)
+                self.assertEqual(node._cache.get('a'), 1)
+                self.assertFalse(node._restored)
+                self.assertEqual(node._last_sequence, None)
+                self.assertEqual(node._cache.owner, node.id)
+
+                node._pull_snapshot = MagicMock()
+                node.bootstrap([['node-3', 'address3', None]])
+                node._pull_snapshot.assert_called_once_with('address3', None)
+
+    def test_save_snapshot(self):
+        self.node._last_sequence = 10
+        self.node.save_snapshot()
+        self.node._cache.dump.assert_called_once_with(10)
+
+    def test_catch_up_truncated(self):
+        self.node._cache = InMemoryCache()
+        self.node._node_client_class = node_client = MagicMock()
+        connection = node_client.create.return_value
+        connection.oplog.return_value = defer.succeed(
+            {'ops': None, 'next': None})
+        connection.snapshot_chunk.return_value = defer.succeed({
+            'chunk': {'data': {'a': 1}, 'expiration': {},
+                      'version': {'a': 5000000}},
+            'cursor': None})
+
+        self.node._last_sequence = 4000000
+        d = self.node.bootstrap(
+            [['node-1', 'address1', None]], catch_up=True)
+        self.successResultOf(d)
+        self.assertEqual(self.node._cache.get('a'), 1)
+        self.assertEqual(self.node._last_sequence, 5000000)
+
+    def test_set_expires(self):
+        self.node._cache = InMemoryCache()
+        self.node.set({'key': 'a', 'value': 1, 'expires': 10})
+        self.node.mset({'items': {'b': 2}, 'expires': 10})
+        self.assertEqual(sorted(self.node._cache._expiration), ['a', 'b'])
+
+    def test_sweep(self):
+        self.node._sweep_limit = 5
+        self.node.sweep()
+        self.node._cache.expire.assert_called_once_with(5)
+
+    def test_topology_published(self):
+        self.node.topology_published(
+            'topology', {'event': 'joined', 'node_id': 'node-2',
+                         'topology': {'version': 4}})
+        self.assertEqual(self.node._topology_version, 4)
+        self.assertTrue(self.node.ping({'action': 'ping'}))
+
+    def test_topology_published_out_of_order(self):
+        changed = [
+            self.node.topology_published(
+                'topology', {'event': 'joined', 'node_id': 'node-2',
+                             'topology': {'version': version}})
+            for version in (5, 3, 4)]
+        self.assertEqual(changed, [True, False, False])
+        self.assertEqual(self.node._topology_version, 5)
+        self.assertTrue(self.node.is_stale({'topology': 4}))
+
+    def test_cache_kwargs(self):
+        node = TestNode(
+            self.mock_factory, self.mock_endpoint, broker='anaddress',
+            cache_class=BoundedCache, cache_kwargs={'max_items': 1})
+        node.set({'key': 'a', 'value': 1})
+        node.set({'key': 'b', 'value': 2})
+        self.assertEqual(node._cache.keys(), ['b'])
+        self.assertEqual(node.cache_stats({})['evictions'], 1)
+
     def test_on_shutdown_not_registered(self):
         self.node._broker = MagicMock()
         self.node.on_shutdown()
@@ -58,6 +320,7 @@ class NodeTest(unittest.TestCase):
         self.node._is_registered = True
         self.node.on_shutdown()
         self.node._broker.unregister.assert_called_with()
+        self.node._cache.close.assert_called_once_with()
 
     def test_get(self):
         message = {'key': 'akey'}
@@ -67,10 +330,98 @@ class NodeTest(unittest.TestCase):
     def test_remove(self):
         message = {'key': 'akey'}
         self.node.remove(message)
-        self.node._cache.remove.assert_called_with(message['key'])
+        self.node._cache.remove.assert_called_with(
+            message['key'], version=None)
+
+    def test_remove_ignores_older_versions(self):
+        self.node._cache.version.return_value = 10
+        message = {'key': 'akey', 'version': 9}
+        self.assertEqual(self.node.remove(message), True)
+        self.node._cache.remove.assert_not_called()
+
+        message = {'key': 'akey', 'version': 11}
+        self.node.remove(message)
+        self.node._cache.remove.assert_called_with(
+            message['key'], version=11)
 
     def test_set(self):
         message = {'key': 'mykey', 'value': 'myvalue'}
         self.node.set(message)
         self.node._cache.set.assert_called_with(
-            message['key'], message['value'])
+            message['key'], message['value'], expires=None, version=None)
+
+    def test_set_ignores_older_versions(self):
+        self.node._cache.version.return_value = 10
+        message = {'key': 'mykey', 'value': 'myvalue', 'version': 9}
+        self.assertEqual(self.node.set(message), True)
+        self.node._cache.set.assert_not_called()
+
+        message = {'key': 'mykey', 'value': 'myvalue', 'version': 11}
+        self.node.set(message)
+        self.node._cache.set.assert_called_with(
+            message['key'], message['value'], expires=None, version=11)
+
+    def test_get_versioned(self):
+        self.node._cache.get.return_value = 'avalue'
+        self.node._cache.version.return_value = 10
+        message = {'key': 'akey', 'versioned': True}
+        self.assertEqual(self.node.get(message), ['avalue', 10])
+
+    def test_mset(self):
+        message = {'items': {'key1': 1, 'key2': 2}, 'version': 5}
+        self.node._cache.version.return_value = None
+        self.node._cache.set.return_value = True
+        self.assertEqual(self.node.mset(message), {'key1': True, 'key2': True})
+        self.node._cache.set.assert_any_call(
+            'key1', 1, expires=None, version=5)
+        self.node._cache.set.assert_any_call(
+            'key2', 2, expires=None, version=5)
+
+    def test_mget(self):
+        self.node._cache.get.side_effect = {'key1': 1, 'key2': None}.get
+        self.node._cache.version.return_value = 5
+        message = {'keys': ['key1', 'key2']}
+        self.assertEqual(self.node.mget(message), {'key1': 1, 'key2': None})
+
+        message['versioned'] = True
+        self.assertEqual(
+            self.node.mget(message), {'key1': [1, 5], 'key2': [None, 5]})
+
+    def test_mremove(self):
+        self.node._cache.remove.side_effect = (
+            lambda key, version: key == 'key1')
+        message = {'keys': ['key1', 'key2']}
+        self.assertEqual(
+            self.node.mremove(message), {'key1': True, 'key2': False})
+
+    def test_topology(self):
+        self.assertFalse(self.node.is_stale({'topology': 1}))
+        self.assertTrue(self.node.topology({'version': 2}))
+        self.assertTrue(self.node.is_stale({'topology': 1}))
+        self.assertFalse(self.node.is_stale({'topology': 2}))
+        # Messages from the broker don't carry a topology.
+        self.assertFalse(self.node.is_stale({}))
+        # Another broker may tell us of an older version late.
+        self.assertFalse(self.node.topology({'version': 1}))
+        self.assertTrue(self.node.is_stale({'topology': 1}))
+
+    def test_gotMessage_stale_topology(self):
+        self.node.reply_error = MagicMock()
+        self.node.reply = MagicMock()
+        self.node.topology({'version': 2})
+        message = umsgpack.dumps({'action': 'get', 'key': 'k', 'topology': 1})
+        self.node.gotMessage('id', message)
+        self.node.reply_error.assert_called_once_with(
+            'id', 'STALE_TOPOLOGY', 'Topology version is 2.')
+        self.node.reply.assert_not_called()
+
+    def test_apply(self):
+        self.node._cache.version.return_value = None
+        self.node._cache.set.return_value = True
+        self.node._cache.remove.return_value = False
+        message = {'ops': [
+            {'action': 'set', 'key': 'a', 'value': 1},
+            {'action': 'remove', 'key': 'b'},
+            {'action': 'snapshot'}]}
+        self.assertEqual(self.node.apply(message), [True, False, None])
+        self.node._cache.snapshot.assert_not_called()
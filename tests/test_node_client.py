@@ -1,4 +1,5 @@
 # -*- coding: utf8 -*-
+import os
 import sys
 import uuid
 
@@ -16,6 +17,8 @@ class TestNodeClient(NodeClient):
     def __init__(self, *args, **kwargs):
         self._timeout = 5
         self._serializer = umsgpack
+        self._nonce = os.urandom(8)
+        self._counter = 0
 
 
 class NodeClientTest(unittest.TestCase):
@@ -41,6 +44,27 @@ class NodeClientTest(unittest.TestCase):
         self.client.remove('message')
         self.client.sendMsg.assert_called_once_with('message')
 
+    def test_multi(self):
+        self.client.mget('message')
+        self.client.mset('message')
+        self.client.mremove('message')
+        self.assertEqual(self.client.sendMsg.call_count, 3)
+
+    def test_message_ids(self):
+        first, second = self.client._getNextId(), self.client._getNextId()
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(first), 16)
+        # Ids of other connections don't collide, the node routes
+        # replies by id alone.
+        other = TestNodeClient()
+        self.assertNotEqual(other._getNextId(), first)
+
     def test_snapshot(self):
         self.client.snapshot()
         self.client.sendMsg.assert_called_once_with({'action': 'snapshot'})
+
+    def test_snapshot_chunk(self):
+        self.client.snapshot_chunk(['stream', 10], 100, [[-1, 10]])
+        self.client.sendMsg.assert_called_once_with({
+            'action': 'snapshot_chunk', 'cursor': ['stream', 10],
+            'count': 100, 'ranges': [[-1, 10]]})
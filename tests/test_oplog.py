@@ -0,0 +1,43 @@
+# -*- coding: utf8 -*-
+from twisted.trial import unittest
+
+from brainer.node.oplog import OpLog
+
+
+class OpLogTest(unittest.TestCase):
+    def setUp(self):
+        self.oplog = OpLog(max_size=3)
+
+    def test_since(self):
+        for version in (1, 3, 2):
+            self.oplog.append({'key': 'a', 'version': version})
+        self.oplog.append({'key': 'a'})  # Not versioned, not logged.
+        self.assertEqual(len(self.oplog), 3)
+        self.assertEqual(
+            [op['version'] for op in self.oplog.since(1)], [2, 3])
+        self.assertEqual(
+            [op['version'] for op in self.oplog.since(0, count=1)], [1])
+
+    def test_truncated(self):
+        for version in (2, 1, 3, 4):
+            self.oplog.append({'key': 'a', 'version': version})
+        # 1 was dropped, the oldest, so anything before it is incomplete.
+        self.assertEqual(self.oplog.since(0), None)
+        self.assertEqual(
+            [op['version'] for op in self.oplog.since(1)], [2, 3, 4])
+        self.assertEqual(
+            [op['version'] for op in self.oplog.since(2)], [3, 4])
+
+    def test_keeps_sequence_order(self):
+        oplog = OpLog(max_size=100)
+        for version in range(0, 300, 2) + [101, 299, 250]:
+            oplog.append({'key': 'a', 'version': version})
+        self.assertEqual(len(oplog), 100)
+        versions = [op['version'] for op in oplog.since(200)]
+        self.assertEqual(versions, sorted(versions))
+        self.assertEqual(versions[:4], [202, 204, 206, 208])
+        self.assertIn(250, versions)
+        self.assertIn(299, versions)
+        self.assertEqual(len(oplog.since(200, count=5)), 5)
+        # 101 arrived after older writes were dropped.
+        self.assertEqual(oplog.since(100), None)
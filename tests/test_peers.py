@@ -0,0 +1,57 @@
+# -*- coding: utf8 -*-
+import sys
+
+import umsgpack
+from mock import MagicMock
+from twisted.internet import task
+from twisted.trial import unittest
+
+if 'brainer' not in sys.path:
+    sys.path.append('brainer')
+
+from brainer.broker.peers import BrokerPeers, MEMBERSHIP
+from brainer.lib.pubsub import Subscriber
+
+
+class BrokerPeersTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = MagicMock()
+        self.clock = task.Clock()
+        self.subscriber_class = MagicMock()
+        self.peers = BrokerPeers(
+            self.broker, ['ipc:///tmp/peer.sock'], interval=1,
+            clock=self.clock, subscriber_class=self.subscriber_class)
+
+    def test_subscribes(self):
+        self.subscriber_class.create.assert_called_once_with(
+            ['ipc:///tmp/peer.sock'], [MEMBERSHIP], self.peers.received,
+            factory=self.broker._factory)
+
+    def test_sync(self):
+        self.peers.start()
+        self.assertEqual(self.broker.publish_members.call_count, 1)
+        self.clock.advance(1)
+        self.assertEqual(self.broker.publish_members.call_count, 2)
+        self.peers.stop()
+        self.clock.advance(1)
+        self.assertEqual(self.broker.publish_members.call_count, 2)
+        self.subscriber_class.create().shutdown.assert_called_once_with()
+
+    def test_received(self):
+        members = [['node-1', 'address-1', 10, True]]
+        self.peers.received(
+            MEMBERSHIP, {'topology': 3, 'members': members})
+        self.broker.merge_members.assert_called_once_with(members, 3)
+
+
+class SubscriberTest(unittest.TestCase):
+    def test_got_message(self):
+        subscriber = Subscriber.__new__(Subscriber)
+        subscriber._serializer = umsgpack
+        subscriber._callback = MagicMock()
+        subscriber.gotMessage(umsgpack.packb({'a': 1}), 'tag')
+        subscriber._callback.assert_called_once_with('tag', {'a': 1})
+
+        subscriber._callback.side_effect = KeyError
+        subscriber.gotMessage(umsgpack.packb({}), 'tag')
+        self.assertEqual(len(self.flushLoggedErrors(KeyError)), 1)
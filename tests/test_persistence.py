@@ -0,0 +1,275 @@
+# -*- coding: utf8 -*-
+import os
+
+from mock import patch
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from brainer.lib import persistence
+from brainer.lib.persistence import (
+    AppendOnlyCache, BoundedAppendOnlyCache, MappedCache, MappedValues,
+    ALWAYS, read_records)
+
+
+def run_now(f, *args, **kwargs):
+    return defer.maybeDeferred(f, *args, **kwargs)
+
+
+class AppendOnlyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.clock = task.Clock()
+        self.patcher = patch(
+            'brainer.lib.persistence.deferToThread', run_now)
+        self.patcher.start()
+        self.cache = self.create()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create(self, **kwargs):
+        return AppendOnlyCache(self.path, clock=self.clock, **kwargs)
+
+    def reopen(self, **kwargs):
+        self.cache.close()
+        self.cache = self.create(**kwargs)
+        return self.cache
+
+    def test_load(self):
+        self.cache.set('a', 1, version=10)
+        self.cache.set('b', 2, expires=60)
+        self.cache.set('c', 3)
+        self.cache.set('a', 4, version=20)
+        self.cache.remove('c')
+
+        cache = self.reopen()
+        self.assertEqual(sorted(cache.keys()), ['a', 'b'])
+        self.assertEqual(cache.get('a'), 4)
+        self.assertEqual(cache.version('a'), 20)
+        self.assertTrue(0 < cache.snapshot()['expiration']['b'] <= 60)
+        self.assertEqual(cache.digests(0), self.cache.digests(0))
+
+    def test_load_skips_expired(self):
+        self.cache.set('a', 1, expires=60)
+        self.cache.close()
+        now = persistence.time.time() + 61
+        with patch('brainer.lib.persistence.time.time', return_value=now):
+            cache = self.create()
+        self.assertEqual(cache.keys(), [])
+
+    def test_load_drops_broken_record(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 1)
+
+        cache = self.cache = self.create()
+        self.assertEqual(cache.keys(), ['a'])
+        cache.set('c', 3)
+        cache = self.reopen()
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+
+    def test_replay_update(self):
+        self.cache.replay(
+            {'data': {'a': 1}, 'expiration': {}, 'version': {'a': 5}},
+            update=True)
+        self.assertEqual(self.reopen().version('a'), 5)
+
+    def test_compact(self):
+        for i in range(100):
+            self.cache.set('a', i)
+        self.cache.set('b', 1)
+        self.cache._log.flush()
+        size = os.path.getsize(self.path)
+
+        self.cache.compact()
+        records = list(read_records(self.path))
+        # Two records, then the offset they end at.
+        self.assertEqual(len(records), 3)
+        self.assertTrue(os.path.getsize(self.path) < size)
+        self.assertEqual(self.reopen().get('a'), 99)
+
+    def test_compact_keeps_writes_made_meanwhile(self):
+        running = defer.Deferred()
+        with patch('brainer.lib.persistence.deferToThread',
+                   lambda f, *args: running.addCallback(
+                       lambda _: f(*args))):
+            d = self.cache.compact()
+            self.cache.set('a', 1)
+            self.assertIs(self.cache.compact(), d)
+            running.callback(None)
+        self.successResultOf(d)
+        self.cache.set('b', 2)
+        self.assertEqual(sorted(self.reopen().keys()), ['a', 'b'])
+
+    def test_compact_appends_writes_made_after_the_rewrite(self):
+        self.cache.set('a', 1)
+        switch = defer.Deferred()
+
+        def rewrite(f, *args):
+            result = f(*args)
+            return switch.addCallback(lambda _: result)
+
+        with patch('brainer.lib.persistence.deferToThread', rewrite):
+            d = self.cache.compact()
+        self.cache.set('b', 2)
+        self.cache.remove('a')
+        switch.callback(None)
+        self.successResultOf(d)
+        self.cache.set('c', 3)
+        self.assertEqual(sorted(self.reopen().keys()), ['b', 'c'])
+
+    def test_replay_while_compacting(self):
+        running = []
+
+        def rewrite(f, *args):
+            running.append(defer.Deferred())
+            return running[-1].addCallback(lambda _: f(*args))
+
+        with patch('brainer.lib.persistence.deferToThread', rewrite):
+            self.cache.set('a', 1)
+            self.cache.compact()
+            self.cache.replay({'data': {'b': 2}, 'expiration': {}})
+            running[0].callback(None)
+            # The replayed keys get a compaction of their own.
+            self.assertEqual(len(running), 2)
+            running[1].callback(None)
+        self.assertEqual(self.reopen().keys(), ['b'])
+
+    def test_sequence(self):
+        self.assertEqual(self.cache.sequence, None)
+        self.cache.set('a', 1, version=20)
+        self.cache.set('b', 2, version=10)
+        self.cache.remove('a')
+        self.assertEqual(self.reopen().sequence, 20)
+
+    def test_tick_compacts(self):
+        cache = self.reopen(compact_min_size=100, compact_growth=2)
+        for i in range(20):
+            cache.set('a', i)
+        with patch.object(cache, 'compact') as compact:
+            self.clock.advance(1)
+        compact.assert_called_once_with()
+
+    def test_fsync(self):
+        with patch('brainer.lib.persistence.os.fsync') as fsync:
+            self.cache.set('a', 1)
+            fsync.assert_not_called()
+            self.clock.advance(1)
+            self.assertEqual(fsync.call_count, 1)
+
+            cache = self.reopen(fsync=ALWAYS)
+            fsync.reset_mock()
+            cache.set('a', 1)
+            self.assertEqual(fsync.call_count, 1)
+
+    def test_owner(self):
+        self.assertEqual(self.cache.owner, None)
+        self.cache.claim('node-1')
+        self.cache.set('a', 1)
+        self.assertEqual(self.reopen().owner, 'node-1')
+        self.cache.compact()
+        self.assertEqual(self.reopen().owner, 'node-1')
+        self.cache.claim('node-2')
+        self.assertEqual(self.reopen().owner, 'node-2')
+        self.assertEqual(self.cache.keys(), ['a'])
+
+    def test_invalid_fsync(self):
+        self.assertRaises(ValueError, self.create, fsync='sometimes')
+
+    def test_bounded(self):
+        self.cache.close()
+        cache = BoundedAppendOnlyCache(
+            self.path, clock=self.clock, max_items=1)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.close()
+        cache = self.create()
+        self.assertEqual(cache.keys(), ['b'])
+
+
+class MappedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.patcher = patch(
+            'brainer.lib.persistence.deferToThread', run_now)
+        self.patcher.start()
+        self.cache = MappedCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.patcher.stop()
+
+    def reopen(self, sequence=None):
+        self.successResultOf(self.cache.dump(sequence))
+        self.cache.close()
+        self.cache = MappedCache(self.path)
+        return self.cache
+
+    def test_owner(self):
+        self.assertEqual(self.reopen().owner, None)
+        self.cache.claim(u'nó-1')
+        self.assertEqual(self.reopen().owner, u'nó-1')
+
+    def test_load(self):
+        self.cache.set('a', [1, 2], version=10)
+        self.cache.set(u'ключ', 'value', expires=60)
+        self.cache.set('c', 3)
+        self.cache.remove('c')
+        digests = self.cache.digests(0)
+
+        cache = self.reopen(sequence=10)
+        self.assertEqual(cache.sequence, 10)
+        self.assertIsInstance(cache._cache, MappedValues)
+        self.assertEqual(sorted(cache.keys()), sorted(['a', u'ключ']))
+        # Nothing read yet, not even to build the Merkle tree.
+        self.assertEqual(len(cache._cache._index), 2)
+        self.assertEqual(cache.digests(0), digests)
+
+        self.assertEqual(cache.get('a'), [1, 2])
+        self.assertEqual(cache._cache._index.keys(), [u'ключ'])
+        self.assertEqual(cache.version('a'), 10)
+        self.assertTrue(0 < cache.snapshot()['expiration'][u'ключ'] <= 60)
+
+    def test_load_skips_expired(self):
+        self.cache.set('a', 1, expires=60)
+        self.successResultOf(self.cache.dump())
+        now = persistence.time.time() + 61
+        with patch('brainer.lib.persistence.time.time', return_value=now):
+            cache = MappedCache(self.path)
+        self.assertEqual(cache.keys(), [])
+        self.assertEqual(cache.sequence, None)
+        cache.close()
+
+    def test_dump_copies_values_not_read(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        cache = self.reopen()
+        cache.set('b', 3)
+        cache.set('c', 4)
+        cache.remove('a')
+        self.successResultOf(cache.dump())
+        # Still mapped, from the new file.
+        self.assertEqual(cache._cache._index.keys(), [])
+
+        cache.set('d', 5)
+        cache = self.reopen()
+        self.assertEqual(
+            dict((key, cache.get(key)) for key in cache.keys()),
+            {'b': 3, 'c': 4, 'd': 5})
+
+    def test_remap(self):
+        for key in 'abc':
+            self.cache.set(key, key * 10)
+        cache = self.reopen()
+        cache.get('a')
+        self.successResultOf(cache.dump())
+        self.assertEqual(sorted(cache._cache._index), ['b', 'c'])
+        self.assertEqual(cache.get('c'), 'c' * 10)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write('nonsense' * 10)
+        self.assertRaises(ValueError, MappedCache, self.path)
@@ -0,0 +1,60 @@
+# -*- coding: utf8 -*-
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from brainer.lib import quorum
+from brainer.lib.exceptions import QuorumError, ConsistencyLevelError
+
+
+class RequiredTest(unittest.TestCase):
+    def test_levels(self):
+        self.assertEqual(quorum.required(quorum.ONE, 3), 1)
+        self.assertEqual(quorum.required(quorum.QUORUM, 3), 2)
+        self.assertEqual(quorum.required(quorum.QUORUM, 4), 3)
+        self.assertEqual(quorum.required(quorum.ALL, 3), 3)
+
+    def test_integer(self):
+        self.assertEqual(quorum.required(2, 3), 2)
+        self.assertEqual(quorum.required(5, 3), 3)
+
+    def test_invalid(self):
+        self.assertRaises(ConsistencyLevelError, quorum.required, 'many', 3)
+        self.assertRaises(ConsistencyLevelError, quorum.required, 0, 3)
+        self.assertRaises(ConsistencyLevelError, quorum.required, True, 3)
+
+
+class GatherTest(unittest.TestCase):
+    def test_fires_on_quorum(self):
+        deferreds = [defer.Deferred() for _ in range(3)]
+        d = quorum.gather(deferreds, 2)
+        deferreds[2].callback('c')
+        self.assertNoResult(d)
+        deferreds[0].callback('a')
+        self.assertEqual(self.successResultOf(d), ['c', 'a'])
+        # Late replies are ignored.
+        deferreds[1].callback('b')
+
+    def test_tolerates_failures(self):
+        deferreds = [defer.Deferred() for _ in range(3)]
+        d = quorum.gather(deferreds, 2)
+        deferreds[0].errback(ValueError())
+        deferreds[1].callback('b')
+        self.assertNoResult(d)
+        deferreds[2].callback('c')
+        self.assertEqual(self.successResultOf(d), ['b', 'c'])
+
+    def test_fails_when_quorum_is_impossible(self):
+        deferreds = [defer.Deferred() for _ in range(3)]
+        d = quorum.gather(deferreds, 2)
+        deferreds[0].errback(ValueError())
+        self.assertNoResult(d)
+        deferreds[1].errback(ValueError())
+        self.failureResultOf(d, QuorumError)
+        deferreds[2].callback('c')
+
+    def test_not_enough_replicas(self):
+        d = quorum.gather([defer.succeed('a')], 2)
+        self.failureResultOf(d, QuorumError)
+
+    def test_nothing_needed(self):
+        self.assertEqual(self.successResultOf(quorum.gather([], 0)), [])
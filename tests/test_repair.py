@@ -0,0 +1,138 @@
+# -*- coding: utf8 -*-
+from mock import MagicMock
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from brainer.broker.repair import AntiEntropy
+from brainer.lib.cache import BoundedCache
+from tests.test_broker import TestBroker
+from tests.test_node import TestNode
+
+
+class NodeConnection(object):
+    """Speaks to a node in-process, like a `NodeClient` would."""
+    def __init__(self, node):
+        self.node = node
+
+    def topology(self, version):
+        return defer.succeed(self.node.topology({'version': version}))
+
+    def merkle(self, level, indexes=None, ranges=None):
+        return defer.succeed(self.node.merkle(
+            {'level': level, 'indexes': indexes, 'ranges': ranges}))
+
+    def merkle_range(self, buckets, ranges=None):
+        return defer.succeed(self.node.merkle_range(
+            {'buckets': buckets, 'ranges': ranges}))
+
+    def merge(self, snapshot):
+        return defer.succeed(self.node.merge({'snapshot': snapshot}))
+
+
+class AntiEntropyTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = TestBroker(MagicMock(), MagicMock())
+        self.nodes = {}
+        for node_id in ('node-1', 'node-2'):
+            node = TestNode(MagicMock(), MagicMock(), broker='anaddress')
+            node._id = node_id
+            self.nodes[node_id] = node
+            self.broker._nodes.append(node_id)
+            self.broker._nodes_connections[node_id] = NodeConnection(node)
+        self.broker.update_ring(transfer=False)
+        self.clock = task.Clock()
+        self.repair = AntiEntropy(self.broker, interval=10, clock=self.clock)
+
+    def cache(self, node_id):
+        return self.nodes[node_id]._cache
+
+    def test_in_sync(self):
+        for node_id in self.nodes:
+            self.cache(node_id).set('a', 1, version=1)
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertEqual(self.successResultOf(d), 0)
+
+    def test_repairs_differences(self):
+        for node_id in self.nodes:
+            self.cache(node_id).set('same', 1, version=1)
+        self.cache('node-1').set('missing', 2, version=2)
+        self.cache('node-1').set('stale', 'old', version=3)
+        self.cache('node-2').set('stale', 'new', version=4)
+
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertTrue(self.successResultOf(d) > 0)
+        self.assertEqual(self.cache('node-2').get('missing'), 2)
+        self.assertEqual(self.cache('node-1').get('stale'), 'new')
+        self.assertEqual(
+            self.cache('node-1').digests(0), self.cache('node-2').digests(0))
+
+    def test_removes_are_not_undone(self):
+        for node_id in self.nodes:
+            self.cache(node_id).set('a', 1, version=1)
+        # The remove only reached node-1.
+        self.nodes['node-1'].remove(
+            {'action': 'remove', 'key': 'a', 'version': 2})
+
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertTrue(self.successResultOf(d) > 0)
+        for node_id in self.nodes:
+            self.assertEqual(self.cache(node_id).get('a'), None)
+        self.assertEqual(
+            self.cache('node-1').digests(0), self.cache('node-2').digests(0))
+
+    def test_evicted_keys_are_not_copied_back(self):
+        self.nodes['node-2']._cache = BoundedCache(max_items=1)
+        for node_id in self.nodes:
+            self.cache(node_id).set('a', 1, version=1)
+        self.cache('node-1').set('b', 2, version=2)
+        self.cache('node-2').set('a', 3, version=3)
+
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertTrue(self.successResultOf(d) > 0)
+        self.assertEqual(self.cache('node-2').keys(), ['a'])
+        self.assertEqual(self.cache('node-1').get('a'), 3)
+
+    def test_partial_replication(self):
+        self.broker._replication = 1
+        self.broker.update_ring(transfer=False)
+        # Not shared by both nodes, so left alone.
+        self.cache('node-1').set('key1', 1, version=1)
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertEqual(self.successResultOf(d), 0)
+        self.assertEqual(self.cache('node-2').get('key1'), None)
+
+    def test_shared_ranges_only(self):
+        node = TestNode(MagicMock(), MagicMock(), broker='anaddress')
+        node._id = 'node-3'
+        self.nodes['node-3'] = node
+        self.broker._nodes.append('node-3')
+        self.broker._nodes_connections['node-3'] = NodeConnection(node)
+        self.broker._replication = 2
+        self.broker.update_ring(transfer=False)
+
+        keys = ['key-{}'.format(i) for i in range(100)]
+        ring = self.broker._ring
+        replicas = dict(zip(keys, ring.get_replicas_many(keys, 2)))
+        shared = [key for key in keys
+                  if sorted(replicas[key]) == ['node-1', 'node-2']]
+        for key in keys:
+            self.cache('node-1').set(key, 1, version=1)
+
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertTrue(self.successResultOf(d) > 0)
+        self.assertEqual(sorted(self.cache('node-2').keys()), sorted(shared))
+
+        # In sync from then on, the trees follow the writes.
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertEqual(self.successResultOf(d), 0)
+        self.cache('node-2').set(shared[0], 2, version=2)
+        d = self.repair.repair('node-1', 'node-2')
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(self.cache('node-1').get(shared[0]), 2)
+
+    def test_runs_in_turns(self):
+        self.repair.repair = MagicMock(return_value=defer.succeed(0))
+        self.repair.start()
+        self.clock.advance(10)
+        self.repair.repair.assert_called_once_with('node-1', 'node-2')
+        self.repair.stop()
@@ -0,0 +1,113 @@
+# -*- coding: utf8 -*-
+from mock import MagicMock
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from brainer.broker.replication import ReplicationQueue
+from brainer.lib.exceptions import ReplicationQueueFullError
+from brainer.lib.versions import make_version
+
+
+class ReplicationQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connection = MagicMock()
+        self.replies = []
+
+        def reply(message):
+            d = defer.Deferred()
+            self.replies.append(d)
+            return d
+
+        self.connection.set.side_effect = reply
+        self.queue = ReplicationQueue(
+            self.connection, max_size=1, concurrency=1, retries=1,
+            retry_delay=1, clock=self.clock)
+
+    def test_bounded(self):
+        first = self.queue.set({'key': 'a', 'version': 1})
+        second = self.queue.set({'key': 'b', 'version': 2})
+        self.assertEqual(len(self.queue), 1)
+        self.assertTrue(self.queue.full())
+        self.failureResultOf(
+            self.queue.set({'key': 'c', 'version': 3}),
+            ReplicationQueueFullError)
+        self.assertEqual(self.queue.shed, 1)
+        self.assertEqual(self.connection.set.call_count, 1)
+
+        self.replies[0].callback(True)
+        self.assertEqual(self.successResultOf(first), True)
+        self.assertEqual(self.connection.set.call_count, 2)
+        self.assertEqual(len(self.queue), 0)
+        self.assertFalse(self.queue.full())
+
+        self.replies[1].callback(True)
+        self.assertEqual(self.successResultOf(second), True)
+
+    def test_retries(self):
+        d = self.queue.set({'key': 'a'})
+        self.replies[0].errback(ValueError())
+        self.assertNoResult(d)
+        self.assertEqual(self.queue.retried, 1)
+
+        self.clock.advance(1)
+        self.assertEqual(self.connection.set.call_count, 2)
+        self.replies[1].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.queue.failed, 1)
+
+    def test_queue_goes_on_during_retries(self):
+        first = self.queue.set({'key': 'a', 'version': 1})
+        second = self.queue.set({'key': 'b', 'version': 2})
+        self.replies[0].errback(ValueError())
+        # The queued write is sent while the failed one waits.
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.connection.set.call_count, 2)
+        self.replies[1].callback(True)
+        self.assertEqual(self.successResultOf(second), True)
+
+        self.clock.advance(1)
+        self.replies[2].callback(True)
+        self.assertEqual(self.successResultOf(first), True)
+
+    def test_keeps_order(self):
+        queue = ReplicationQueue(
+            self.connection, max_size=2, concurrency=1, clock=self.clock)
+        queue.set({'key': 'a', 'version': 1})
+        queue.set({'key': 'b', 'version': 2})
+        # A slot frees up while a write is queued: it still goes first.
+        queue._inflight = 0
+        queue.set({'key': 'c', 'version': 3})
+        self.assertEqual(len(queue), 2)
+        queue._next()
+        self.assertEqual(
+            [call[0][0]['key'] for call in self.connection.set.call_args_list],
+            ['a', 'b'])
+
+    def test_lag(self):
+        self.queue.set({'key': 'a', 'version': make_version(1000000, 1)})
+        self.queue.set({'key': 'b', 'version': make_version(3000000, 2)})
+        self.replies[0].callback(True)
+        self.assertEqual(self.queue.lag(), 2.0)
+        self.replies[1].callback(True)
+        self.assertEqual(self.queue.stats(), {
+            'queued': 0, 'inflight': 0, 'lag': 0.0,
+            'shed': 0, 'retried': 0, 'failed': 0})
+
+    def test_other_methods_pass_through(self):
+        self.queue.get({'key': 'a'})
+        self.connection.get.assert_called_once_with({'key': 'a'})
+
+    def test_shutdown(self):
+        self.queue.set({'key': 'a'})
+        d = self.queue.set({'key': 'b'})
+        self.queue.shutdown()
+        self.failureResultOf(d, defer.CancelledError)
+        self.connection.shutdown.assert_called_once_with()
+
+    def test_shutdown_cancels_retries(self):
+        d = self.queue.set({'key': 'a'})
+        self.replies[0].errback(ValueError())
+        self.queue.shutdown()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,90 @@
+# -*- coding: utf8 -*-
+import sys
+import json
+import shutil
+import tempfile
+
+from mock import MagicMock, patch
+from twisted.internet import defer
+from twisted.trial import unittest
+
+if 'brainer' not in sys.path:
+    sys.path.append('brainer')
+
+from brainer.broker import Broker
+from brainer.node import Node, NodeClient
+from brainer.node.sharded import (
+    worker_endpoint, worker_id, start_workers, stop_workers)
+
+
+class WorkerHelpersTest(unittest.TestCase):
+    def test_worker_endpoint(self):
+        self.assertEqual(worker_endpoint('ipc:///tmp/node.sock', 2),
+                         'ipc:///tmp/node.sock.2')
+        self.assertEqual(worker_endpoint('tcp://127.0.0.1:5000', 2),
+                         'tcp://127.0.0.1:5002')
+
+    def test_worker_id(self):
+        self.assertEqual(worker_id('node-1', 0), 'node-1/0')
+
+    @patch('brainer.node.sharded.subprocess')
+    def test_start_and_stop_workers(self, subprocess):
+        processes = start_workers(2, {
+            'host': 'ipc:///tmp/node.sock', 'node_id': 'node-1',
+            'data_file': '/tmp/data', 'snapshot_file': None})
+        self.assertEqual(len(processes), 2)
+        options = [json.loads(call[0][0][-1])
+                   for call in subprocess.Popen.call_args_list]
+        self.assertEqual(options[1], {
+            'host': 'ipc:///tmp/node.sock.1', 'node_id': 'node-1/1',
+            'data_file': '/tmp/data.1', 'snapshot_file': None})
+
+        stop_workers(processes)
+        self.assertEqual(processes[0].terminate.call_count, 2)
+        self.assertEqual(processes[0].wait.call_count, 2)
+
+
+class WorkersSocketsTest(unittest.TestCase):
+    """The workers of a node registered with a broker on real sockets.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='brainer-test-')
+        address = 'ipc://{}/broker.sock'.format(self.directory)
+        self.broker = Broker.create(address, repair_interval=0)
+        self.workers = [
+            Node.create(
+                worker_endpoint('ipc://{}/node.sock'.format(self.directory),
+                                index),
+                broker=address, node_id=worker_id('node-1', index))
+            for index in range(2)]
+        self.client = NodeClient.create(address)
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker._sweeper.stop()
+            worker._broker.factory.shutdown()
+            worker.factory.shutdown()
+        for connection in (self.client, self.broker):
+            connection.factory.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @defer.inlineCallbacks
+    def test_keys_spread_over_workers(self):
+        for worker in self.workers:
+            yield worker.register()
+        self.assertEqual(sorted(self.broker._nodes), ['node-1/0', 'node-1/1'])
+
+        keys = ['key{}'.format(i) for i in range(20)]
+        yield defer.gatherResults([
+            self.client.sendMsg({'action': 'set', 'key': key, 'value': key})
+            for key in keys])
+        replies = yield defer.gatherResults([
+            self.client.sendMsg({'action': 'get', 'key': key})
+            for key in keys])
+        self.assertEqual(replies, keys)
+
+        # Workers of a node are never replicas of the same keys.
+        held = [set(worker._cache.keys()) for worker in self.workers]
+        self.assertTrue(all(held))
+        self.assertEqual(held[0] | held[1], set(keys))
+        self.assertFalse(held[0] & held[1])